@@ -122,6 +122,7 @@ coarse_model_and_render = dict(
     maskout_near_cam_vox=True,    # maskout grid points that between cameras and their near planes
     world_bound_scale=1,          # rescale the BBox enclosing the scene
     stepsize=0.5,                 # sampling stepsize in volume rendering
+    deferred_shading=False,       # march the features and run the colors MLP once per ray
 )
 
 fine_model_and_render = deepcopy(coarse_model_and_render)
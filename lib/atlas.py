@@ -0,0 +1,270 @@
+'''Baked sparse-brick atlas of a DirectVoxGO for real-time viewers.
+The density and k0 grids are cut into brick_size^3 bricks; only the bricks where the alpha
+can exceed the alpha threshold (fast_color_thres) are kept. Each kept brick stores its voxels
+and a one-voxel apron, so that the trilinear interpolation of a sample only reads its own brick.
+The view-dependent color is the rgbnet of the model (small MLP, float16 weights).
+    atlas.bin: magic | header length (uint32) | json header | 16-byte aligned raw sections
+    sections:  brick_index  int32   [nbx, nby, nbz]       atlas slot of each brick (-1: empty)
+               density      float16 [n, A, A, A]          A = brick_size + 1
+               k0           float16 [n, A, A, A, C]
+               mask_index   int32   [mbx, mby, mbz]       (optional) the mask_cache bricks
+               mask_bits    uint8   [m, brick_size^3/8]
+               rgbnet.{i}.weight / rgbnet.{i}.bias  float16
+The voxel grid is padded by one empty voxel on the low side (voxel i is the atlas voxel i+1),
+which makes the interpolation of the samples next to xyz_min read a kept brick as well.
+AtlasRenderer is the numpy reference renderer of the format (see tools/export_atlas.py --verify).
+'''
+import os, json, struct
+import numpy as np
+
+
+MAGIC = b'SVRFATL1'
+ALIGN = 16
+
+
+def activate_density(density, act_shift, interval):
+    return 1 - (1 + np.exp(density + act_shift)) ** (-interval)
+
+
+''' Writer
+'''
+def export_atlas(model, path, stepsize, brick_size=8, alpha_thres=None, render_kwargs=None):
+    '''Write the atlas of a DirectVoxGO w/ DenseGrid density and k0 grids and a k0 + rgbnet color.
+    @stepsize:    the stepsize the occupancy of the bricks is computed for.
+    @alpha_thres: drop the bricks whose alpha never exceeds it (default: the fast_color_thres of
+                  the model, or 1e-4 when it is 0).
+    Output: the header of the atlas.
+    '''
+    import torch
+    assert model.rgbnet is not None and not model.rgbnet_full_implicit, 'Only support the k0 + rgbnet models'
+    if alpha_thres is None:
+        alpha_thres = model.fast_color_thres if model.fast_color_thres > 0 else 1e-4
+    with torch.no_grad():
+        density = model.density.grid[0,0].float().cpu().numpy()
+        k0 = model.k0.grid[0].float().cpu().numpy()
+        mask = model.mask_cache.mask.cpu().numpy() if model.mask_cache is not None else None
+        layers = [(m.weight.cpu().numpy(), m.bias.cpu().numpy())
+                  for m in model.rgbnet.modules() if isinstance(m, torch.nn.Linear)]
+    header = {
+        'world_size': list(density.shape),
+        'xyz_min': model.xyz_min.tolist(),
+        'xyz_max': model.xyz_max.tolist(),
+        'voxel_size': float(model.voxel_size),
+        'voxel_size_ratio': float(model.voxel_size_ratio),
+        'act_shift': float(model.act_shift),
+        'stepsize': stepsize,
+        'alpha_thres': alpha_thres,
+        'fast_color_thres': float(model.fast_color_thres),
+        'rgbnet_direct': bool(model.rgbnet_direct),
+        'viewbase_pe': len(model.viewfreq),
+        'render_kwargs': {k: v for k, v in (render_kwargs or {}).items() if isinstance(v, (int, float, bool))},
+    }
+    return write_atlas(path, header, density, k0, mask, layers, brick_size)
+
+
+def write_atlas(path, header, density, k0, mask, layers, brick_size=8):
+    '''Write the atlas of the density [X, Y, Z] and k0 [C, X, Y, Z] grids (see export_atlas).'''
+    B, A = brick_size, brick_size + 1
+    world_size = list(density.shape)
+    n_bricks = [-(-(s + 1) // B) for s in world_size]
+    padded_size = [n * B + 1 for n in n_bricks]
+
+    # the padded grids: voxel i -> i+1, zeros elsewhere
+    density_p = np.zeros(padded_size, dtype=np.float32)
+    density_p[1:world_size[0]+1, 1:world_size[1]+1, 1:world_size[2]+1] = density
+    k0_p = np.zeros([len(k0)] + padded_size, dtype=np.float32)
+    k0_p[:, 1:world_size[0]+1, 1:world_size[1]+1, 1:world_size[2]+1] = k0
+
+    # a brick is kept if the alpha of any voxel of its apron exceeds the threshold, as the
+    # interpolated density is bounded by the ones of the voxels
+    interval = header['stepsize'] * header['voxel_size_ratio']
+    alpha = activate_density(density_p, header['act_shift'], interval)
+    windows = np.lib.stride_tricks.sliding_window_view(alpha, (A, A, A))[::B, ::B, ::B]
+    occupied = windows.max((-3, -2, -1)) > header['alpha_thres']
+    brick_ijk = np.argwhere(occupied)
+    brick_index = np.full(n_bricks, -1, dtype=np.int32)
+    brick_index[tuple(brick_ijk.T)] = np.arange(len(brick_ijk))
+    density_bricks = np.stack([density_p[i*B:i*B+A, j*B:j*B+A, k*B:k*B+A] for i, j, k in brick_ijk]) \
+                     if len(brick_ijk) else np.zeros([0, A, A, A], np.float32)
+    k0_bricks = np.stack([k0_p[:, i*B:i*B+A, j*B:j*B+A, k*B:k*B+A].transpose(1, 2, 3, 0) for i, j, k in brick_ijk]) \
+                if len(brick_ijk) else np.zeros([0, A, A, A, len(k0)], np.float32)
+
+    sections = {
+        'brick_index': brick_index,
+        'density': density_bricks.astype(np.float16),
+        'k0': k0_bricks.astype(np.float16),
+    }
+    # the mask_cache bricks (w/ the nearest lookup of grid.MaskGrid); skipped if all occupied
+    if mask is not None and not mask.all():
+        mask_bricks = [-(-s // B) for s in mask.shape]
+        mask_p = np.zeros([n * B for n in mask_bricks], dtype=bool)
+        mask_p[:mask.shape[0], :mask.shape[1], :mask.shape[2]] = mask
+        blocks = mask_p.reshape(mask_bricks[0], B, mask_bricks[1], B, mask_bricks[2], B).transpose(0, 2, 4, 1, 3, 5)
+        mask_ijk = np.argwhere(blocks.any((-3, -2, -1)))
+        mask_index = np.full(mask_bricks, -1, dtype=np.int32)
+        mask_index[tuple(mask_ijk.T)] = np.arange(len(mask_ijk))
+        sections['mask_index'] = mask_index
+        sections['mask_bits'] = np.packbits(blocks[tuple(mask_ijk.T)].reshape(len(mask_ijk), -1), axis=-1)
+        header['mask_world_size'] = list(mask.shape)
+    for i, (w, b) in enumerate(layers):
+        sections[f'rgbnet.{i}.weight'] = np.asarray(w).astype(np.float16)
+        sections[f'rgbnet.{i}.bias'] = np.asarray(b).astype(np.float16)
+
+    header = dict(header, brick_size=B, n_bricks=len(brick_ijk), k0_dim=len(k0),
+                  n_layers=len(layers), sections={})
+    offset = 0
+    for name, arr in sections.items():
+        offset += -offset % ALIGN
+        header['sections'][name] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+        offset += arr.nbytes
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(len(MAGIC) + 4 + len(header_bytes)) % ALIGN)
+    base = len(MAGIC) + 4 + len(header_bytes)
+    with open(os.path.join(path, 'atlas.bin'), 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+        for name, arr in sections.items():
+            f.write(b'\0' * (base + header['sections'][name]['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(arr).tobytes())
+    print(f'atlas: {len(brick_ijk)} / {int(np.prod(n_bricks))} bricks, {os.path.getsize(os.path.join(path, "atlas.bin"))/2**20:.2f} MB')
+    return header
+
+
+''' Reference renderer
+'''
+class AtlasRenderer:
+    '''Numpy reference renderer of atlas.bin, following DirectVoxGO.forward (w/o the shell
+    sampling, the deferred shading and the caches): the samples of sample_ray in the mask_cache
+    and the kept bricks, alpha and weight thresholds of fast_color_thres, and the rgbnet color.
+    Usage:
+        renderer = AtlasRenderer(path)
+        rgb, depth, alphainv_last = renderer.render_rays(rays_o, rays_d, viewdirs, near, far)
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, 'atlas.bin'), 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, 'not an atlas'
+            n = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(n))
+            data = f.read()
+        h = self.header
+        self.sections = {}
+        for name, s in h['sections'].items():
+            dtype = np.dtype(s['dtype'])
+            count = int(np.prod(s['shape']))
+            self.sections[name] = np.frombuffer(data, dtype, count, s['offset']).reshape(s['shape'])
+        self.xyz_min = np.array(h['xyz_min'], dtype=np.float32)
+        self.xyz_max = np.array(h['xyz_max'], dtype=np.float32)
+        self.world_size = np.array(h['world_size'])
+        self.B = h['brick_size']
+        self.density_bricks = self.sections['density'].astype(np.float32)
+        self.k0_bricks = self.sections['k0'].astype(np.float32)
+        self.layers = [(self.sections[f'rgbnet.{i}.weight'].astype(np.float32),
+                        self.sections[f'rgbnet.{i}.bias'].astype(np.float32)) for i in range(h['n_layers'])]
+        self.viewfreq = 2.0 ** np.arange(h['viewbase_pe'], dtype=np.float32)
+
+    def lookup(self, pts):
+        '''Atlas slot, local corner [M, 3] and the trilinear weights [M, 3] of the points.'''
+        u = (pts - self.xyz_min) / (self.xyz_max - self.xyz_min) * self.world_size - 0.5 + 1
+        i0 = np.clip(np.floor(u).astype(np.int64), 0, np.array(self.sections['brick_index'].shape) * self.B - 1)
+        w = (u - i0).astype(np.float32)
+        b = i0 // self.B
+        slot = self.sections['brick_index'][b[:,0], b[:,1], b[:,2]]
+        return slot, i0 - b * self.B, w
+
+    def interp(self, bricks, slot, local, w):
+        out = 0
+        for c in range(8):
+            d = [(c >> a) & 1 for a in range(3)]
+            wc = np.prod([w[:,a] if d[a] else 1 - w[:,a] for a in range(3)], 0)
+            v = bricks[slot, local[:,0]+d[0], local[:,1]+d[1], local[:,2]+d[2]]
+            out = out + (wc[:,None] * v if v.ndim == 2 else wc * v)
+        return out
+
+    def mask(self, pts):
+        '''The mask_cache lookup of grid.MaskGrid (nearest grid point, rounded half away from zero).'''
+        if 'mask_index' not in self.sections:
+            return np.ones(len(pts), dtype=bool)
+        world_size = np.array(self.header['mask_world_size'])
+        ijk = (pts - self.xyz_min) * ((world_size - 1) / (self.xyz_max - self.xyz_min))
+        ijk = (np.sign(ijk) * np.floor(np.abs(ijk) + 0.5)).astype(np.int64)
+        inside = ((ijk >= 0) & (ijk < world_size)).all(-1)
+        ijk = np.clip(ijk, 0, world_size - 1)
+        b = ijk // self.B
+        slot = self.sections['mask_index'][b[:,0], b[:,1], b[:,2]]
+        local = ijk - b * self.B
+        bit = (local[:,0] * self.B + local[:,1]) * self.B + local[:,2]
+        bits = self.sections['mask_bits'][np.maximum(slot, 0), bit >> 3]
+        return inside & (slot >= 0) & (((bits >> (7 - (bit & 7))) & 1) == 1)
+
+    def sample_ray(self, rays_o, rays_d, near, stepsize):
+        '''The sample_pts_on_rays of dvgo (far is the bbox).'''
+        stepdist = stepsize * self.header['voxel_size']
+        vec = np.where(rays_d == 0, np.float32(1e-6), rays_d)
+        rate_a = (self.xyz_max - rays_o) / vec
+        rate_b = (self.xyz_min - rays_o) / vec
+        t_min = np.maximum(np.minimum(rate_a, rate_b).max(-1), near)
+        t_max = np.maximum(np.maximum(rate_a, rate_b).min(-1), near)
+        rnorm = np.linalg.norm(rays_d, axis=-1)
+        N_steps = np.maximum(np.ceil((t_max - t_min) * rnorm / stepdist), 1).astype(np.int64)
+        ray_id = np.repeat(np.arange(len(rays_o)), N_steps)
+        step_id = np.arange(len(ray_id)) - (np.cumsum(N_steps) - N_steps)[ray_id]
+        rays_start = rays_o + rays_d * t_min[:,None]
+        rays_dir = rays_d / rnorm[:,None]
+        ray_pts = rays_start[ray_id] + rays_dir[ray_id] * (stepdist * step_id)[:,None].astype(np.float32)
+        inbbox = ((self.xyz_min <= ray_pts) & (ray_pts <= self.xyz_max)).all(-1)
+        return ray_pts[inbbox], ray_id[inbbox], step_id[inbbox]
+
+    def render_rays(self, rays_o, rays_d, viewdirs, near, far=None, stepsize=None, bg=None):
+        '''Output: rgb [N, 3], depth [N] (in steps, as render_depth) and alphainv_last [N].'''
+        h = self.header
+        stepsize = h['stepsize'] if stepsize is None else stepsize
+        bg = h['render_kwargs'].get('bg', 0) if bg is None else bg
+        rays_o, rays_d, viewdirs = [np.asarray(x, dtype=np.float32) for x in (rays_o, rays_d, viewdirs)]
+        N = len(rays_o)
+        ray_pts, ray_id, step_id = self.sample_ray(rays_o, rays_d, near, stepsize)
+
+        # alpha of the samples in the mask_cache and the kept bricks
+        keep = self.mask(ray_pts)
+        ray_pts, ray_id, step_id = ray_pts[keep], ray_id[keep], step_id[keep]
+        slot, local, w = self.lookup(ray_pts)
+        keep = slot >= 0
+        ray_pts, ray_id, step_id, slot, local, w = [x[keep] for x in (ray_pts, ray_id, step_id, slot, local, w)]
+        density = self.interp(self.density_bricks, slot, local, w)
+        alpha = activate_density(density, h['act_shift'], stepsize * h['voxel_size_ratio'])
+        if h['fast_color_thres'] > 0:
+            keep = alpha > h['fast_color_thres']
+            ray_id, step_id, slot, local, w, alpha = [x[keep] for x in (ray_id, step_id, slot, local, w, alpha)]
+
+        # weights (accumulated until the transmittance drops below 1e-3, as alpha2weight)
+        n_pts = np.bincount(ray_id, minlength=N)
+        first = np.cumsum(n_pts) - n_pts
+        log_t = np.log(np.maximum(1 - alpha.astype(np.float64), 1e-300))
+        cum = np.cumsum(log_t)
+        T_after = np.exp(cum - (cum - log_t)[first[ray_id]])
+        T = np.exp((cum - log_t) - (cum - log_t)[first[ray_id]])
+        active = T >= 1e-3
+        weights = np.where(active, T * alpha, 0).astype(np.float32)
+        alphainv_last = np.ones(N, dtype=np.float32)
+        np.minimum.at(alphainv_last, ray_id[active], T_after[active].astype(np.float32))
+        if h['fast_color_thres'] > 0:
+            keep = weights > h['fast_color_thres']
+            ray_id, step_id, slot, local, w, weights = [x[keep] for x in (ray_id, step_id, slot, local, w, weights)]
+
+        # view-dependent color
+        k0 = self.interp(self.k0_bricks, slot, local, w)
+        emb = (viewdirs[:,:,None] * self.viewfreq).reshape(N, -1)
+        emb = np.concatenate([viewdirs, np.sin(emb), np.cos(emb)], -1)
+        x = np.concatenate([k0 if h['rgbnet_direct'] else k0[:,3:], emb[ray_id]], -1)
+        for i, (W, b) in enumerate(self.layers):
+            x = x @ W.T + b
+            if i < len(self.layers) - 1:
+                x = np.maximum(x, 0)
+        if not h['rgbnet_direct']:
+            x = x + k0[:,:3]
+        rgb = 1 / (1 + np.exp(-x))
+
+        rgb_marched = np.zeros([N, 3], dtype=np.float32)
+        np.add.at(rgb_marched, ray_id, weights[:,None] * rgb)
+        rgb_marched += alphainv_last[:,None] * bg
+        depth = np.zeros(N, dtype=np.float32)
+        np.add.at(depth, ray_id, weights * step_id)
+        return rgb_marched, depth, alphainv_last
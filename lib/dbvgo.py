@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from torch_scatter import segment_coo
 
 from . import grid
-from .dvgo import Raw2Alpha, Alphas2Weights, render_utils_cuda
+from .dvgo import Raw2Alpha, Alphas2Weights, PointBatch, render_utils_cuda
 from .dmpigo import create_full_step_id
 
 
@@ -146,7 +146,7 @@ class DirectBiVoxGO(nn.Module):
             'num_voxels_base': self.num_voxels_base,
             'alpha_init': self.alpha_init,
             'voxel_size_ratio': self.voxel_size_ratio,
-            'mask_cache_world_size': list(self.mask_cache[0].mask.shape),
+            'mask_cache_world_size': list(self.mask_cache[0].world_size),
             'fast_color_thres': self.fast_color_thres,
             'density_type': self.density_type,
             'k0_type': self.k0_type,
@@ -168,11 +168,6 @@ class DirectBiVoxGO(nn.Module):
         self.k0[1].scale_volume_grid(self.world_size)
 
         if np.prod(list(self.world_size)) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
             self_alpha = [
                 F.max_pool3d(self.activate_density(self.density[0].get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0],
                 F.max_pool3d(self.activate_density(self.density[1].get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0],
@@ -188,16 +183,11 @@ class DirectBiVoxGO(nn.Module):
 
     @torch.no_grad()
     def update_occupancy_cache(self):
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache[0].mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache[0].mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache[0].mask.shape[2]),
-        ), -1)
         for i in range(2):
-            cache_grid_density = self.density[i](cache_grid_xyz)[None,None]
+            cache_grid_density = self.density[i].sample_lattice(self.mask_cache[i].world_size)
             cache_grid_alpha = self.activate_density(cache_grid_density)
             cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
-            self.mask_cache[i].mask &= (cache_grid_alpha > self.fast_color_thres)
+            self.mask_cache[i].update_and(cache_grid_alpha > self.fast_color_thres)
 
     def density_total_variation_add_grad(self, weight, dense_mode):
         w = weight * self.world_size.max() / 128
@@ -262,31 +252,21 @@ class DirectBiVoxGO(nn.Module):
             ray_pts = ray_pts.view(N,-1,3)[mask].view(-1,3)
 
         # skip known free space
-        mask = mask_grid(ray_pts)
-        ray_pts = ray_pts[mask]
-        ray_id = ray_id[mask]
-        step_id = step_id[mask]
+        pts = PointBatch(ray_pts=ray_pts, ray_id=ray_id, step_id=step_id)
+        pts.filter(mask_grid(pts['ray_pts']))
 
         # query for alpha w/ post-activation
-        density = density_grid(ray_pts)
-        alpha = self.activate_density(density, interval)
+        density = density_grid(pts['ray_pts'])
+        pts['alpha'] = self.activate_density(density, interval)
         if self.fast_color_thres > 0:
-            mask = (alpha > self.fast_color_thres)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            alpha = alpha[mask]
+            pts.filter(pts['alpha'] > self.fast_color_thres)
 
         # compute accumulated transmittance
-        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
+        pts['weights'], alphainv_last = Alphas2Weights.apply(pts['alpha'], pts['ray_id'], N)
         if self.fast_color_thres > 0:
-            mask = (weights > self.fast_color_thres)
-            weights = weights[mask]
-            alpha = alpha[mask]
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
+            pts.filter(pts['weights'] > self.fast_color_thres)
+        ray_pts, ray_id, step_id = pts['ray_pts'], pts['ray_id'], pts['step_id']
+        alpha, weights = pts['alpha'], pts['weights']
 
         # query for color
         k0 = k0_grid(ray_pts)
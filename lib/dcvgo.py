@@ -143,7 +143,7 @@ class DirectContractedVoxGO(nn.Module):
             'num_voxels_base': self.num_voxels_base,
             'alpha_init': self.alpha_init,
             'voxel_size_ratio': self.voxel_size_ratio,
-            'mask_cache_world_size': list(self.mask_cache.mask.shape),
+            'mask_cache_world_size': list(self.mask_cache.world_size),
             'fast_color_thres': self.fast_color_thres,
             'contracted_norm': self.contracted_norm,
             'density_type': self.density_type,
@@ -164,31 +164,21 @@ class DirectContractedVoxGO(nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
             self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
             self.mask_cache = grid.MaskGrid(
-                path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                path=None, mask=self.mask_cache.sample_lattice(self.xyz_min, self.xyz_max, self.world_size) & (self_alpha>self.fast_color_thres),
                 xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dcvgo: scale_volume_grid finish')
 
     @torch.no_grad()
     def update_occupancy_cache(self):
-        ori_p = self.mask_cache.mask.float().mean().item()
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        ori_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
+        cache_grid_density = self.density.sample_lattice(self.mask_cache.world_size)
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
-        self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
-        new_p = self.mask_cache.mask.float().mean().item()
+        self.mask_cache.update_and(cache_grid_alpha > self.fast_color_thres)
+        new_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
         print(f'dcvgo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
 
     def update_occupancy_cache_lt_nviews(self, rays_o_tr, rays_d_tr, imsz, render_kwargs, maskout_lt_nviews):
@@ -204,9 +194,9 @@ class DirectContractedVoxGO(nn.Module):
                         **render_kwargs)
                 ones(ray_pts).sum().backward()
             count.data += (ones.grid.grad > 1)
-        ori_p = self.mask_cache.mask.float().mean().item()
-        self.mask_cache.mask &= (count >= maskout_lt_nviews)[0,0]
-        new_p = self.mask_cache.mask.float().mean().item()
+        ori_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
+        self.mask_cache.update_and((count >= maskout_lt_nviews)[0,0])
+        new_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
         print(f'dcvgo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
         eps_time = time.time() - eps_time
         print(f'dcvgo: update mask_cache lt_nviews finish (eps time:', eps_time, 'sec)')
@@ -267,6 +257,7 @@ class DirectContractedVoxGO(nn.Module):
         @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
         '''
         assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
+        assert render_kwargs.get('shell_band', 0) <= 0, 'shell_band is only supported by DirectVoxGO'
         if isinstance(self._fast_color_thres, dict) and global_step in self._fast_color_thres:
             print(f'dcvgo: update fast_color_thres {self.fast_color_thres} => {self._fast_color_thres[global_step]}')
             self.fast_color_thres = self._fast_color_thres[global_step]
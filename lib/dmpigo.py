@@ -11,7 +11,7 @@ from einops import rearrange
 from torch_scatter import scatter_add, segment_coo
 
 from . import grid
-from .dvgo import Raw2Alpha, Alphas2Weights, render_utils_cuda
+from .dvgo import Raw2Alpha, Alphas2Weights, PointBatch, render_utils_cuda
 
 
 '''Model'''
@@ -105,12 +105,7 @@ class DirectMPIGO(torch.nn.Module):
             mask_cache = grid.MaskGrid(
                     path=mask_cache_path,
                     mask_cache_thres=mask_cache_thres).to(self.xyz_min.device)
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], mask_cache_world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], mask_cache_world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], mask_cache_world_size[2]),
-            ), -1)
-            mask = mask_cache(self_grid_xyz)
+            mask = mask_cache.sample_lattice(self.xyz_min, self.xyz_max, mask_cache_world_size)
         else:
             mask = torch.ones(list(mask_cache_world_size), dtype=torch.bool)
         self.mask_cache = grid.MaskGrid(
@@ -138,7 +133,7 @@ class DirectMPIGO(torch.nn.Module):
             'voxel_size_ratio': self.voxel_size_ratio,
             'mask_cache_path': self.mask_cache_path,
             'mask_cache_thres': self.mask_cache_thres,
-            'mask_cache_world_size': list(self.mask_cache.mask.shape),
+            'mask_cache_world_size': list(self.mask_cache.world_size),
             'fast_color_thres': self.fast_color_thres,
             'density_type': self.density_type,
             'k0_type': self.k0_type,
@@ -158,32 +153,22 @@ class DirectMPIGO(torch.nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
             dens = self.density.get_dense_grid() + self.act_shift.grid
             self_alpha = F.max_pool3d(self.activate_density(dens), kernel_size=3, padding=1, stride=1)[0,0]
             self.mask_cache = grid.MaskGrid(
-                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    path=None, mask=self.mask_cache.sample_lattice(self.xyz_min, self.xyz_max, self.world_size) & (self_alpha>self.fast_color_thres),
                     xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dmpigo: scale_volume_grid finish')
 
     @torch.no_grad()
     def update_occupancy_cache(self):
-        ori_p = self.mask_cache.mask.float().mean().item()
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        ori_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
+        cache_grid_density = self.density.sample_lattice(self.mask_cache.world_size)
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
-        self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
-        new_p = self.mask_cache.mask.float().mean().item()
+        self.mask_cache.update_and(cache_grid_alpha > self.fast_color_thres)
+        new_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
         print(f'dmpigo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
 
     def update_occupancy_cache_lt_nviews(self, rays_o_tr, rays_d_tr, imsz, render_kwargs, maskout_lt_nviews):
@@ -198,9 +183,9 @@ class DirectMPIGO(torch.nn.Module):
                         rays_o=rays_o.to(device), rays_d=rays_d.to(device), **render_kwargs)
                 ones(ray_pts).sum().backward()
             count.data += (ones.grid.grad > 1)
-        ori_p = self.mask_cache.mask.float().mean().item()
-        self.mask_cache.mask &= (count >= maskout_lt_nviews)[0,0]
-        new_p = self.mask_cache.mask.float().mean().item()
+        ori_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
+        self.mask_cache.update_and((count >= maskout_lt_nviews)[0,0])
+        new_p = self.mask_cache.count().item() / np.prod(self.mask_cache.world_size)
         print(f'dmpigo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
         torch.cuda.empty_cache()
         eps_time = time.time() - eps_time
@@ -255,6 +240,7 @@ class DirectMPIGO(torch.nn.Module):
         @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
         '''
         assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
+        assert render_kwargs.get('shell_band', 0) <= 0, 'shell_band is only supported by DirectVoxGO'
 
         ret_dict = {}
         N = len(rays_o)
@@ -265,31 +251,22 @@ class DirectMPIGO(torch.nn.Module):
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
         # skip known free space
+        pts = PointBatch(ray_pts=ray_pts, ray_id=ray_id, step_id=step_id)
         if self.mask_cache is not None:
-            mask = self.mask_cache(ray_pts)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
+            pts.filter(self.mask_cache(pts['ray_pts']))
 
         # query for alpha w/ post-activation
-        density = self.density(ray_pts) + self.act_shift(ray_pts)
-        alpha = self.activate_density(density, interval)
+        density = self.density(pts['ray_pts']) + self.act_shift(pts['ray_pts'])
+        pts['alpha'] = self.activate_density(density, interval)
         if self.fast_color_thres > 0:
-            mask = (alpha > self.fast_color_thres)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
-            alpha = alpha[mask]
+            pts.filter(pts['alpha'] > self.fast_color_thres)
 
         # compute accumulated transmittance
-        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
+        pts['weights'], alphainv_last = Alphas2Weights.apply(pts['alpha'], pts['ray_id'], N)
         if self.fast_color_thres > 0:
-            mask = (weights > self.fast_color_thres)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
-            alpha = alpha[mask]
-            weights = weights[mask]
+            pts.filter(pts['weights'] > self.fast_color_thres)
+        ray_pts, ray_id, step_id = pts['ray_pts'], pts['ray_id'], pts['step_id']
+        alpha, weights = pts['alpha'], pts['weights']
 
         # query for color
         vox_emb = self.k0(ray_pts)
@@ -8,7 +8,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import utils
 from torch_scatter import segment_coo
-from . import grid
+from . import grid, quant, sparse
 import numpy as np
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -124,15 +124,7 @@ class DirectVoxGO(torch.nn.Module):
                 dim0 += self.k0_dim
             else:
                 dim0 += self.k0_dim-3
-            self.rgbnet = nn.Sequential(
-                nn.Linear(dim0, rgbnet_width), nn.ReLU(inplace=True),
-                *[
-                    nn.Sequential(nn.Linear(rgbnet_width, rgbnet_width), nn.ReLU(inplace=True))
-                    for _ in range(rgbnet_depth-2)
-                ],
-                nn.Linear(rgbnet_width, 3),
-            )
-            nn.init.constant_(self.rgbnet[-1].bias, 0)
+            self.rgbnet = create_rgbnet(dim0, rgbnet_width, rgbnet_depth)
             print('dvgo: feature voxel grid', self.k0)
             print('dvgo: mlp', self.rgbnet)
 
@@ -146,12 +138,7 @@ class DirectVoxGO(torch.nn.Module):
             mask_cache = grid.MaskGrid(
                     path=mask_cache_path,
                     mask_cache_thres=mask_cache_thres).to(self.xyz_min.device)
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], mask_cache_world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], mask_cache_world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], mask_cache_world_size[2]),
-            ), -1)
-            mask = mask_cache(self_grid_xyz)
+            mask = mask_cache.sample_lattice(self.xyz_min, self.xyz_max, mask_cache_world_size)
         else:
             mask = torch.ones(list(mask_cache_world_size), dtype=torch.bool)
         self.mask_cache = grid.MaskGrid(
@@ -159,16 +146,21 @@ class DirectVoxGO(torch.nn.Module):
                 xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         self.importance = None
+        self.rgbnet_baked = None
+        self.sh_baked = None
+        self.alpha_cache = None
         self.used_kwargs = {'density_factor':self.density_factor}
         
         print('initialization finished')
         
     def cut_half(self):
-        ori_shape = self.mask_cache.mask.shape
+        ori_shape = self.mask_cache.world_size
         print("mask size:", ori_shape)
         print("Cut weight")
         
-        self.mask_cache.mask[:, :ori_shape[1]//2, :] = 0
+        mask = self.mask_cache.mask
+        mask[:, :ori_shape[1]//2, :] = 0
+        self.mask_cache.mask = mask
 
     def _set_grid_resolution(self, num_voxels):
         # Determine grid resolution
@@ -191,7 +183,7 @@ class DirectVoxGO(torch.nn.Module):
             'voxel_size_ratio': self.voxel_size_ratio,
             'mask_cache_path': self.mask_cache_path,
             'mask_cache_thres': self.mask_cache_thres,
-            'mask_cache_world_size': list(self.mask_cache.mask.shape),
+            'mask_cache_world_size': list(self.mask_cache.world_size),
             'fast_color_thres': self.fast_color_thres,
             'fast_color_thres_init': self.fast_color_thres_init,
             'fast_color_thres_final': self.fast_color_thres_final,
@@ -206,16 +198,22 @@ class DirectVoxGO(torch.nn.Module):
     @torch.no_grad()
     def maskout_near_cam_vox(self, cam_o, near_clip):
         # maskout grid points that between cameras and their near planes
-        self_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-        ), -1)
-        nearest_dist = torch.stack([
-            (self_grid_xyz.unsqueeze(-2) - co).pow(2).sum(-1).sqrt().amin(-1)
-            for co in cam_o.split(100)  # for memory saving
-        ]).amin(0)
-        self.density.grid[nearest_dist[None,None] <= near_clip] = -100
+        # only the grid points in the bounding box of each camera's near_clip ball are tested
+        world_size = self.density.grid.shape[2:]
+        grid_xyz = [
+            torch.linspace(self.xyz_min[i], self.xyz_max[i], world_size[i], device=cam_o.device)
+            for i in range(3)]
+        cam_o = cam_o.to(grid_xyz[0])
+        box_lo = torch.stack([torch.searchsorted(grid_xyz[i], cam_o[:,i] - near_clip) for i in range(3)], -1)
+        box_hi = torch.stack([torch.searchsorted(grid_xyz[i], cam_o[:,i] + near_clip, right=True) for i in range(3)], -1)
+        near_mask = torch.zeros(list(world_size), dtype=torch.bool, device=cam_o.device)
+        for co, lo, hi in zip(cam_o, box_lo.tolist(), box_hi.tolist()):
+            if any(l >= h for l, h in zip(lo, hi)):
+                continue
+            dx, dy, dz = [(grid_xyz[i][lo[i]:hi[i]] - co[i]).pow(2) for i in range(3)]
+            dist = (dx[:,None,None] + dy[None,:,None] + dz[None,None,:]).sqrt()
+            near_mask[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] |= (dist <= near_clip)
+        self.density.grid[near_mask[None,None].expand_as(self.density.grid)] = -100
 
     @torch.no_grad()
     def scale_volume_grid(self, num_voxels):
@@ -228,36 +226,30 @@ class DirectVoxGO(torch.nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]*self.density_factor),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]*self.density_factor),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]*self.density_factor),
-            ), -1)
             self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
+            mask = self.mask_cache.sample_lattice(self.xyz_min, self.xyz_max, self_alpha.shape)
             self.mask_cache = grid.MaskGrid(
-                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    path=None, mask=mask & (self_alpha>self.fast_color_thres),
                     xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dvgo: scale_volume_grid finish')
 
     @torch.no_grad()
     def update_occupancy_cache(self, global_step, cur_thres=1):
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        eps_time = time.time()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        cache_grid_density = self.density.sample_lattice(self.mask_cache.world_size)
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
         ## update color_thres
         if global_step == -1:
             self.fast_color_thres = self.fast_color_thres_final
-            self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
+            self.mask_cache.update_and(cache_grid_alpha > self.fast_color_thres)
            
         elif self.N_iters > 0:
             self.fast_color_thres = self.fast_color_thres_init * (self.N_iters-global_step)/self.N_iters + self.fast_color_thres_final * global_step / self.N_iters
-            self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
+            self.mask_cache.update_and(cache_grid_alpha > self.fast_color_thres)
         if global_step >= self.N_dynamic_iters and cur_thres != 1.0:
             importance = self.importance.flatten()  
             # dynamic pruning
@@ -273,10 +265,13 @@ class DirectVoxGO(torch.nn.Module):
             percent_point = (importance+(1e-6)>= vals[split_index]).sum()/importance.numel()
             print(f'{percent_point*100:.2f}% of most important points contribute over {(percent_sum)*100:.2f}% importance ')
             self.non_prune_mask = importance>split_val_nonprune ## False been prune
-            print("original number of voxels:", torch.sum(self.mask_cache.mask))
-            self.mask_cache.mask &= self.non_prune_mask.reshape(self.importance.shape[-3:])
+            print("original number of voxels:", self.mask_cache.count())
+            self.mask_cache.update_and(self.non_prune_mask.reshape(self.importance.shape[-3:]))
             print("number of importance voxels:", torch.sum(self.non_prune_mask))
-            print("changed number of voxels:", torch.sum(self.mask_cache.mask))
+            print("changed number of voxels:", self.mask_cache.count())
+        eps_time = time.time() - eps_time
+        peak_mem = torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else 0
+        print(f'dvgo: update_occupancy_cache finish (eps time: {eps_time:.3f} sec, peak memory: {peak_mem:.0f} MB)')
 
     def voxel_count_views(self, rays_o_tr, rays_d_tr, imsz, near, far, stepsize, downrate=1, irregular_shape=False):
         print('dvgo: voxel_count_views start')
@@ -331,7 +326,7 @@ class DirectVoxGO(torch.nn.Module):
         rays_o = rays_o.reshape(-1, 3).contiguous()
         rays_d = rays_d.reshape(-1, 3).contiguous()
         stepdist = stepsize * self.voxel_size
-        ray_pts, mask_outbbox, ray_id = render_utils_cuda.sample_pts_on_rays(
+        ray_pts, mask_outbbox, ray_id = sample_pts_on_rays(
                 rays_o, rays_d, self.xyz_min, self.xyz_max, near, far, stepdist)[:3]
         mask_inbbox = ~mask_outbbox
         hit = torch.zeros([len(rays_o)], dtype=torch.bool)
@@ -354,7 +349,7 @@ class DirectVoxGO(torch.nn.Module):
         rays_o = rays_o.contiguous()
         rays_d = rays_d.contiguous()
         stepdist = stepsize * self.voxel_size
-        ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max = render_utils_cuda.sample_pts_on_rays(
+        ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max = sample_pts_on_rays(
             rays_o, rays_d, self.xyz_min, self.xyz_max, near, far, stepdist)
         mask_inbbox = ~mask_outbbox
         ray_pts = ray_pts[mask_inbbox]
@@ -362,6 +357,74 @@ class DirectVoxGO(torch.nn.Module):
         step_id = step_id[mask_inbbox]
         return ray_pts, ray_id, step_id, t_min, t_max, N_steps, stepdist
 
+    @torch.no_grad()
+    def sample_ray_shell(self, rays_o, rays_d, near, far, stepsize,
+                         shell_band=2, shell_coarse_step=4, shell_thres=None, **render_kwargs):
+        '''Two-pass shell-guided sampling (inference only).
+        A coarse march with `shell_coarse_step` times the stepsize finds the first sample
+        of each ray with alpha above `shell_thres` (default: fast_color_thres). The fine
+        samples are then only placed within `shell_band` voxels around that crossing.
+        Rays missing the shell get no sample at all.
+        Output: the same as sample_ray. The step_id are counted at the fine stepsize
+                from t_min so depth rendering is consistent with sample_ray.
+        '''
+        far = 1e9  # the given far can be too small while rays stop when hitting scene bbox
+        rays_o = rays_o.contiguous()
+        rays_d = rays_d.contiguous()
+        N = len(rays_o)
+        device = rays_o.device
+        shell_thres = self.fast_color_thres if shell_thres is None else shell_thres
+
+        # coarse pass: locate the first shell crossing on each ray
+        coarse_stepsize = stepsize * shell_coarse_step
+        ray_pts, ray_id, step_id, t_min, t_max, _, coarse_stepdist = self.sample_ray(
+                rays_o=rays_o, rays_d=rays_d, near=near, far=far, stepsize=coarse_stepsize)
+        mask = self.mask_cache(ray_pts)
+        ray_pts = ray_pts[mask]
+        ray_id = ray_id[mask]
+        step_id = step_id[mask]
+        if self.density is None:
+            # alpha of the cached stepsize raised to the coarse one, as Raw2Alpha
+            alpha = 1 - (1 - self.alpha_cache(ray_pts)) ** (coarse_stepsize / self.alpha_cache.stepsize)
+        else:
+            alpha = self.activate_density(self.density(ray_pts), coarse_stepsize * self.voxel_size_ratio)
+        hit = (alpha > shell_thres)
+        n_big = torch.iinfo(torch.int64).max
+        first_step = torch.full([N], n_big, dtype=torch.int64, device=device)
+        first_step.scatter_reduce_(0, ray_id[hit], step_id[hit], reduce='amin')
+        hit_id = (first_step < n_big).nonzero().squeeze(-1)
+
+        # fine pass: uniformly sample the band around the crossing
+        stepdist = stepsize * self.voxel_size
+        band = shell_band * self.voxel_size
+        s_lo = (first_step[hit_id] * coarse_stepdist - coarse_stepdist - band).clamp(min=0)
+        n_fine = int(torch.ceil((coarse_stepdist + 2 * band) / stepdist).item()) + 1
+        step_start = (s_lo / stepdist).floor().long()
+        ray_id = hit_id.view(-1,1).expand(-1, n_fine).flatten()
+        step_id = (step_start.view(-1,1) + torch.arange(n_fine, device=device).view(1,-1)).flatten()
+        rays_start = rays_o + rays_d * t_min.unsqueeze(-1)
+        rays_dir = rays_d / rays_d.norm(dim=-1, keepdim=True)
+        ray_pts = rays_start[ray_id] + rays_dir[ray_id] * (step_id * stepdist).unsqueeze(-1)
+        N_steps = infer_n_samples(rays_d, t_min, t_max, stepdist)
+        mask_inbbox = (step_id < N_steps[ray_id]) & \
+                      ((self.xyz_min <= ray_pts) & (ray_pts <= self.xyz_max)).all(-1)
+        ray_pts = ray_pts[mask_inbbox]
+        ray_id = ray_id[mask_inbbox]
+        step_id = step_id[mask_inbbox]
+        return ray_pts, ray_id, step_id, t_min, t_max, N_steps, stepdist
+
+    def sample_points(self, rays_o, rays_d, **render_kwargs):
+        '''Sample the query points of the rays with the sampler selected by render_kwargs.
+        Output: ray_pts, ray_id, step_id, t_min and the step distance (see sample_ray).
+        '''
+        if render_kwargs.get('shell_band', 0) > 0:
+            ray_pts, ray_id, step_id, t_min, t_max, N_steps, interval_dist = self.sample_ray_shell(
+                    rays_o=rays_o, rays_d=rays_d, **render_kwargs)
+        else:
+            ray_pts, ray_id, step_id, t_min, t_max, N_steps, interval_dist = self.sample_ray(
+                    rays_o=rays_o, rays_d=rays_d, **render_kwargs)
+        return ray_pts, ray_id, step_id, t_min, interval_dist
+
     def forward(self, rays_o, rays_d, viewdirs, global_step=None, target=None, use_vq_flag=None, include_thres=None, **render_kwargs):
         '''Volume rendering
         @rays_o:   [N, 3] the starting point of the N shooting rays.
@@ -370,101 +433,128 @@ class DirectVoxGO(torch.nn.Module):
         '''
         assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
 
-        ret_dict = {}
-        N = len(rays_o)
-
         # sample points on rays
-        ray_pts, ray_id, step_id, t_min, t_max, N_steps, interval_dist = self.sample_ray(
-                rays_o=rays_o, rays_d=rays_d, **render_kwargs)
+        ray_pts, ray_id, step_id, t_min, interval_dist = self.sample_points(rays_o, rays_d, **render_kwargs)
+        return self.forward_samples(
+                ray_pts, ray_id, step_id, t_min, interval_dist, viewdirs,
+                global_step=global_step, **render_kwargs)
+
+    def forward_samples(self, ray_pts, ray_id, step_id, t_min, interval_dist, viewdirs,
+                        global_step=None, mask_hit=None, **render_kwargs):
+        '''Volume rendering of the points given by sample_points.
+        The samples can be shared by the models of the same bbox and world_size.
+        @mask_hit: the mask_cache hits of the points if already evaluated.
+        '''
+        ret_dict = {}
+        N = len(viewdirs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
         # skip known free space
-        if self.mask_cache is not None:
-            mask = self.mask_cache(ray_pts)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
+        pts = PointBatch(ray_pts=ray_pts, ray_id=ray_id, step_id=step_id)
+        if mask_hit is not None:
+            pts.filter(mask_hit)
+        elif self.mask_cache is not None:
+            pts.filter(self.mask_cache(pts['ray_pts']))
             
         debug = False
-        sampled_importance = None
+        use_alpha_cache = self.alpha_cache is not None and self.importance is None and \
+                          self.alpha_cache.stepsize == render_kwargs['stepsize']
+        assert use_alpha_cache or self.density is not None, \
+               'The density grid is freed by build_alpha_cache, only its stepsize can be rendered'
         with utils.Timing('-density sampling', debug):
             # query for alpha w/ post-activation
             if self.importance is not None:
-                density, sampled_importance = self.density(ray_pts, importance=self.importance)
-            
+                pts['density'], pts['sampled_importance'] = self.density(pts['ray_pts'], importance=self.importance)
+            elif use_alpha_cache:
+                # only the activated alpha are cached
+                pts['alpha'] = self.alpha_cache(pts['ray_pts'])
             else:
-                density = self.density(ray_pts, importance=None)
+                pts['density'] = self.density(pts['ray_pts'], importance=None)
 
         with utils.Timing('-density to alpha', debug):
-            alpha = self.activate_density(density, interval)
+            if not use_alpha_cache:
+                pts['alpha'] = self.activate_density(pts['density'], interval)
             if self.fast_color_thres > 0:
-                mask = (alpha > self.fast_color_thres)
-                ray_pts = ray_pts[mask]
-                ray_id = ray_id[mask]
-                step_id = step_id[mask]
-                density = density[mask]
-                alpha = alpha[mask]
-                if sampled_importance is not None:
-                    sampled_importance = sampled_importance[mask]
+                pts.filter(pts['alpha'] > self.fast_color_thres)
 
         # compute accumulated transmittance
         with utils.Timing('-alpha to weight', debug):   
             surf_mask = None
-            weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
+            pts['weights'], alphainv_last = Alphas2Weights.apply(pts['alpha'], pts['ray_id'], N)
             if render_kwargs.get('depth_label', False) and (
                 global_step > render_kwargs['entropy_loss_after'] and 
                 global_step <= render_kwargs['entropy_loss_before'] and 
                 global_step%render_kwargs['depth_entropy_every']==0
             ):
+                ray_id, step_id = pts['ray_id'], pts['step_id']
                 depth = segment_coo(
-                        src=(weights * (step_id * interval_dist + t_min[ray_id])),
+                        src=(pts['weights'] * (step_id * interval_dist + t_min[ray_id])),
                         index=ray_id,
                         out=torch.zeros([N]),
                         reduce='sum')
-                depth_label = create_pseudo_label_v1(ray_id, step_id, depth, t_min, interval_dist)
+                pts['depth_label'] = create_pseudo_label_v1(ray_id, step_id, depth, t_min, interval_dist)
                 
             if self.fast_color_thres > 0:
-                mask = (weights > self.fast_color_thres)
-                weights = weights[mask]
-                alpha = alpha[mask]
-                ray_pts = ray_pts[mask]
-                ray_id = ray_id[mask]
-                step_id = step_id[mask]
-                density = density[mask]
-                if sampled_importance is not None:
-                    sampled_importance = sampled_importance[mask]
+                pts.filter(pts['weights'] > self.fast_color_thres)
+            ray_pts, ray_id, step_id = pts['ray_pts'], pts['ray_id'], pts['step_id']
+            weights, alpha = pts['weights'], pts['alpha']
+            density = None if use_alpha_cache else pts['density']
                      
             if render_kwargs.get('depth_label', False) and (
                 global_step > render_kwargs['entropy_loss_after'] and 
                 global_step <= render_kwargs['entropy_loss_before'] and 
                 global_step % render_kwargs['depth_entropy_every']==0
                 ):
-                if self.fast_color_thres > 0:
-                    depth_label =  depth_label[mask]
+                depth_label = pts['depth_label']
                 if render_kwargs['weight_surface_distill'] > 0:
                     surf_mask = depth_label.bool()
                         
                 ret_dict.update({'depth_label': depth_label})
 
+        deferred = render_kwargs.get('deferred_shading', False) and self.rgbnet is not None and \
+                   not self.rgbnet_full_implicit and self.rgbnet_baked is None and self.sh_baked is None
         with utils.Timing('-feat query', debug):
-            if self.rgbnet_full_implicit:
+            if self.rgbnet_full_implicit or self.rgbnet_baked is not None or self.sh_baked is not None:
                 pass
             else:
                 k0 = self.k0(ray_pts)
             if self.rgbnet is None:
                 # no view-depend effect
                 rgb = torch.sigmoid(k0)
+            elif self.sh_baked is not None:
+                # view-dependent color emission w/ the baked SH coefficients
+                with utils.Timing('-rgb net - sh', debug):
+                    rgb = self.query_sh_rgb(ray_pts, ray_id, viewdirs)
+            elif self.rgbnet_baked is not None:
+                # view-dependent color emission w/ the baked first layer
+                with utils.Timing('-rgb net - baked', debug):
+                    rgb = self.query_baked_rgb(ray_pts, ray_id, viewdirs)
             else:
                 # view-dependent color emission
-                if self.rgbnet_direct:
-                    k0_view = k0
-                else:
-                    k0_view = k0[:, 3:]
-                    k0_diffuse = k0[:, :3]
                 with utils.Timing('-rgb net - pre', debug):
                     viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
                     viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
-                    viewdirs_emb = viewdirs_emb.flatten(0,-2)[ray_id]
+                    viewdirs_emb = viewdirs_emb.flatten(0,-2)
+                    if deferred:
+                        # deferred shading: march the features and run rgbnet once per ray
+                        weights_sum = segment_coo(
+                                src=weights,
+                                index=ray_id,
+                                out=torch.zeros([N]),
+                                reduce='sum')
+                        k0 = segment_coo(
+                                src=(weights.unsqueeze(-1) * k0),
+                                index=ray_id,
+                                out=torch.zeros([N, self.k0_dim]),
+                                reduce='sum')
+                        k0 = k0 / weights_sum.clamp_min(1e-6).unsqueeze(-1)
+                    else:
+                        viewdirs_emb = viewdirs_emb[ray_id]
+                    if self.rgbnet_direct:
+                        k0_view = k0
+                    else:
+                        k0_view = k0[:, 3:]
+                        k0_diffuse = k0[:, :3]
                     rgb_feat = torch.cat([k0_view, viewdirs_emb], -1)
                   
                 with utils.Timing('-rgb net - forward', debug):
@@ -473,6 +563,9 @@ class DirectVoxGO(torch.nn.Module):
                         rgb = torch.sigmoid(rgb_logit)
                     else:
                         rgb = torch.sigmoid(rgb_logit + k0_diffuse)
+                    if deferred:
+                        rgb_deferred = rgb
+                        rgb = rgb_deferred[ray_id]
                         
                     ## surface color
                     if surf_mask is not None:
@@ -491,11 +584,14 @@ class DirectVoxGO(torch.nn.Module):
                         
         with utils.Timing('-ray march', debug):
             # Ray marching
-            rgb_marched = segment_coo(
-                    src=(weights.unsqueeze(-1) * rgb),
-                    index=ray_id,
-                    out=torch.zeros([N, 3]),
-                    reduce='sum')  
+            if deferred:
+                rgb_marched = weights_sum.unsqueeze(-1) * rgb_deferred
+            else:
+                rgb_marched = segment_coo(
+                        src=(weights.unsqueeze(-1) * rgb),
+                        index=ray_id,
+                        out=torch.zeros([N, 3]),
+                        reduce='sum')  
 
         rgb_marched += (alphainv_last.unsqueeze(-1) * render_kwargs['bg'])
         ret_dict.update({
@@ -505,8 +601,9 @@ class DirectVoxGO(torch.nn.Module):
             'raw_alpha': alpha,
             'raw_rgb': rgb,
             'ray_id': ray_id,
-            'density':density,
         })
+        if density is not None:
+            ret_dict['density'] = density
 
         if render_kwargs.get('render_depth', False):
             with torch.no_grad():
@@ -536,38 +633,25 @@ class DirectVoxGO(torch.nn.Module):
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
         # skip known free space
+        pts = PointBatch(ray_pts=ray_pts, ray_id=ray_id, step_id=step_id)
         if self.mask_cache is not None:
-            mask = self.mask_cache(ray_pts)
-            ray_pts = ray_pts[mask]
-            ray_id = ray_id[mask]
-            step_id = step_id[mask]
+            pts.filter(self.mask_cache(pts['ray_pts']))
         debug = False
         with utils.Timing('-alpha calc', debug):
             # query for alpha w/ post-activation
            
-            density, sampled_pseudo_grid = self.density(ray_pts, importance=pseudo_grid)
+            pts['density'], pts['sampled_pseudo_grid'] = self.density(pts['ray_pts'], importance=pseudo_grid)
 
-            alpha = self.activate_density(density, interval)
+            pts['alpha'] = self.activate_density(pts['density'], interval)
             if self.fast_color_thres > 0:
-                mask = (alpha > self.fast_color_thres)
-                ray_pts = ray_pts[mask]
-                ray_id = ray_id[mask]
-                step_id = step_id[mask]
-                density = density[mask]
-                alpha = alpha[mask]
-                sampled_pseudo_grid = sampled_pseudo_grid[mask]
+                pts.filter(pts['alpha'] > self.fast_color_thres)
            
             # compute accumulated transmittance
-            weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
+            pts['weights'], alphainv_last = Alphas2Weights.apply(pts['alpha'], pts['ray_id'], N)
             if self.fast_color_thres > 0:
-                mask = (weights > self.fast_color_thres)
-                weights = weights[mask]
-                alpha = alpha[mask]
-                ray_pts = ray_pts[mask]
-                ray_id = ray_id[mask]
-                step_id = step_id[mask]
-                density = density[mask]
-                sampled_pseudo_grid = sampled_pseudo_grid[mask]
+                pts.filter(pts['weights'] > self.fast_color_thres)
+            weights, alpha, ray_id = pts['weights'], pts['alpha'], pts['ray_id']
+            density, sampled_pseudo_grid = pts['density'], pts['sampled_pseudo_grid']
 
         ret_dict.update({
             'alphainv_last': alphainv_last,
@@ -579,17 +663,28 @@ class DirectVoxGO(torch.nn.Module):
         })
         return ret_dict
 
+    @torch.no_grad()
+    def importance_cdf(self):
+        '''The sorted importance and their normalized cumulative sum.'''
+        vals, idx = torch.sort(self.importance.flatten()+(1e-6))
+        cumsum_val = torch.cumsum(vals, dim=0)
+        return vals, cumsum_val/vals.sum()
+
+    @torch.no_grad()
+    def cdf_split_val(self, thres, cdf=None):
+        '''The importance above which the voxels contribute over thres of the total importance.'''
+        vals, cdf = self.importance_cdf() if cdf is None else cdf
+        split_index = torch.searchsorted(cdf, torch.tensor([1-thres], dtype=cdf.dtype, device=cdf.device), right=True)
+        return vals[split_index.clamp(max=len(vals)-1)][0]
+
     @torch.no_grad()
     def init_cdf_mask(self, thres=1.0):
         print("start cdf three split")
         importance = self.importance.flatten()   
         if thres!=1.0:
             percent_sum = thres
-            vals,idx = sorted_importance = torch.sort(importance+(1e-6))
-            cumsum_val = torch.cumsum(vals, dim=0)
-            split_index = ((cumsum_val/vals.sum()) > (1-percent_sum)).nonzero().min()
-            split_val_nonprune = vals[split_index]
-            percent_point = (importance+(1e-6)>= vals[split_index]).sum()/importance.numel()
+            split_val_nonprune = self.cdf_split_val(thres)
+            percent_point = (importance+(1e-6)>= split_val_nonprune).sum()/importance.numel()
             print(f'{percent_point*100:.2f}% of most important points contribute over {(percent_sum)*100:.2f}% importance ')
             self.non_prune_mask = importance>split_val_nonprune 
             self.non_prune_mask &= self.mask_cache.mask.flatten()
@@ -600,9 +695,126 @@ class DirectVoxGO(torch.nn.Module):
         return self.non_prune_mask
 
     @torch.no_grad()
-    def quantize_reformat(self, thres=1.0, quantize=False, save_path=None):
-       
+    def size_estimate_state(self, occupied, bits=8, quant_mode='tensor', block_size=16):
+        '''The state of estimate_compressed_size shared by the candidate masks (subsets of occupied).
+        A random rank of the occupied voxels picks the same sample for every candidate (the lowest
+        ranked kept voxels), and the scale and offset of the channel and block modes are fit once
+        on all the occupied voxels.
+        '''
+        occupied = occupied.flatten()
+        occ_idx = occupied.nonzero().squeeze(-1)
+        state = {'occupied': occupied, 'occ_idx': occ_idx,
+                 'rank': torch.randperm(len(occ_idx), device=occ_idx.device), 'affine': None}
+        if quant_mode != 'tensor' and len(occ_idx) > 0:
+            if quant_mode == 'block':
+                group, n_groups = quant.block_ids(occupied, self.world_size.tolist(), block_size)
+            else:
+                group, n_groups = torch.zeros_like(occ_idx), 1
+            state['group'] = group
+            state['affine'] = [
+                quant.fit_affine(grid.grid.reshape(grid.grid.shape[1],-1)[:,occ_idx].T, group, n_groups, bits)
+                for grid in [self.k0, self.density]]
+        return state
+
+    @torch.no_grad()
+    def estimate_compressed_size(self, non_prune_mask, bits=8, quant_mode='tensor', block_size=16, n_sample=1<<16,
+                                 state=None):
+        '''Estimate the bytes of the extreme_saving encoding of quantize_reformat w/o encoding it.
+        The quantized grids are estimated at the empirical entropy of their stored symbols (on a
+        random subset of the kept voxels): the qint8 codes of the tensor mode, or the codes of the
+        channel and block modes, packed two per byte for <= 4 bits, plus their float16 scale and
+        offset per group. The mask is estimated at the binary entropy of the kept fraction and the
+        rgbnet at its half-precision size.
+        @state: the sample ranks and the fitted scale and offset of size_estimate_state (drawn from
+                non_prune_mask if not given), reused across the candidates of search_prune_thres.
+        '''
+        if state is None:
+            state = self.size_estimate_state(non_prune_mask, bits=bits, quant_mode=quant_mode, block_size=block_size)
+        non_prune_mask = non_prune_mask.flatten()
+        assert not (non_prune_mask & ~state['occupied']).any()
+        n_keep = non_prune_mask.sum().item()
+        n_total = non_prune_mask.numel()
+        rgbnet_bytes = sum(p.numel() * 2 for p in self.rgbnet.parameters()) if self.rgbnet is not None else 0
+        if n_keep == 0:
+            return rgbnet_bytes
+        keep = non_prune_mask[state['occupied']].nonzero().squeeze(-1)
+        sample = keep
+        if n_keep > n_sample:
+            sample = keep[state['rank'][keep].topk(n_sample, largest=False).indices]
+        code_bytes = 0
+        for i, grid in enumerate([self.k0, self.density]):
+            C = grid.grid.shape[1]
+            x = grid.grid.reshape(C,-1)[:,state['occ_idx'][sample]].T
+            if quant_mode == 'tensor':
+                codes = quant.quantize_per_tensor(x, bits).int_repr()
+                code_bytes += entropy_bits(codes) * n_keep * C / 8
+                continue
+            scale, offset = state['affine'][i]
+            codes = quant.encode(x, scale, offset, state['group'][sample], bits)
+            if bits <= 4:
+                # the entropy of the packed bytes, each holding two codes
+                packed = torch.from_numpy(quant.pack_codes(codes, bits))
+                code_bytes += entropy_bits(packed) * len(packed) / codes.numel() * n_keep * C / 8
+            else:
+                code_bytes += entropy_bits(codes) * n_keep * C / 8
+            # float16 scale and offset of the groups holding kept voxels
+            code_bytes += len(torch.unique(state['group'][keep])) * C * 2 * 2
+        p = n_keep / n_total
+        mask_bits = -(p * np.log2(p) + (1-p) * np.log2(1-p)) if 0 < p < 1 else 0
+        return code_bytes + n_total * mask_bits / 8 + rgbnet_bytes
+
+    @torch.no_grad()
+    def search_prune_thres(self, target_size=None, target_voxels=None, bits=8, quant_mode='tensor', block_size=16,
+                           n_iters=30):
+        '''Binary search the cumulative-importance threshold of init_cdf_mask for a budget.
+        @target_size:   the estimated bytes of the compressed scene (see estimate_compressed_size
+                        w/ the bits, quant_mode and block_size of quantize_reformat).
+        @target_voxels: the number of kept voxels (used if target_size is not given).
+        Output: the largest threshold within the budget (1.0 if the unpruned model fits).
+        '''
+        assert target_size is not None or target_voxels is not None
+        cdf = self.importance_cdf()
+        importance = self.importance.flatten()
+        occupied = self.mask_cache.mask.flatten()
+        # the same sample and quantization params for every candidate (a smooth cost for the bisection)
+        state = self.size_estimate_state(occupied, bits=bits, quant_mode=quant_mode, block_size=block_size) \
+                if target_size is not None else None
+        def cost(thres):
+            if thres == 1.0:
+                mask = occupied
+            else:
+                mask = (importance > self.cdf_split_val(thres, cdf)) & occupied
+            if target_size is not None:
+                return self.estimate_compressed_size(
+                        mask, bits=bits, quant_mode=quant_mode, block_size=block_size, state=state)
+            return mask.sum().item()
+        budget = target_size if target_size is not None else target_voxels
+        best, best_cost = 1.0, cost(1.0)
+        if best_cost > budget:
+            lo, hi = 0.0, 1.0
+            best, best_cost = lo, cost(lo)
+            for _ in range(n_iters):
+                mid = (lo + hi) / 2
+                mid_cost = cost(mid)
+                if mid_cost <= budget:
+                    lo, best, best_cost = mid, mid, mid_cost
+                else:
+                    hi = mid
+        unit = 'bytes (estimated)' if target_size is not None else 'voxels'
+        print(f'dvgo: search_prune_thres: thres {best:.6f} -> {best_cost:.0f} / {budget:.0f} {unit}')
+        return best
+
+    @torch.no_grad()
+    def quantize_reformat(self, thres=1.0, quantize=False, save_path=None, render_kwargs=None, bits=8,
+                          quant_mode='tensor', block_size=16, layout='raster', brick_size=8):
+        '''Prune the voxels of init_cdf_mask and quantize the kept ones (saved to save_path/extreme_saving).
+        @quant_mode: 'tensor' (qint8 w/ one scale for all the values) or the 'channel' and 'block'
+                     modes of lib/quant.py.
+        @layout:     'raster' (the mask and the values in the raster order of the grid) or 'morton'
+                     (the Morton-ordered bricks of lib/sparse.py; the block mode uses block_size bricks).
+        '''
         print("start tensor quantization")
+
         k0_grid = self.k0.grid.reshape(self.k0_dim,-1)
         k0_grid = k0_grid.T
 
@@ -615,41 +827,75 @@ class DirectVoxGO(torch.nn.Module):
         new_densiy_grid = torch.zeros_like(density_grid)# - 99999
         
         non_prune_density = density_grid[self.non_prune_mask,:]
-        if quantize:
-            non_prune_density = torch.quantize_per_tensor(non_prune_density, scale=non_prune_density.std()/15, zero_point=torch.round(non_prune_density.mean()), dtype=torch.qint8)
-            new_densiy_grid[self.non_prune_mask,:] = non_prune_density.dequantize() 
-        else:
-            new_densiy_grid[self.non_prune_mask,:] = non_prune_density 
-        # new_k0_grid[self.non_prune_mask,:] = k0_grid[self.non_prune_mask,:]
         non_prune_grid = k0_grid[self.non_prune_mask,:]
-        if quantize:
-            non_prune_grid = torch.quantize_per_tensor(non_prune_grid, scale=non_prune_grid.std()/15, zero_point=torch.round(non_prune_grid.mean()), dtype=torch.qint8)
+        if quantize and quant_mode != 'tensor':
+            quant_kwargs = dict(bits=bits, mode=quant_mode, non_prune_mask=self.non_prune_mask,
+                                world_size=self.world_size.tolist(), block_size=block_size)
+            density_codes, density_quant = quant.quantize(non_prune_density, **quant_kwargs)
+            grid_codes, grid_quant = quant.quantize(non_prune_grid, **quant_kwargs)
+            new_densiy_grid[self.non_prune_mask,:] = quant.dequantize_params(
+                    density_codes, density_quant, self.non_prune_mask, self.world_size.tolist())
+            new_k0_grid[self.non_prune_mask,:] = quant.dequantize_params(
+                    grid_codes, grid_quant, self.non_prune_mask, self.world_size.tolist())
+        elif quantize:
+            non_prune_density = quant.quantize_per_tensor(non_prune_density, bits)
+            new_densiy_grid[self.non_prune_mask,:] = non_prune_density.dequantize() 
+            non_prune_grid = quant.quantize_per_tensor(non_prune_grid, bits)
             new_k0_grid[self.non_prune_mask,:] =  non_prune_grid.dequantize() 
+            density_codes = non_prune_density.int_repr()
+            grid_codes = non_prune_grid.int_repr()
         else:
+            new_densiy_grid[self.non_prune_mask,:] = non_prune_density 
             new_k0_grid[self.non_prune_mask,:] =  non_prune_grid
+            density_codes = non_prune_density.half()
+            grid_codes = non_prune_grid.half()
             
         if save_path is not None:
             import numpy as np
             import math
             from copy import deepcopy
             os.makedirs(f'{save_path}/extreme_saving', exist_ok=True)
-            np.savez_compressed(f'{save_path}/extreme_saving/non_prune_density.npz',non_prune_density.int_repr().cpu().numpy())
-            np.savez_compressed(f'{save_path}/extreme_saving/non_prune_grid.npz',non_prune_grid.int_repr().cpu().numpy())
-            np.savez_compressed(f'{save_path}/extreme_saving/non_prune_mask.npz',np.packbits(self.non_prune_mask.reshape(-1).cpu().numpy()))
+            packed_bits = bits if quantize and quant_mode != 'tensor' else None
+            if layout == 'morton':
+                if quantize and quant_mode == 'block':
+                    brick_size = block_size
+                sparse.save_bricks(
+                        f'{save_path}/extreme_saving', self.non_prune_mask.cpu().numpy(), self.world_size.tolist(),
+                        {'density': density_codes.cpu().numpy(), 'grid': grid_codes.cpu().numpy()},
+                        bits=packed_bits, brick_size=brick_size)
+            else:
+                if packed_bits is not None:
+                    density_codes = quant.pack_codes(density_codes, bits)
+                    grid_codes = quant.pack_codes(grid_codes, bits)
+                else:
+                    density_codes = density_codes.cpu().numpy()
+                    grid_codes = grid_codes.cpu().numpy()
+                np.savez_compressed(f'{save_path}/extreme_saving/non_prune_density.npz',density_codes)
+                np.savez_compressed(f'{save_path}/extreme_saving/non_prune_grid.npz',grid_codes)
+                np.savez_compressed(f'{save_path}/extreme_saving/non_prune_mask.npz',np.packbits(self.non_prune_mask.reshape(-1).cpu().numpy()))
             np.savez_compressed(f'{save_path}/extreme_saving/rgbnet.npz',deepcopy(self.rgbnet).half().cpu().state_dict())
 
             # we also save necessary metadata 
             metadata = dict()
             metadata['global_step'] =20000
             metadata['world_size'] = self.world_size
+            metadata['bits'] = bits
+            metadata['layout'] = layout
             metadata['model_kwargs'] = self.get_kwargs()
+            if render_kwargs is not None:
+                # so that the compressed scene can be rendered w/o its dataset (see tools/render_server.py)
+                metadata['render_kwargs'] = render_kwargs
             metadata['model_state_dict'] = dict()
-            metadata['grid_dequant'] = dict()
-            metadata['grid_dequant']['zero_point'] = non_prune_grid.q_zero_point()
-            metadata['grid_dequant']['scale'] = non_prune_grid.q_scale()
-            metadata['density_dequant'] = dict()
-            metadata['density_dequant']['zero_point'] = non_prune_density.q_zero_point()
-            metadata['density_dequant']['scale'] = non_prune_density.q_scale()
+            if quantize and quant_mode != 'tensor':
+                metadata['grid_quant'] = grid_quant
+                metadata['density_quant'] = density_quant
+            elif quantize:
+                metadata['grid_dequant'] = dict()
+                metadata['grid_dequant']['zero_point'] = non_prune_grid.q_zero_point()
+                metadata['grid_dequant']['scale'] = non_prune_grid.q_scale()
+                metadata['density_dequant'] = dict()
+                metadata['density_dequant']['zero_point'] = non_prune_density.q_zero_point()
+                metadata['density_dequant']['scale'] = non_prune_density.q_scale()
             model_state_dict = self.state_dict()
             metadata['model_state_dict']['act_shift'] = model_state_dict['act_shift']
             metadata['model_state_dict']['viewfreq'] = model_state_dict['viewfreq']
@@ -671,8 +917,316 @@ class DirectVoxGO(torch.nn.Module):
        
         print("finish fully vector quantize")
 
+    @torch.no_grad()
+    def build_alpha_cache(self, stepsize, dtype=None, brick_size=4):
+        '''Precompute the activated alpha of the kept voxels for the given stepsize (inference only).
+        The forward then interpolates the cached alpha directly (i.e., post-activation interpolation)
+        instead of querying the density and calling Raw2Alpha on every sample. Only the voxels w/
+        non-zero density (the non-pruned ones for compressed models) are activated and stored, in
+        the sparse bricks of grid.AlphaGrid; the pruned voxels read alpha 0 instead of the alpha
+        of density 0. The density grid is freed, so only this stepsize can be rendered after.
+        @dtype: None (float32), torch.float16 or torch.uint8.
+        '''
+        assert isinstance(self.density, grid.DenseGrid), 'Only support DenseGrid density'
+        density = self.density.grid[0,0]
+        active = density != 0
+        alpha = self.activate_density(density[active], stepsize * self.voxel_size_ratio)
+        self.alpha_cache = grid.AlphaGrid.from_active(
+                active, alpha, self.xyz_min, self.xyz_max, stepsize, dtype=dtype, brick_size=brick_size)
+        density_bytes = density.numel() * density.element_size()
+        self.density = None
+        print(f'dvgo: build_alpha_cache: stepsize {stepsize} {self.alpha_cache.bricks.dtype}: '
+              f'{active.sum().item()} / {active.numel()} active voxels in {len(self.alpha_cache.bricks)} bricks')
+        print(f'dvgo: build_alpha_cache: density grid {density_bytes/2**20:.1f} MB (freed) -> '
+              f'alpha grid {self.alpha_cache.nbytes()/2**20:.1f} MB')
+
+    def set_rgbnet(self, rgbnet_width, rgbnet_depth):
+        '''Replace rgbnet by a new (e.g., smaller distilled) MLP of the same inputs.
+        The model kwargs are updated so that the checkpoints and compressed scenes saved after
+        are loaded w/ the new MLP.
+        '''
+        assert self.rgbnet is not None and not self.rgbnet_full_implicit, 'Only support the k0 + rgbnet models'
+        device = self.rgbnet[0].weight.device
+        self.rgbnet = create_rgbnet(self.rgbnet[0].in_features, rgbnet_width, rgbnet_depth).to(device)
+        self.rgbnet_kwargs.update(rgbnet_width=rgbnet_width, rgbnet_depth=rgbnet_depth)
+        self.rgbnet_baked = None
+        self.sh_baked = None
+        print('dvgo: mlp', self.rgbnet)
+
+    @torch.no_grad()
+    def bake_rgbnet(self, half=False):
+        '''Bake the k0 part of the first rgbnet layer into a sparse grid (inference only).
+        As the trilinear interpolation is linear, W_k0 @ interp(k0) == interp(W_k0 @ k0), so the
+        projection is precomputed on the voxels with non-zero features (the non-pruned ones for
+        compressed models). The forward then only adds the per-ray view term before the first ReLU.
+        '''
+        assert self.rgbnet is not None and not self.rgbnet_full_implicit, 'Only support the k0 + rgbnet models'
+        assert isinstance(self.k0, grid.DenseGrid), 'Only support DenseGrid k0'
+        k0_view_dim = self.k0_dim if self.rgbnet_direct else self.k0_dim-3
+        W_k0 = self.rgbnet[0].weight[:, :k0_view_dim].float()
+        k0 = self.k0.grid
+        active = (k0[0] != 0).any(0)
+        k0_active = k0[0].flatten(1).T[active.flatten()]
+        feat = k0_active[:, -k0_view_dim:] @ W_k0.T
+        if not self.rgbnet_direct:
+            feat = torch.cat([feat, k0_active[:, :3]], -1)
+        self.rgbnet_baked = grid.SparseGrid.from_active(
+                active, feat, self.xyz_min, self.xyz_max,
+                dtype=torch.float16 if half else None)
+
+        # report the trade-offs
+        width = self.rgbnet[0].out_features
+        n_active = len(self.rgbnet_baked.feat)
+        k0_bytes = k0.numel() * k0.element_size()
+        baked_bytes = self.rgbnet_baked.feat.numel() * self.rgbnet_baked.feat.element_size() + \
+                      self.rgbnet_baked.index.numel() * self.rgbnet_baked.index.element_size()
+        flops_k0 = 8*2*self.k0_dim + 2*self.rgbnet[0].in_features*width
+        flops_baked = 8*2*self.rgbnet_baked.channels + width
+        print(f'dvgo: bake_rgbnet: {n_active} / {active.numel()} ({n_active/active.numel()*100:.2f}%) active voxels')
+        print(f'dvgo: bake_rgbnet: feature memory {k0_bytes/2**20:.1f} MB (k0) -> {baked_bytes/2**20:.1f} MB (baked)')
+        print(f'dvgo: bake_rgbnet: interp + first layer FLOPs per sample {flops_k0} (k0) -> {flops_baked} (baked)')
+
+    def query_baked_rgb(self, ray_pts, ray_id, viewdirs):
+        '''Query the colors from the baked first rgbnet layer.
+        Output: the same rgb as querying k0 and the full rgbnet.
+        '''
+        k0_view_dim = self.k0_dim if self.rgbnet_direct else self.k0_dim-3
+        viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
+        viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
+        view_h = F.linear(
+                viewdirs_emb.flatten(0,-2),
+                self.rgbnet[0].weight[:, k0_view_dim:],
+                self.rgbnet[0].bias)
+        baked = self.rgbnet_baked(ray_pts)
+        width = view_h.shape[-1]
+        h = F.relu(baked[:, :width] + view_h[ray_id])
+        rgb_logit = self.rgbnet[2:](h)
+        if self.rgbnet_direct:
+            return torch.sigmoid(rgb_logit)
+        return torch.sigmoid(rgb_logit + baked[:, width:])
+
+    @torch.no_grad()
+    def bake_sh(self, degree=2, n_dirs=128, chunk=1024, half=False):
+        '''Distill the k0 + rgbnet color into per-voxel spherical harmonics (inference only).
+        The rgbnet logits of each voxel with non-zero features are evaluated on n_dirs directions
+        (a Fibonacci sphere) and fit by least squares in the SH basis of the given degree. The forward
+        then interpolates the coefficients and takes the sigmoid of their dot product w/ the basis of
+        the viewdir, w/o any MLP.
+        '''
+        assert self.rgbnet is not None and not self.rgbnet_full_implicit, 'Only support the k0 + rgbnet models'
+        assert isinstance(self.k0, grid.DenseGrid), 'Only support DenseGrid k0'
+        assert 0 <= degree <= 3, 'Only support SH degree <= 3'
+        eps_time = time.time()
+        k0_view_dim = self.k0_dim if self.rgbnet_direct else self.k0_dim-3
+        W_k0 = self.rgbnet[0].weight[:, :k0_view_dim].float()
+        k0 = self.k0.grid
+        active = (k0[0] != 0).any(0)
+        k0_active = k0[0].flatten(1).T[active.flatten()].float()
+
+        # the view part of the first layer and the SH basis of the sampled directions
+        dirs = fibonacci_dirs(n_dirs, device=k0.device)
+        viewdirs_emb = (dirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
+        viewdirs_emb = torch.cat([dirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
+        view_h = F.linear(viewdirs_emb, self.rgbnet[0].weight[:, k0_view_dim:], self.rgbnet[0].bias)
+        basis = eval_sh_bases(dirs, degree)
+        fit = torch.linalg.pinv(basis)
+
+        coeffs, sq_err = [], 0
+        for feat in k0_active.split(chunk):
+            h = F.relu((feat[:, -k0_view_dim:] @ W_k0.T).unsqueeze(1) + view_h)
+            logit = self.rgbnet[2:](h)
+            if not self.rgbnet_direct:
+                logit = logit + feat[:, None, :3]
+            c = torch.einsum('km,nmc->nck', fit, logit)
+            sq_err += (torch.sigmoid(c @ basis.T).transpose(1, 2) - torch.sigmoid(logit)).pow(2).sum().item()
+            coeffs.append(c.flatten(1))
+        self.sh_degree = degree
+        self.sh_baked = grid.SparseGrid.from_active(
+                active, torch.cat(coeffs), self.xyz_min, self.xyz_max,
+                dtype=torch.float16 if half else None)
+
+        # report the trade-offs
+        n_active = len(self.sh_baked.feat)
+        rmse = (sq_err / max(n_active * n_dirs * 3, 1)) ** 0.5
+        k0_bytes = n_active * self.k0_dim * k0.element_size()
+        rgbnet_bytes = sum(p.numel() * p.element_size() for p in self.rgbnet.parameters())
+        sh_bytes = self.sh_baked.feat.numel() * self.sh_baked.feat.element_size() + \
+                   self.sh_baked.index.numel() * self.sh_baked.index.element_size()
+        flops_mlp = 8*2*self.k0_dim + sum(2*l.in_features*l.out_features for l in self.rgbnet.modules() if isinstance(l, nn.Linear))
+        flops_sh = 8*2*self.sh_baked.channels + 2*self.sh_baked.channels
+        print(f'dvgo: bake_sh: degree {degree} on {n_active} voxels, fit rgb rmse {rmse:.5f} on {n_dirs} dirs '
+              f'(eps time: {time.time()-eps_time:.1f} sec)')
+        print(f'dvgo: bake_sh: color memory {(k0_bytes+rgbnet_bytes)/2**20:.2f} MB (active k0 + rgbnet) -> '
+              f'{sh_bytes/2**20:.2f} MB (sh)')
+        print(f'dvgo: bake_sh: interp + color FLOPs per sample {flops_mlp} (k0 + rgbnet) -> {flops_sh} (sh)')
+
+    def query_sh_rgb(self, ray_pts, ray_id, viewdirs):
+        '''Query the colors from the baked SH coefficients.'''
+        coeffs = self.sh_baked(ray_pts).reshape(len(ray_pts), 3, -1)
+        basis = eval_sh_bases(viewdirs, self.sh_degree)[ray_id]
+        return torch.sigmoid((coeffs * basis.unsqueeze(1)).sum(-1))
+
 ''' Misc
 '''
+def create_rgbnet(dim0, rgbnet_width, rgbnet_depth):
+    rgbnet = nn.Sequential(
+        nn.Linear(dim0, rgbnet_width), nn.ReLU(inplace=True),
+        *[
+            nn.Sequential(nn.Linear(rgbnet_width, rgbnet_width), nn.ReLU(inplace=True))
+            for _ in range(rgbnet_depth-2)
+        ],
+        nn.Linear(rgbnet_width, 3),
+    )
+    nn.init.constant_(rgbnet[-1].bias, 0)
+    return rgbnet
+
+def fibonacci_dirs(n, device=None):
+    '''n roughly uniform unit directions on the sphere.'''
+    i = torch.arange(n, dtype=torch.float32, device=device) + 0.5
+    z = 1 - 2 * i / n
+    phi = i * np.pi * (3 - np.sqrt(5))
+    r = (1 - z * z).sqrt()
+    return torch.stack([r * phi.cos(), r * phi.sin(), z], -1)
+
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+SH_C3 = [-0.5900435899266435, 2.890611442640554, -0.4570457994644658, 0.3731763325901154,
+         -0.4570457994644658, 1.445305721320277, -0.5900435899266435]
+
+def eval_sh_bases(dirs, degree):
+    '''The (degree+1)**2 real SH bases [N, K] of the unit directions [N, 3].'''
+    x, y, z = dirs.unbind(-1)
+    bases = [torch.full_like(x, SH_C0)]
+    if degree >= 1:
+        bases += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree >= 2:
+        xx, yy, zz = x * x, y * y, z * z
+        bases += [SH_C2[0] * x * y, SH_C2[1] * y * z, SH_C2[2] * (2 * zz - xx - yy),
+                  SH_C2[3] * x * z, SH_C2[4] * (xx - yy)]
+    if degree >= 3:
+        bases += [SH_C3[0] * y * (3 * xx - yy), SH_C3[1] * x * y * z, SH_C3[2] * y * (4 * zz - xx - yy),
+                  SH_C3[3] * z * (2 * zz - 3 * xx - 3 * yy), SH_C3[4] * x * (4 * zz - xx - yy),
+                  SH_C3[5] * z * (xx - yy), SH_C3[6] * x * (xx - 3 * yy)]
+    return torch.stack(bases, -1)
+
+def entropy_bits(symbols):
+    '''Empirical entropy (bits per symbol) of the integer symbols.'''
+    counts = torch.unique(symbols, return_counts=True)[1].double()
+    p = counts / counts.sum()
+    return -(p * p.log2()).sum().item()
+
+class PointBatch:
+    '''Struct-of-arrays of the per-sample tensors in the render hot path.
+    The columns added between the same filters share one generation, whose index vector is
+    composed once per filter (one nonzero and one index gather per live generation); a column
+    is gathered through the index of its generation at most once, when it is read after the filters.
+    Usage:
+        pts = PointBatch(ray_pts=ray_pts, ray_id=ray_id)
+        pts.filter(mask)
+        pts['alpha'] = alpha  # new column aligned with the current samples
+        ray_id, alpha = pts['ray_id'], pts['alpha']
+    '''
+    def __init__(self, **columns):
+        self._columns = {}
+        self._gen = {}          # column -> generation
+        self._gen_index = {}    # generation -> composed index (None before any filter)
+        self._n_gen = 0
+        self.n = None
+        for k, v in columns.items():
+            self[k] = v
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, k):
+        return k in self._columns
+
+    def _current_gen(self):
+        '''The generation of the columns aligned with the current samples.'''
+        g = self._n_gen - 1
+        if g not in self._gen_index or self._gen_index[g] is not None:
+            g = self._n_gen
+            self._n_gen += 1
+            self._gen_index[g] = None
+        return g
+
+    def _release(self, g):
+        if g not in self._gen.values():
+            del self._gen_index[g]
+
+    def __setitem__(self, k, v):
+        if self.n is None:
+            self.n = len(v)
+        assert len(v) == self.n, f'column {k} has {len(v)} samples, expect {self.n}'
+        old = self._gen.get(k)
+        self._columns[k] = v
+        self._gen[k] = self._current_gen()
+        if old is not None:
+            self._release(old)
+
+    def __getitem__(self, k):
+        g = self._gen[k]
+        if self._gen_index[g] is not None:
+            self._columns[k] = self._columns[k][self._gen_index[g]]
+            self._gen[k] = self._current_gen()
+            self._release(g)
+        return self._columns[k]
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def filter(self, mask):
+        '''Keep the samples where the boolean mask is true.'''
+        keep = mask.nonzero().squeeze(-1)
+        for g, index in self._gen_index.items():
+            self._gen_index[g] = keep if index is None else index[keep]
+        self.n = len(keep)
+        return keep
+
+''' Torch fallbacks of the render_utils_cuda ops for cpu tensors (inference)
+'''
+def infer_n_samples(rays_d, t_min, t_max, stepdist):
+    if rays_d.is_cuda:
+        return render_utils_cuda.infer_n_samples(rays_d, t_min, t_max, stepdist)
+    # at least 1 point for easier implementation in the later sample_pts_on_rays
+    rnorm = rays_d.norm(dim=-1)
+    return ((t_max - t_min) * rnorm / stepdist).ceil().clamp(min=1).long()
+
+def sample_pts_on_rays(rays_o, rays_d, xyz_min, xyz_max, near, far, stepdist):
+    if rays_o.is_cuda:
+        return render_utils_cuda.sample_pts_on_rays(rays_o, rays_d, xyz_min, xyz_max, near, far, stepdist)
+    vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
+    rate_a = (xyz_max - rays_o) / vec
+    rate_b = (xyz_min - rays_o) / vec
+    t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(max=far).clamp(min=near)
+    t_max = torch.maximum(rate_a, rate_b).amin(-1).clamp(max=far).clamp(min=near)
+    N_steps = infer_n_samples(rays_d, t_min, t_max, stepdist)
+    ray_id = torch.repeat_interleave(torch.arange(len(rays_o), device=rays_o.device), N_steps)
+    step_id = torch.arange(len(ray_id), device=rays_o.device) - (N_steps.cumsum(0) - N_steps)[ray_id]
+    rays_start = rays_o + rays_d * t_min.unsqueeze(-1)
+    rays_dir = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    ray_pts = rays_start[ray_id] + rays_dir[ray_id] * (stepdist * step_id).unsqueeze(-1)
+    mask_outbbox = ((xyz_min > ray_pts) | (xyz_max < ray_pts)).any(-1)
+    return ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max
+
+def alpha2weight_torch(alpha, ray_id, N):
+    '''Same as render_utils_cuda.alpha2weight: the points of a ray are accumulated from near
+    to far until the transmittance drops below 1e-3. The points are sorted by ray_id.
+    '''
+    n_pts = torch.bincount(ray_id, minlength=N)
+    step_id = torch.arange(len(ray_id), device=alpha.device) - (n_pts.cumsum(0) - n_pts)[ray_id]
+    padded = torch.ones([N, int(n_pts.max()) if len(ray_id) else 0], device=alpha.device)
+    padded[ray_id, step_id] = 1 - alpha
+    T_cum = padded.cumprod(1)
+    T_after = T_cum[ray_id, step_id]
+    T = torch.where(step_id == 0, torch.ones_like(alpha), T_cum[ray_id, (step_id-1).clamp(min=0)])
+    active = T >= 1e-3
+    weights = torch.where(active, T * alpha, torch.zeros_like(alpha))
+    alphainv_last = torch.ones([N], device=alpha.device)
+    alphainv_last.scatter_reduce_(0, ray_id[active], T_after[active], reduce='amin')
+    return weights, alphainv_last
+
 class Raw2Alpha(torch.autograd.Function):
     @staticmethod
     def forward(ctx, density, shift, interval):
@@ -682,7 +1236,11 @@ class Raw2Alpha(torch.autograd.Function):
               = 1 - exp(log(1 + exp(density + shift)) ^ (-interval))
               = 1 - (1 + exp(density + shift)) ^ (-interval)
         '''
-        exp, alpha = render_utils_cuda.raw2alpha(density, shift, interval)
+        if density.is_cuda:
+            exp, alpha = render_utils_cuda.raw2alpha(density, shift, interval)
+        else:
+            exp = torch.exp(density + shift)
+            alpha = 1 - (1 + exp).pow(-interval)
         if density.requires_grad:
             ctx.save_for_backward(exp)
             ctx.interval = interval
@@ -697,6 +1255,8 @@ class Raw2Alpha(torch.autograd.Function):
         '''
         exp = ctx.saved_tensors[0]
         interval = ctx.interval
+        if not exp.is_cuda:
+            return interval * (1 + exp).pow(-interval-1) * exp * grad_back, None, None
         return render_utils_cuda.raw2alpha_backward(exp, grad_back.contiguous(), interval), None, None
 
 class Raw2Alpha_nonuni(torch.autograd.Function):
@@ -718,6 +1278,10 @@ class Raw2Alpha_nonuni(torch.autograd.Function):
 class Alphas2Weights(torch.autograd.Function):
     @staticmethod
     def forward(ctx, alpha, ray_id, N):
+        if not alpha.is_cuda:
+            if alpha.requires_grad:
+                raise NotImplementedError('Alphas2Weights: the cpu fallback is for inference only')
+            return alpha2weight_torch(alpha, ray_id, N)
         weights, T, alphainv_last, i_start, i_end = render_utils_cuda.alpha2weight(alpha, ray_id, N)
         if alpha.requires_grad:
             ctx.save_for_backward(alpha, weights, T, alphainv_last, i_start, i_end)
@@ -736,10 +1300,20 @@ class Alphas2Weights(torch.autograd.Function):
 
 ''' Ray and batch
 '''
-def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
+def get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, mode='center', device=None):
+    '''Camera-space ray directions of all pixels, [H,W,3].
+    Views sharing the same H, W, K and flags share the same directions, so they are
+    cached (except for the random mode); do not modify the returned tensor inplace.
+    '''
+    if mode == 'random':
+        return _get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, mode, device)
+    K = tuple(tuple(float(v) for v in row) for row in np.asarray(K)[:3,:3])
+    return _get_cam_dirs_cached(int(H), int(W), K, inverse_y, flip_x, flip_y, mode, device)
+
+def _get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, mode, device):
     i, j = torch.meshgrid(
-        torch.linspace(0, W-1, W, device=c2w.device),
-        torch.linspace(0, H-1, H, device=c2w.device))  # pytorch's meshgrid has indexing='ij'
+        torch.linspace(0, W-1, W, device=device),
+        torch.linspace(0, H-1, H, device=device))  # pytorch's meshgrid has indexing='ij'
     i = i.t().float()
     j = j.t().float()
     if mode == 'lefttop':
@@ -760,6 +1334,13 @@ def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
         dirs = torch.stack([(i-K[0][2])/K[0][0], (j-K[1][2])/K[1][1], torch.ones_like(i)], -1)
     else:
         dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
+    return dirs
+
+_get_cam_dirs_cached = functools.lru_cache(maxsize=4)(_get_cam_dirs)
+
+
+def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
+    dirs = get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, mode=mode, device=c2w.device)
     # Rotate ray directions from camera frame to the world frame
     rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
     # Translate camera frame's origin to the world frame. It is the origin of all rays.
@@ -767,6 +1348,66 @@ def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
     return rays_o, rays_d
 
 
+def get_rays_of_views(H, W, K, c2ws, ndc, inverse_y, flip_x, flip_y, mode='center'):
+    '''Batched get_rays_of_a_view for views sharing the same H, W and K.
+    The camera-space directions are computed once and rotated by all poses in one matmul.
+    Output: rays_o, rays_d, viewdirs of shape [N,H,W,3]
+    '''
+    c2ws = torch.as_tensor(c2ws, dtype=torch.float32)
+    dirs = get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, mode=mode, device=c2ws.device)
+    rays_d = torch.matmul(dirs.view(1,-1,3), c2ws[:,:3,:3].transpose(1,2)).view(len(c2ws), H, W, 3)
+    rays_o = c2ws[:,None,None,:3,3].expand(rays_d.shape)
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
+def get_corner_rays_of_views(HW, Ks, c2ws, ndc, inverse_y, flip_x, flip_y):
+    '''Rays of the four corner pixels (lefttop, righttop, leftbottom, rightbottom) of each view.
+    Output: rays_o, rays_d, viewdirs of shape [N,4,3]
+    '''
+    c2ws = torch.as_tensor(c2ws, dtype=torch.float32)
+    dirs = torch.stack([
+        get_cam_dirs(H, W, K, inverse_y, flip_x, flip_y, device=c2ws.device)[[0,0,-1,-1],[0,-1,0,-1]]
+        for (H, W), K in zip(HW, Ks)])
+    rays_d = torch.matmul(dirs, c2ws[:,:3,:3].transpose(1,2))
+    rays_o = c2ws[:,None,:3,3].expand(rays_d.shape)
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        rays_o, rays_d = torch.stack([
+            torch.stack(ndc_rays(H, W, K[0][0], 1., ro, rd))
+            for (H, W), K, ro, rd in zip(HW, Ks, rays_o, rays_d)]).unbind(1)
+    return rays_o, rays_d, viewdirs
+
+
+def get_frustum_extreme_dirs(viewdirs):
+    '''Unit directions that attain the per-axis extremes of the rays of a pixel rectangle.
+    The normalized rays of a view span a spherical quadrilateral whose per-axis extremes are
+    at its corners, at the axis directions falling inside it, or on its great-circle edges.
+    Input: viewdirs of the four corner pixels [N,4,3] as given by get_corner_rays_of_views.
+    Output: the candidate directions [N,34,3] and their validity mask [N,34].
+    '''
+    axes = torch.cat([torch.eye(3), -torch.eye(3)]).to(viewdirs)[None,None]  # [1,1,6,3]
+    a = viewdirs[:,[0,1,3,2]]  # in cyclic order
+    b = a.roll(-1, 1)
+    cross_ab = torch.cross(a, b, dim=-1)
+    inward = cross_ab * torch.sign((cross_ab * a.sum(1, keepdim=True)).sum(-1, keepdim=True))
+    # axis directions inside the frustum
+    inside = ((inward[:,:,None] * axes).sum(-1) >= 0).all(1)
+    # extremes on the edges: the axis projected onto the plane of each edge
+    n_hat = F.normalize(cross_ab, dim=-1)[:,:,None]
+    proj = axes - (axes * n_hat).sum(-1, keepdim=True) * n_hat
+    valid_proj = proj.norm(dim=-1) > 1e-6
+    proj = F.normalize(proj, dim=-1)
+    on_edge = valid_proj & \
+        ((torch.cross(a[:,:,None].expand_as(proj), proj, dim=-1) * cross_ab[:,:,None]).sum(-1) >= 0) & \
+        ((torch.cross(proj, b[:,:,None].expand_as(proj), dim=-1) * cross_ab[:,:,None]).sum(-1) >= 0)
+    dirs = torch.cat([viewdirs, axes[0].expand(len(viewdirs),6,3), proj.flatten(1,2)], 1)
+    valid = torch.cat([torch.ones_like(viewdirs[...,0], dtype=torch.bool), inside, on_edge.flatten(1)], 1)
+    return dirs, valid
+
+
 def get_rays_np(H, W, K, c2w):
     i, j = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32), indexing='xy')
     dirs = np.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -np.ones_like(i)], -1)
@@ -818,12 +1459,13 @@ def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_
     rays_d_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     viewdirs_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     imsz = [1] * len(rgb_tr)
-    for i, c2w in enumerate(train_poses):
-        rays_o, rays_d, viewdirs = get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w, ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
-        rays_o_tr[i].copy_(rays_o.to(rgb_tr.device))
-        rays_d_tr[i].copy_(rays_d.to(rgb_tr.device))
-        viewdirs_tr[i].copy_(viewdirs.to(rgb_tr.device))
+    CHUNK = 16
+    for i in range(0, len(train_poses), CHUNK):
+        rays_o, rays_d, viewdirs = get_rays_of_views(
+                H=H, W=W, K=K, c2ws=train_poses[i:i+CHUNK], ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        rays_o_tr[i:i+CHUNK].copy_(rays_o.to(rgb_tr.device))
+        rays_d_tr[i:i+CHUNK].copy_(rays_d.to(rgb_tr.device))
+        viewdirs_tr[i:i+CHUNK].copy_(viewdirs.to(rgb_tr.device))
         del rays_o, rays_d, viewdirs
     eps_time = time.time() - eps_time
     print('get_training_rays: finish (eps time:', eps_time, 'sec)')
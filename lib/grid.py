@@ -35,88 +35,6 @@ def create_grid(type, **kwargs):
     else:
         raise NotImplementedError
 
-from functools import lru_cache
-
-@lru_cache(100)
-def get_scaling_factor(width, height, num_d, device):
-    return torch.FloatTensor([width-1.0, height-1.0, num_d-1.0]).to(device).view(1, 1, 1, 3)
-
-class TrilinearIntepolation(nn.Module):
-    """TrilinearIntepolation in PyTorch."""
-
-    def __init__(self):
-        super(TrilinearIntepolation, self).__init__()
-
-    def sample_at_integer_locs(self, input_feats, index_tensor):
-        assert input_feats.ndimension()==5, 'input_feats should be of shape [B,F,D,H,W]'
-        assert index_tensor.ndimension()==4, 'index_tensor should be of shape [B,H,W,3]'
-        # first sample pixel locations using nearest neighbour interpolation
-        batch_size, num_chans, num_d, height, width = input_feats.shape
-        grid_height, grid_width = index_tensor.shape[1],index_tensor.shape[2]
-        xy_grid = index_tensor[..., 0:2]
-        xy_grid[..., 0] = xy_grid[..., 0] - ((width-1.0)/2.0)
-        xy_grid[..., 0] = xy_grid[..., 0] / ((width-1.0)/2.0)
-        xy_grid[..., 1] = xy_grid[..., 1] - ((height-1.0)/2.0)
-        xy_grid[..., 1] = xy_grid[..., 1] / ((height-1.0)/2.0)
-
-        xy_grid = torch.clamp(xy_grid, min=-1.0, max=1.0)
-        sampled_in_2d = F.grid_sample(input=input_feats.view(batch_size, num_chans*num_d, height, width),
-                                        grid=xy_grid, mode='nearest').view(batch_size, num_chans, num_d, grid_height, grid_width)
-        z_grid = index_tensor[..., 2].view(batch_size, 1, 1, grid_height, grid_width)
-        z_grid = z_grid.long().clamp(min=0, max=num_d-1)
-        z_grid = z_grid.expand(batch_size,num_chans, 1, grid_height, grid_width)
-        sampled_in_3d = sampled_in_2d.gather(2, z_grid).squeeze(2)
-        return sampled_in_3d
-    
-    def forward(self, input_feats, sampling_grid, vq):
-        assert input_feats.ndimension()==5, 'input_feats should be of shape [B,F,D,H,W]'
-        assert sampling_grid.ndimension()==4, 'sampling_grid should be of shape [B,H,W,3]'
-        batch_size, num_chans, num_d, height, width = input_feats.shape
-        grid_height, grid_width = sampling_grid.shape[1],sampling_grid.shape[2]
-        # make sure sampling grid lies between -1, 1
-        sampling_grid = torch.clamp(sampling_grid, min=-1.0, max=1.0)
-        # map to 0,1
-        sampling_grid = (sampling_grid+1)/2.0
-        # Scale grid to floating point pixel locations
-        # import ipdb;ipdb.set_trace()
-        scaling_factor = get_scaling_factor(width, height, num_d, input_feats.device)
-        sampling_grid = scaling_factor*sampling_grid
-        # Now sampling grid is between [0, w-1; 0,h-1; 0,d-1]
-        x, y, z = torch.split(sampling_grid, split_size_or_sections=1, dim=3)
-        x_0, y_0, z_0 = torch.split(sampling_grid.floor(), split_size_or_sections=1, dim=3)
-        x_1, y_1, z_1 = x_0+1.0, y_0+1.0, z_0+1.0
-        u, v, w = x-x_0, y-y_0, z-z_0
-        u, v, w = map(lambda x:x.view(batch_size, 1, grid_height, grid_width).expand(
-                                    batch_size, num_chans, grid_height, grid_width),  [u, v, w])
-        c_000 = self.sample_at_integer_locs(input_feats, torch.cat([x_0, y_0, z_0], dim=3))
-        c_001 = self.sample_at_integer_locs(input_feats, torch.cat([x_0, y_0, z_1], dim=3))
-        c_010 = self.sample_at_integer_locs(input_feats, torch.cat([x_0, y_1, z_0], dim=3))
-        c_011 = self.sample_at_integer_locs(input_feats, torch.cat([x_0, y_1, z_1], dim=3))
-        c_100 = self.sample_at_integer_locs(input_feats, torch.cat([x_1, y_0, z_0], dim=3))
-        c_101 = self.sample_at_integer_locs(input_feats, torch.cat([x_1, y_0, z_1], dim=3))
-        c_110 = self.sample_at_integer_locs(input_feats, torch.cat([x_1, y_1, z_0], dim=3))
-        c_111 = self.sample_at_integer_locs(input_feats, torch.cat([x_1, y_1, z_1], dim=3))
-        # import ipdb;ipdb.set_trace()
-        c_000 = vq(c_000.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_001 = vq(c_001.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_010 = vq(c_010.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_011 = vq(c_011.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_100 = vq(c_100.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_101 = vq(c_101.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_110 = vq(c_110.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-        c_111 = vq(c_111.squeeze(2).permute(0,2,1))[0].permute(0,2,1).unsqueeze(2)
-
-        c_xyz = (1.0-u)*(1.0-v)*(1.0-w)*c_000 + \
-                (1.0-u)*(1.0-v)*(w)*c_001 + \
-                (1.0-u)*(v)*(1.0-w)*c_010 + \
-                (1.0-u)*(v)*(w)*c_011 + \
-                (u)*(1.0-v)*(1.0-w)*c_100 + \
-                (u)*(1.0-v)*(w)*c_101 + \
-                (u)*(v)*(1.0-w)*c_110 + \
-                (u)*(v)*(w)*c_111
-        return c_xyz
-
-
 ''' Dense 3D grid
 '''
 class DenseGrid(nn.Module):
@@ -127,19 +45,15 @@ class DenseGrid(nn.Module):
         self.register_buffer('xyz_min', torch.Tensor(xyz_min))
         self.register_buffer('xyz_max', torch.Tensor(xyz_max))
         self.grid = nn.Parameter(torch.zeros([1, channels, *world_size]))
-        self.trilinear_interpolation = TrilinearIntepolation().cuda()
 
-    def forward(self, xyz, importance=None, vq=None):
+    def forward(self, xyz, importance=None):
         '''
         xyz: global coordinates to query
         '''
         shape = xyz.shape[:-1]
         xyz = xyz.reshape(1,1,1,-1,3)
         ind_norm = ((xyz - self.xyz_min) / (self.xyz_max - self.xyz_min)).flip((-1,)) * 2 - 1
-        if vq is None:
-            out = F.grid_sample(self.grid, ind_norm, mode='bilinear', align_corners=False)
-        else:
-            out = self.trilinear_interpolation(self.grid, ind_norm.squeeze(0), vq)
+        out = F.grid_sample(self.grid, ind_norm, mode='bilinear', align_corners=False)
 
         if importance is not None:
             sampled_importance = F.grid_sample(importance, ind_norm, mode='bilinear', align_corners=False)
@@ -155,6 +69,21 @@ class DenseGrid(nn.Module):
         else:
             return out
 
+    def sample_lattice(self, lattice_size, chunk=16):
+        '''Query the lattice of linspace(xyz_min, xyz_max, lattice_size) points.
+        Same as querying the meshgrid of the lattice, but the trilinear interpolation is
+        done by separable 1D interpolations in index space, chunked along the x axis.
+        Output: [1, channels, *lattice_size] as get_dense_grid
+        '''
+        X, Y, Z = [int(n) for n in lattice_size]
+        out = []
+        for idx in torch.arange(X, device=self.grid.device).split(chunk):
+            t = lattice_lerp(self.grid, 2, X, idx)
+            t = lattice_lerp(t, 3, Y)
+            t = lattice_lerp(t, 4, Z)
+            out.append(t)
+        return torch.cat(out, 2)
+
     def scale_volume_grid(self, new_world_size):
         if self.channels == 0:
             self.grid = nn.Parameter(torch.zeros([1, self.channels, *new_world_size]))
@@ -179,6 +108,193 @@ class DenseGrid(nn.Module):
         return f'channels={self.channels}, world_size={self.world_size.tolist()}'
 
 
+''' Sparse 3D grid
+Only keeps the features of the active voxels of a dense grid in a [M, channels] table
+and an index volume pointing into it (-1 for the empty voxels, which read as zeros).
+The query is equivalent to DenseGrid, i.e., grid_sample w/ align_corners=False and zero padding.
+'''
+class SparseGrid(nn.Module):
+    def __init__(self, channels, world_size, xyz_min, xyz_max, index, feat):
+        super(SparseGrid, self).__init__()
+        self.channels = channels
+        self.world_size = world_size
+        self.register_buffer('xyz_min', torch.Tensor(xyz_min))
+        self.register_buffer('xyz_max', torch.Tensor(xyz_max))
+        self.register_buffer('index', index.int())
+        self.register_buffer('feat', feat)
+
+    @classmethod
+    def from_dense(cls, grid, xyz_min, xyz_max, active=None, dtype=None):
+        '''Build from a dense grid of shape [1, channels, X, Y, Z].
+        @active: [X, Y, Z] voxels to keep (default: the voxels with any non-zero channel).
+        '''
+        feat = grid[0].flatten(1).T
+        if active is None:
+            active = (feat != 0).any(-1)
+        return cls.from_active(active.reshape(grid.shape[2:]), feat[active.flatten()], xyz_min, xyz_max, dtype=dtype)
+
+    @classmethod
+    def from_active(cls, active, feat, xyz_min, xyz_max, dtype=None):
+        '''Build from the [X, Y, Z] active mask and the [M, channels] features of the active voxels
+        (in the flattened order).
+        '''
+        world_size = torch.LongTensor(list(active.shape))
+        active = active.flatten()
+        index = torch.full([len(active)], -1, dtype=torch.int32, device=feat.device)
+        index[active] = torch.arange(len(feat), dtype=torch.int32, device=feat.device)
+        feat = feat.contiguous()
+        if dtype is not None:
+            feat = feat.to(dtype)
+        return cls(feat.shape[1], world_size, xyz_min, xyz_max, index.reshape(*world_size.tolist()), feat)
+
+    def forward(self, xyz):
+        '''
+        xyz: global coordinates to query
+        '''
+        shape = xyz.shape[:-1]
+        xyz = xyz.reshape(-1,3)
+        corner_idx, corner_w = trilinear_corners(xyz, self.xyz_min, self.xyz_max, self.world_size)
+        corner_vid = self.index.flatten()[corner_idx].long()
+        corner_w = corner_w * (corner_vid >= 0)
+        corner_vid = corner_vid.clamp_min(0)
+        out = torch.zeros([len(xyz), self.channels], device=xyz.device)
+        for i in range(8):
+            out.addcmul_(corner_w[:,[i]], self.feat[corner_vid[:,i]].float())
+        out = out.reshape(*shape,self.channels)
+        if self.channels == 1:
+            out = out.squeeze(-1)
+        return out
+
+    def get_dense_grid(self):
+        grid = torch.zeros([self.index.numel(), self.channels], device=self.feat.device)
+        active = self.index.flatten() >= 0
+        grid[active] = self.feat[self.index.flatten()[active].long()].float()
+        return grid.T.reshape(1, self.channels, *self.index.shape)
+
+    def extra_repr(self):
+        return f'channels={self.channels}, world_size={self.world_size.tolist()}, n_active={len(self.feat)}, dtype={self.feat.dtype}'
+
+
+''' Activated alpha grid
+Cache the activated alpha of the active voxels of a density grid for a fixed sampling interval
+(inference only). Only the bricks (brick_size^3 voxels) holding active voxels are stored, w/ a
+brick index volume pointing into them (-1 for the empty bricks); the inactive voxels read as
+zeros. The uint8 alpha are stored as round(sqrt(alpha)*255) to keep the precision of the small
+alpha around fast_color_thres, and decoded by a lookup table before the interpolation.
+'''
+class AlphaGrid(nn.Module):
+    def __init__(self, brick_index, bricks, world_size, xyz_min, xyz_max, stepsize, lut=None):
+        super(AlphaGrid, self).__init__()
+        self.stepsize = stepsize
+        self.world_size = torch.LongTensor(list(world_size))
+        self.brick_size = round(bricks.shape[1] ** (1/3))
+        self.register_buffer('xyz_min', torch.Tensor(xyz_min))
+        self.register_buffer('xyz_max', torch.Tensor(xyz_max))
+        self.register_buffer('brick_index', brick_index)
+        self.register_buffer('bricks', bricks)
+        if lut is not None:
+            self.register_buffer('lut', lut)
+        else:
+            self.lut = None
+
+    @classmethod
+    def from_active(cls, active, alpha, xyz_min, xyz_max, stepsize, dtype=None, brick_size=4):
+        '''Build from the [X, Y, Z] active mask and the alpha [M] of the active voxels (in the
+        flattened order); the voxels whose alpha is zero in the given dtype are not stored.
+        '''
+        lut = None
+        if dtype == torch.uint8:
+            alpha = (alpha.clamp(0, 1).sqrt() * 255).round().to(torch.uint8)
+            lut = (torch.arange(256, device=alpha.device) / 255) ** 2
+        elif dtype is not None:
+            alpha = alpha.to(dtype)
+        ijk = active.nonzero()[alpha != 0]
+        alpha = alpha[alpha != 0]
+        b = brick_size
+        n_bricks = [(s + b - 1) // b for s in active.shape]
+        bijk = ijk // b
+        bid = (bijk[:,0] * n_bricks[1] + bijk[:,1]) * n_bricks[2] + bijk[:,2]
+        uniq, brick = torch.unique(bid, return_inverse=True)
+        brick_index = torch.full([n_bricks[0] * n_bricks[1] * n_bricks[2]], -1, dtype=torch.int32, device=alpha.device)
+        brick_index[uniq] = torch.arange(len(uniq), dtype=torch.int32, device=alpha.device)
+        local = ijk % b
+        local = (local[:,0] * b + local[:,1]) * b + local[:,2]
+        bricks = torch.zeros([max(len(uniq), 1), b**3], dtype=alpha.dtype, device=alpha.device)
+        bricks[brick, local] = alpha
+        return cls(brick_index.reshape(n_bricks), bricks, active.shape, xyz_min, xyz_max, stepsize, lut=lut)
+
+    def forward(self, xyz):
+        '''
+        xyz: global coordinates to query
+        '''
+        shape = xyz.shape[:-1]
+        xyz = xyz.reshape(-1,3)
+        corner_idx, corner_w = trilinear_corners(xyz, self.xyz_min, self.xyz_max, self.world_size)
+        X, Y, Z = self.world_size.tolist()
+        _, bY, bZ = self.brick_index.shape
+        b = self.brick_size
+        i, j, k = corner_idx // (Y*Z), corner_idx // Z % Y, corner_idx % Z
+        brick = self.brick_index.flatten()[((i // b) * bY + j // b) * bZ + k // b].long()
+        local = ((i % b) * b + j % b) * b + k % b
+        corner_alpha = self.bricks[brick.clamp_min(0), local]
+        if self.lut is not None:
+            corner_alpha = self.lut[corner_alpha.long()]
+        out = (corner_w * (brick >= 0) * corner_alpha.float()).sum(-1)
+        return out.reshape(shape)
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in [self.brick_index, self.bricks])
+
+    def extra_repr(self):
+        return (f'world_size={self.world_size.tolist()}, stepsize={self.stepsize}, dtype={self.bricks.dtype}, '
+                f'n_bricks={len(self.bricks)}, brick_size={self.brick_size}')
+
+def lattice_lerp(t, dim, n_out, idx=None):
+    '''1D linear interpolation of t along dim at the n_out points of linspace(0, 1, n_out)
+    (or the subset idx of them), matching F.grid_sample w/ align_corners=False and zero padding.
+    '''
+    size = t.shape[dim]
+    u = torch.linspace(0, 1, n_out, device=t.device) * size - 0.5
+    if idx is not None:
+        u = u[idx]
+    u0 = u.floor()
+    frac = u - u0
+    u0 = u0.long()
+    w0 = (1 - frac) * (u0 >= 0)
+    w1 = frac * (u0 + 1 < size)
+    shape = [1] * t.dim()
+    shape[dim] = -1
+    return t.index_select(dim, u0.clamp(0, size-1)) * w0.view(shape) + \
+           t.index_select(dim, (u0+1).clamp(max=size-1)) * w1.view(shape)
+
+def trilinear_corners(xyz, xyz_min, xyz_max, world_size, align_corners=False):
+    '''The 8 corners of the trilinear interpolation of a [X, Y, Z] grid.
+    Match F.grid_sample w/ align_corners=False and zero padding as used by DenseGrid
+    (or the align_corners=True grid points if align_corners).
+    Input:
+        xyz:        [N, 3] the xyz in global coordinate
+        world_size: [3] the grid resolution
+    Output:
+        corner_idx: [N, 8] the linear index of the corners into the flattened grid
+        corner_w:   [N, 8] the interpolation weights (zero for the corners outside the grid)
+    '''
+    world_size = torch.as_tensor(world_size, device=xyz.device).long()
+    if align_corners:
+        ijk = (xyz - xyz_min) / (xyz_max - xyz_min) * (world_size - 1)
+    else:
+        ijk = (xyz - xyz_min) / (xyz_max - xyz_min) * world_size - 0.5
+    ijk0 = ijk.floor()
+    frac = (ijk - ijk0).unsqueeze(1)
+    offset = torch.LongTensor([[i,j,k] for i in range(2) for j in range(2) for k in range(2)]).to(xyz.device)
+    corner = ijk0.long().unsqueeze(1) + offset
+    corner_w = torch.where(offset.bool(), frac, 1-frac).prod(-1)
+    inside = ((corner >= 0) & (corner < world_size)).all(-1)
+    corner_w = corner_w * inside
+    corner = torch.minimum(corner.clamp_min(0), world_size-1)
+    corner_idx = (corner[...,0] * world_size[1] + corner[...,1]) * world_size[2] + corner[...,2]
+    return corner_idx, corner_w
+
+
 ''' Vector-Matrix decomposited grid
 See TensoRF: Tensorial Radiance Fields (https://arxiv.org/abs/2203.09517)
 '''
@@ -223,6 +339,20 @@ class TensoRFGrid(nn.Module):
             out = out.reshape(*shape)
         return out
 
+    def sample_lattice(self, lattice_size, chunk=16):
+        '''Query the lattice of linspace(xyz_min, xyz_max, lattice_size) points.
+        Output: [1, channels, *lattice_size] as get_dense_grid
+        '''
+        lattice_xyz = [
+            torch.linspace(self.xyz_min[i], self.xyz_max[i], int(lattice_size[i]))
+            for i in range(3)]
+        out = torch.cat([
+            self(torch.stack(torch.meshgrid(x, *lattice_xyz[1:]), -1))
+            for x in lattice_xyz[0].split(chunk)])
+        if self.channels == 1:
+            out = out.unsqueeze(-1)
+        return out.permute(3,0,1,2).unsqueeze(0)
+
     def scale_volume_grid(self, new_world_size):
         if self.channels == 0:
             return
@@ -298,6 +428,7 @@ def compute_tensorf_val(xy_plane, xz_plane, yz_plane, x_vec, y_vec, z_vec, ind_n
 
 ''' Mask grid
 It supports query for the known free space and unknown space.
+The occupancy is bit-packed into int64 words (64 voxels per word, in the flattened order).
 '''
 class MaskGrid(nn.Module):
     def __init__(self, path=None, mask_cache_thres=None, mask=None, xyz_min=None, xyz_max=None):
@@ -315,11 +446,41 @@ class MaskGrid(nn.Module):
             xyz_min = torch.Tensor(xyz_min)
             xyz_max = torch.Tensor(xyz_max)
 
-        self.register_buffer('mask', mask)
+        self.world_size = list(mask.shape)
+        self.register_buffer('mask_bits', pack_bits(mask))
         xyz_len = xyz_max - xyz_min
-        self.register_buffer('xyz2ijk_scale', (torch.Tensor(list(mask.shape)) - 1) / xyz_len)
+        self.register_buffer('xyz2ijk_scale', (torch.Tensor(self.world_size) - 1) / xyz_len)
         self.register_buffer('xyz2ijk_shift', -xyz_min * self.xyz2ijk_scale)
 
+    @property
+    def mask(self):
+        '''The unpacked [X, Y, Z] bool occupancy (a copy; assign it back to modify).'''
+        return unpack_bits(self.mask_bits, self.world_size)
+
+    @mask.setter
+    def mask(self, mask):
+        assert list(mask.shape) == self.world_size
+        self.mask_bits = pack_bits(mask.to(self.mask_bits.device))
+
+    @torch.no_grad()
+    def update_and(self, mask):
+        self.mask_bits &= pack_bits(mask.to(self.mask_bits.device))
+
+    @torch.no_grad()
+    def update_or(self, mask):
+        self.mask_bits |= pack_bits(mask.to(self.mask_bits.device))
+
+    @torch.no_grad()
+    def count(self):
+        '''Number of occupied voxels.'''
+        return popcount(self.mask_bits)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert the checkpoints storing the bool mask
+        if prefix + 'mask' in state_dict:
+            state_dict[prefix + 'mask_bits'] = pack_bits(state_dict.pop(prefix + 'mask'))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @torch.no_grad()
     def forward(self, xyz):
         '''Skip know freespace
@@ -327,10 +488,65 @@ class MaskGrid(nn.Module):
         '''
         shape = xyz.shape[:-1]
         xyz = xyz.reshape(-1, 3)
-        mask = render_utils_cuda.maskcache_lookup(self.mask, xyz, self.xyz2ijk_scale, self.xyz2ijk_shift)
+        # nearest grid point as rounded in render_utils_cuda.maskcache_lookup (half away from zero)
+        ijk = xyz * self.xyz2ijk_scale + self.xyz2ijk_shift
+        ijk = (ijk.sign() * (ijk.abs() + 0.5).floor()).long()
+        world_size = torch.LongTensor(self.world_size).to(xyz.device)
+        inside = ((ijk >= 0) & (ijk < world_size)).all(-1)
+        ijk = torch.minimum(ijk.clamp_min(0), world_size-1)
+        idx = (ijk[:,0] * world_size[1] + ijk[:,1]) * world_size[2] + ijk[:,2]
+        mask = ((self.mask_bits[idx >> 6] >> (idx & 63)) & 1).bool() & inside
         mask = mask.reshape(shape)
         return mask
 
-    def extra_repr(self):
-        return f'mask.shape=list(self.mask.shape)'
+    @torch.no_grad()
+    def sample_lattice(self, xyz_min, xyz_max, lattice_size, chunk=16):
+        '''Query the lattice of linspace(xyz_min, xyz_max, lattice_size) points.
+        Same as querying the meshgrid of the lattice, but the nearest grid indices are
+        computed per axis and the bits are gathered directly, chunked along the x axis.
+        Output: [*lattice_size] bool
+        '''
+        ijk, inside = [], []
+        for i in range(3):
+            x = torch.linspace(xyz_min[i], xyz_max[i], int(lattice_size[i]), device=self.mask_bits.device)
+            x = x * self.xyz2ijk_scale[i] + self.xyz2ijk_shift[i]
+            x = (x.sign() * (x.abs() + 0.5).floor()).long()
+            inside.append((x >= 0) & (x < self.world_size[i]))
+            ijk.append(x.clamp(0, self.world_size[i]-1))
+        X, Y, Z = self.world_size
+        yz = ijk[1].view(-1,1) * Z + ijk[2].view(1,-1)
+        yz_inside = inside[1].view(-1,1) & inside[2].view(1,-1)
+        out = []
+        for ix, x_inside in zip(ijk[0].split(chunk), inside[0].split(chunk)):
+            idx = ix.view(-1,1,1) * (Y*Z) + yz
+            mask = ((self.mask_bits[idx >> 6] >> (idx & 63)) & 1).bool()
+            out.append(mask & x_inside.view(-1,1,1) & yz_inside)
+        return torch.cat(out)
 
+    def extra_repr(self):
+        return f'world_size={self.world_size}'
+
+
+@torch.no_grad()
+def pack_bits(mask):
+    '''Pack a bool tensor into int64 words. The bit i%64 of word i//64 is the i-th flattened element.'''
+    mask = mask.flatten().bool()
+    mask = torch.cat([mask, mask.new_zeros([-len(mask) % 64])]).view(-1, 8)
+    packed = torch.zeros([len(mask)], dtype=torch.uint8, device=mask.device)
+    for i in range(8):
+        packed |= mask[:,i].to(torch.uint8) << i
+    return packed.view(torch.int64)
+
+@torch.no_grad()
+def unpack_bits(bits, shape):
+    bit = torch.arange(8, dtype=torch.uint8, device=bits.device)
+    mask = ((bits.view(torch.uint8).unsqueeze(-1) >> bit) & 1).bool()
+    return mask.flatten()[:int(np.prod(shape))].reshape(shape)
+
+@functools.lru_cache(maxsize=8)
+def popcount_table(device):
+    return torch.tensor([bin(i).count('1') for i in range(256)], dtype=torch.int64, device=device)
+
+@torch.no_grad()
+def popcount(bits):
+    return popcount_table(bits.device)[bits.view(torch.uint8).long()].sum()
@@ -0,0 +1,152 @@
+'''Progressive level-of-detail bitstream of the final density and k0 grids.
+The grids are quantized per channel (lib/quant.py) and coded as a pyramid, from a coarse level
+of about world_size / 2**(n_levels-1) up to the full world_size. Each level is coded as the
+integer residual of its codes w.r.t. the trilinear upsampling of the level before, on the voxels
+supporting the kept voxels only; the voxels out of the support are empty. The finest level is the
+kept voxels themselves, so the whole stream is the final scene (up to the per-channel quantization).
+    lod.bin: magic | header length (uint32) | json header | one zlib chunk per level (coarse first)
+Any prefix of lod.bin holding the header decodes to the finest complete level, which is upsampled
+to world_size for rendering (see renderer.load_lod).
+'''
+import os, json, zlib, struct
+import numpy as np
+import torch
+
+from . import quant
+
+
+MAGIC = b'SVRFLOD1'
+
+def level_sizes(world_size, n_levels):
+    '''Grid sizes of the levels, the finest (world_size) first.'''
+    return [[max(2, -(-s // 2**k)) for s in world_size] for k in range(n_levels)]
+
+
+def resize(x, size):
+    '''Trilinear resizing of the last three axes of x, one axis at a time. The voxels are mapped by
+    their centers (align_corners=False, as grid.DenseGrid), clamped at the border. Downsizing uses the normalized transpose of the upsampling (a tent filter) so that thin
+    structures are not skipped.
+    '''
+    for axis, m in zip(range(-3, 0), size):
+        n = x.shape[axis]
+        if n == m:
+            continue
+        lo, hi = (m, n) if m < n else (n, m)
+        pos = np.clip((np.arange(hi) + 0.5) * lo / hi - 0.5, 0, lo - 1)
+        i0 = np.minimum(np.floor(pos).astype(np.int64), lo - 2)
+        w = (pos - i0).astype(np.float32)
+        mat = np.zeros([hi, lo], dtype=np.float32)
+        mat[np.arange(hi), i0] = 1 - w
+        mat[np.arange(hi), i0 + 1] = w
+        if m < n:
+            mat = mat.T / mat.T.sum(1, keepdims=True)
+        x = np.moveaxis(np.tensordot(x, mat, axes=([axis], [1])), -1, axis)
+    return x
+
+
+def support(mask, size):
+    '''The voxels of a grid of the given size whose trilinear upsampling touches the mask.'''
+    idx = np.argwhere(mask)
+    active = np.zeros(size, dtype=bool)
+    corners = []
+    for axis, (n, m) in enumerate(zip(mask.shape, size)):
+        pos = np.clip((idx[:,axis] + 0.5) * m / n - 0.5, 0, m - 1)
+        corners.append([np.floor(pos).astype(np.int64), np.ceil(pos).astype(np.int64)])
+    for i in corners[0]:
+        for j in corners[1]:
+            for k in corners[2]:
+                active[i, j, k] = True
+    return active
+
+
+''' Encoder
+'''
+def encode_lod(path, grids, non_prune_mask, bits=8, n_levels=4):
+    '''Write the LOD bitstream of the grids (dict of name -> [C, X, Y, Z] array, empty out of the mask).
+    Output: the byte size of each level, the coarsest first.
+    '''
+    mask = np.asarray(non_prune_mask).astype(bool)
+    world_size = list(mask.shape)
+    sizes = level_sizes(world_size, n_levels)
+    header = {'world_size': world_size, 'bits': bits, 'levels': [], 'grids': {}}
+    params = {}
+    for name, grid in grids.items():
+        grid = np.asarray(grid, dtype=np.float32)
+        x = torch.from_numpy(grid.reshape(len(grid), -1).T[mask.reshape(-1)])
+        scale, offset = quant.fit_affine(x, torch.zeros([len(x)], dtype=torch.long), 1, bits)
+        params[name] = (scale.numpy().reshape(-1, 1, 1, 1), offset.numpy().reshape(-1, 1, 1, 1))
+        header['grids'][name] = {'channels': len(grid), 'scale': scale.reshape(-1).tolist(),
+                                 'offset': offset.reshape(-1).tolist()}
+
+    chunks = []
+    prev = {name: None for name in grids}
+    for k in reversed(range(n_levels)):
+        active = mask if k == 0 else support(mask, sizes[k])
+        chunk = [np.packbits(active.reshape(-1)).tobytes()]
+        for name, grid in grids.items():
+            scale, offset = params[name]
+            target = resize(np.asarray(grid, dtype=np.float32), sizes[k])
+            target = np.clip(np.round((target - offset) / scale), 0, 2**bits - 1)[:,active]
+            pred = predict(prev[name], sizes[k], scale, offset, bits)[:,active]
+            chunk.append((target - pred).astype(np.int16).tobytes())
+            prev[name] = reconstruct(target, active, sizes[k], scale, offset)
+        chunks.append(zlib.compress(b''.join(chunk), 9))
+        header['levels'].append({'size': sizes[k], 'nbytes': len(chunks[-1])})
+
+    header = json.dumps(header).encode()
+    with open(os.path.join(path, 'lod.bin'), 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header + b''.join(chunks))
+    return [len(c) for c in chunks]
+
+
+def predict(prev, size, scale, offset, bits):
+    '''Codes of a level predicted by the upsampling of the values of the level before.'''
+    if prev is None:
+        prev = np.zeros([len(scale), 2, 2, 2], dtype=np.float32)
+    return np.clip(np.round((resize(prev, size) - offset) / scale), 0, 2**bits - 1)
+
+def reconstruct(codes, active, size, scale, offset):
+    values = np.zeros([len(scale)] + list(size), dtype=np.float32)
+    values[:,active] = codes * scale.reshape(-1, 1) + offset.reshape(-1, 1)
+    return values
+
+
+''' Decoder
+'''
+def read_header(f):
+    assert f.read(len(MAGIC)) == MAGIC, 'not a LOD bitstream'
+    n = struct.unpack('<I', f.read(4))[0]
+    return json.loads(f.read(n)), len(MAGIC) + 4 + n
+
+
+def decode_lod(path, n_bytes=None, max_level=None):
+    '''Decode the finest complete level of the first n_bytes of lod.bin (or up to the max_level-th level).
+    Output: dict of name -> values [C, X, Y, Z] of that level, its index (0 for the coarsest)
+            and the number of levels of the stream.
+    '''
+    with open(os.path.join(path, 'lod.bin'), 'rb') as f:
+        header, pos = read_header(f)
+        data = f.read(None if n_bytes is None else max(n_bytes - pos, 0))
+    bits = header['bits']
+    prev = {name: None for name in header['grids']}
+    level, start = -1, 0
+    for k, info in enumerate(header['levels']):
+        if start + info['nbytes'] > len(data) or (max_level is not None and k > max_level):
+            break
+        chunk = zlib.decompress(data[start:start+info['nbytes']])
+        start += info['nbytes']
+        size = info['size']
+        n_mask = (int(np.prod(size)) + 7) // 8
+        active = np.unpackbits(np.frombuffer(chunk[:n_mask], np.uint8))[:np.prod(size)].reshape(size).astype(bool)
+        n = int(active.sum())
+        offset_bytes = n_mask
+        for name, g in header['grids'].items():
+            scale = np.array(g['scale'], dtype=np.float32).reshape(-1, 1, 1, 1)
+            offset = np.array(g['offset'], dtype=np.float32).reshape(-1, 1, 1, 1)
+            residual = np.frombuffer(chunk[offset_bytes:offset_bytes + 2*n*g['channels']], np.int16)
+            offset_bytes += 2 * n * g['channels']
+            pred = predict(prev[name], size, scale, offset, bits)[:,active]
+            prev[name] = reconstruct(pred + residual.reshape(g['channels'], n), active, size, scale, offset)
+        level = k
+    assert level >= 0, 'the prefix holds no complete level'
+    return prev, level, len(header['levels'])
@@ -0,0 +1,113 @@
+'''Content-addressed stages of run.train.
+Each stage is keyed by a hash of its inputs (the configs and args it depends on) and of the
+runs of its upstream stages (a rerun upstream stage invalidates its downstream stages even
+if its own key is unchanged). The key, the artifacts and the small outputs of every finished
+stage are recorded in manifest.json of the experiment directory. A stage is reused when its
+key matches the record and its artifacts exist; otherwise the stale artifacts are removed and
+the stage is run again, which changes the keys of all the downstream stages in turn.
+'''
+import os, json, time, shutil, hashlib
+import numpy as np
+import torch
+
+
+def canonical(obj):
+    '''JSON-serializable canonical form of configs, tensors and arrays.'''
+    if isinstance(obj, dict):
+        return {str(k): canonical(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    if torch.is_tensor(obj):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    return repr(obj)
+
+
+def hash_inputs(inputs):
+    return hashlib.sha1(json.dumps(canonical(inputs), sort_keys=True).encode()).hexdigest()[:16]
+
+
+class Pipeline:
+    '''Run or reuse the stages of an experiment directory.
+    Usage:
+        pipeline = Pipeline(os.path.join(cfg.basedir, cfg.expname))
+        outputs = pipeline.run('coarse', train_coarse, inputs={'cfg': cfg.coarse_train},
+                               artifacts=['coarse_last.tar'])
+        pipeline.run('fine', train_fine, inputs={...}, artifacts=['fine_last.tar'], deps=['coarse'])
+    '''
+    def __init__(self, root, force=()):
+        self.root = root
+        self.force = set(force)
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.manifest = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def remove(self, artifacts):
+        for name in artifacts:
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            else:
+                continue
+            print(f'pipeline: remove stale {path}')
+
+    def is_valid(self, name, key):
+        record = self.manifest.get(name)
+        if name in self.force or record is None or record['key'] != key:
+            return False
+        return all(os.path.exists(os.path.join(self.root, a)) for a in record['artifacts'])
+
+    def run(self, name, fn, inputs, artifacts=(), deps=()):
+        '''Run the stage fn() unless its record is still valid.
+        @inputs:    the configs and args the stage depends on.
+        @artifacts: the files (or directories) written by the stage, relative to the root;
+                    the first one is the main artifact (e.g., the checkpoint).
+                    The ones not written by fn are not required for reuse.
+        @deps:      the names of the upstream stages run before.
+        Output: the canonical form of the return value of fn (as recorded in the manifest).
+        '''
+        deps = {d: self.manifest[d]['run'] for d in deps}
+        key = hash_inputs({'inputs': inputs, 'deps': deps})
+        if self.is_valid(name, key):
+            print(f'pipeline: reuse {name} ({key})')
+            return self.manifest[name]['outputs']
+        record = self.manifest.pop(name, None)
+        if record is None and name not in self.force and len(artifacts) and \
+                os.path.exists(os.path.join(self.root, artifacts[0])):
+            # the artifacts of a run before the manifest was introduced
+            print(f'pipeline: adopt the existing artifacts of {name} ({key})')
+            outputs = None
+            run = key
+        else:
+            self.remove(set(artifacts) | set(record['artifacts'] if record else []))
+            self.save()
+            print(f'pipeline: run {name} ({key})')
+            outputs = fn()
+            run = hash_inputs([key, time.time()])
+        self.manifest[name] = {
+            'key': key,
+            'run': run,
+            'deps': deps,
+            'inputs': canonical(inputs),
+            'artifacts': [a for a in artifacts if os.path.exists(os.path.join(self.root, a))],
+            'outputs': canonical(outputs),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.save()
+        return self.manifest[name]['outputs']
@@ -0,0 +1,175 @@
+'''Affine quantization of the non-pruned voxels (see DirectVoxGO.quantize_reformat).
+The values [N, C] of the N kept voxels are quantized into 2**bits levels per group:
+    'tensor':  qint8 storage w/ one scale for all the values (quantize_per_tensor),
+    'channel': one scale and offset per channel,
+    'block':   one scale and offset per channel of each spatial block (block_size^3 voxels).
+The scale and offset of each group are fit by a grid search of the clipping range
+minimizing the reconstruction MSE, and stored in float16. Codes of <= 4 bits are
+packed two per byte.
+'''
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+QUANT_MODES = ['tensor', 'channel', 'block']
+
+def quantize_per_tensor(x, bits=8):
+    '''Quantize x into qint8 storage w/ 2**bits levels; the step of 8 bits is std/15.
+    The zero point of 8 bits is round(mean); it is rescaled w/ the step for fewer bits, so that
+    the clipping window stays (about) the same as for 8 bits.
+    '''
+    scale = (x.std() / 15 * 2**(8-bits)).item()
+    zero_point = int(round(torch.round(x.mean()).item() / 2**(8-bits)))
+    qmin, qmax = -2**(bits-1), 2**(bits-1)-1
+    x = x.clamp((qmin - zero_point) * scale, (qmax - zero_point) * scale)
+    return torch.quantize_per_tensor(x, scale=scale, zero_point=zero_point, dtype=torch.qint8)
+
+
+def block_ids(non_prune_mask, world_size, block_size):
+    '''Index of the (occupied) spatial block of each kept voxel in the flattened mask order.
+    Output: the block index [N] and the number of occupied blocks.
+    '''
+    idx = non_prune_mask.reshape(-1).nonzero().squeeze(-1)
+    X, Y, Z = world_size
+    n_blocks = [(s + block_size - 1) // block_size for s in world_size]
+    i, j, k = idx // (Y*Z), idx // Z % Y, idx % Z
+    bid = ((i // block_size) * n_blocks[1] + j // block_size) * n_blocks[2] + k // block_size
+    uniq, group = torch.unique(bid, return_inverse=True)
+    return group, len(uniq)
+
+
+def fit_affine(x, group, n_groups, bits, n_grid=20, min_ratio=0.3):
+    '''Per-(group, channel) scale and offset of x [N, C] minimizing the reconstruction MSE.
+    The candidates shrink the [min, max] range of each group around its center.
+    '''
+    N, C = x.shape
+    levels = 2**bits - 1
+    index = group.view(-1,1).expand(-1, C)
+    lo = torch.full([n_groups, C], np.inf, device=x.device).scatter_reduce_(0, index, x, reduce='amin')
+    hi = torch.full([n_groups, C], -np.inf, device=x.device).scatter_reduce_(0, index, x, reduce='amax')
+    center = (hi + lo) / 2
+    half = (hi - lo) / 2
+    best_err = torch.full([n_groups, C], np.inf, device=x.device)
+    best_scale = torch.ones([n_groups, C], device=x.device)
+    best_offset = lo.clone()
+    for ratio in torch.linspace(1, min_ratio, n_grid).tolist():
+        scale = (2 * half * ratio / levels).clamp_min(2**-24).half().float()
+        offset = (center - half * ratio).half().float()
+        err = torch.zeros([n_groups, C], device=x.device).index_add_(
+                0, group, (dequantize(encode(x, scale, offset, group, bits), scale, offset, group) - x).pow(2))
+        better = err < best_err
+        best_err = torch.where(better, err, best_err)
+        best_scale = torch.where(better, scale, best_scale)
+        best_offset = torch.where(better, offset, best_offset)
+    return best_scale, best_offset
+
+
+def encode(x, scale, offset, group, bits):
+    return ((x - offset[group]) / scale[group]).round().clamp(0, 2**bits - 1).to(torch.uint8)
+
+def dequantize(codes, scale, offset, group):
+    '''Vectorized dequantization of the codes [N, C] of the given groups [N].'''
+    return codes.float() * scale[group] + offset[group]
+
+
+def quantize(x, bits=8, mode='channel', non_prune_mask=None, world_size=None, block_size=16):
+    '''Quantize the kept voxels x [N, C].
+    Output: the uint8 codes [N, C] and the params (scale and offset [n_groups, C] in float16)
+    '''
+    assert mode in ['channel', 'block'] and 1 < bits <= 8
+    if mode == 'block':
+        group, n_groups = block_ids(non_prune_mask, world_size, block_size)
+    else:
+        group, n_groups = torch.zeros([len(x)], dtype=torch.long, device=x.device), 1
+    scale, offset = fit_affine(x, group, n_groups, bits)
+    codes = encode(x, scale, offset, group, bits)
+    params = {
+        'mode': mode, 'bits': bits, 'block_size': block_size, 'shape': list(x.shape),
+        'scale': scale.half().cpu().numpy(), 'offset': offset.half().cpu().numpy(),
+    }
+    return codes, params
+
+
+def dequantize_params(codes, params, non_prune_mask=None, world_size=None, group=None):
+    '''Dequantize the codes [N, C] saved w/ the params of quantize.
+    The groups [N] of the codes are given, or derived from the mask of the raster order.
+    '''
+    device = codes.device
+    if group is None and params['mode'] == 'block':
+        group, _ = block_ids(non_prune_mask, world_size, params['block_size'])
+    elif group is None:
+        group = torch.zeros([len(codes)], dtype=torch.long, device=device)
+    scale = torch.from_numpy(params['scale']).float().to(device)
+    offset = torch.from_numpy(params['offset']).float().to(device)
+    return dequantize(codes, scale, offset, group)
+
+
+''' Code packing
+'''
+def pack_codes(codes, bits):
+    '''Flatten the codes into uint8 bytes; codes of <= 4 bits are packed two per byte.'''
+    codes = codes.reshape(-1).cpu().numpy().astype(np.uint8)
+    if bits > 4:
+        return codes
+    if len(codes) % 2:
+        codes = np.append(codes, np.uint8(0))
+    return codes[0::2] | (codes[1::2] << 4)
+
+def unpack_codes(packed, bits, shape):
+    n = int(np.prod(shape))
+    if bits > 4:
+        codes = packed[:n]
+    else:
+        codes = np.stack([packed & 0x0f, packed >> 4], -1).reshape(-1)[:n]
+    return torch.from_numpy(codes.reshape(shape))
+
+
+''' Quantization-aware training
+'''
+class FakeQuantize(nn.Module):
+    '''Parametrization of a DenseGrid grid w/ the quantization of quantize_reformat (for QAT).
+    The pruned voxels are zero; the kept ones are replaced by their dequantized codes in the
+    forward and pass the gradient straight through. The scale and offset are fit on the first
+    forward and by refit.
+    Usage:
+        parametrize.register_parametrization(model.k0, 'grid', FakeQuantize(non_prune_mask, bits=4))
+    '''
+    def __init__(self, non_prune_mask, bits=8, mode='tensor', world_size=None, block_size=16):
+        super(FakeQuantize, self).__init__()
+        assert mode in QUANT_MODES and 1 < bits <= 8
+        self.bits = bits
+        self.mode = mode
+        self.register_buffer('keep', non_prune_mask.reshape(-1).nonzero().squeeze(-1))
+        if mode == 'block':
+            group, self.n_groups = block_ids(non_prune_mask, world_size, block_size)
+        else:
+            group, self.n_groups = torch.zeros_like(self.keep), 1
+        self.register_buffer('group', group)
+        self.scale = None
+        self.offset = None
+
+    def kept(self, grid):
+        return grid.reshape(grid.shape[1], -1).T[self.keep]
+
+    @torch.no_grad()
+    def refit(self, grid):
+        x = self.kept(grid)
+        if self.mode == 'tensor':
+            # the levels of quantize_per_tensor as an affine code of [0, 2**bits-1]
+            q = quantize_per_tensor(x, self.bits)
+            scale, zero_point = q.q_scale(), q.q_zero_point()
+            self.scale = torch.full([1, x.shape[1]], scale, device=x.device)
+            self.offset = torch.full([1, x.shape[1]], (-2**(self.bits-1) - zero_point) * scale, device=x.device)
+        else:
+            self.scale, self.offset = fit_affine(x, self.group, self.n_groups, self.bits)
+
+    def forward(self, grid):
+        if self.scale is None:
+            self.refit(grid)
+        x = self.kept(grid)
+        x_hat = dequantize(encode(x, self.scale, self.offset, self.group, self.bits), self.scale, self.offset, self.group)
+        x_hat = x + (x_hat - x).detach()
+        C = grid.shape[1]
+        out = x.new_zeros([grid[0,0].numel(), C]).index_copy(0, self.keep, x_hat)
+        return out.T.reshape(grid.shape)
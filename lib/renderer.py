@@ -0,0 +1,449 @@
+import os, time
+import numpy as np
+import torch
+
+from . import utils, dvgo, dcvgo, dmpigo, quant, sparse, lod
+
+
+''' Model and render_kwargs construction
+'''
+def select_model_class(cfg_data):
+    if cfg_data.ndc:
+        return dmpigo.DirectMPIGO
+    elif cfg_data.unbounded_inward:
+        return dcvgo.DirectContractedVoxGO
+    else:
+        return dvgo.DirectVoxGO
+
+
+def build_render_kwargs(cfg, near, far, stepsize=None, **kwargs):
+    '''The render_kwargs for rendering with the given config; extra kwargs are added as is.
+    '''
+    render_kwargs = {
+        'near': near,
+        'far': far,
+        'bg': 1 if cfg.data.white_bkgd else 0,
+        'stepsize': cfg.fine_model_and_render.stepsize if stepsize is None else stepsize,
+        'inverse_y': cfg.data.inverse_y,
+        'flip_x': cfg.data.flip_x,
+        'flip_y': cfg.data.flip_y,
+    }
+    render_kwargs.update(kwargs)
+    return render_kwargs
+
+
+def load_vqdvgo(path, device='cuda', bricks=None):
+    '''Load a compressed scene (the extreme_saving directory).
+    @bricks: the indices of the bricks to decode (the morton layout only, see the query_box and
+             query_frustum of sparse.BrickReader); the voxels of the other bricks are left empty.
+    '''
+    def load_f(name, allow_pickle=False,array_name='arr_0'):
+        return np.load(os.path.join(path,name),allow_pickle=allow_pickle)[array_name]
+
+    metadata = load_f('metadata.npz',allow_pickle=True,array_name='metadata')
+    metadata = metadata.item()
+
+    ## prepare needed model kwargs
+    model_kwargs = metadata['model_kwargs']
+    k0_dim  = model_kwargs['rgbnet_dim']
+    world_size = metadata['world_size'].cpu().numpy().tolist()
+    max_elements = metadata['world_size'].prod().item()
+
+    if metadata.get('layout', 'raster') == 'morton':
+        ## decoding the bricks (the values are in the morton order of the voxels)
+        reader = sparse.BrickReader(path)
+        non_prune_idx, values, brick = reader.decode(bricks)
+        non_prune_idx = torch.from_numpy(non_prune_idx).to(device)
+        group = torch.from_numpy(reader.brick_group()[brick]).to(device)
+        true_grid = values['grid']
+        true_density = values['density']
+    else:
+        ## loading the masks
+        non_prune_mask = load_f('non_prune_mask.npz')
+        non_prune_mask = np.unpackbits(non_prune_mask)
+        non_prune_mask = non_prune_mask[:max_elements] #.reshape(world_size)
+        non_prune_mask = torch.from_numpy(non_prune_mask).bool().to(device)
+        non_prune_idx = non_prune_mask.nonzero().squeeze(-1)
+        group = None
+
+        ## loading the non-vq-feature and non-prune density
+        true_grid = load_f('non_prune_grid.npz')
+        true_density = load_f('non_prune_density.npz')
+
+    if 'grid_quant' in metadata:
+        # per-channel / per-block quantization (see lib/quant.py)
+        grid_quant = metadata.pop('grid_quant')
+        density_quant = metadata.pop('density_quant')
+        if group is None:
+            true_grid = quant.dequantize_params(
+                    quant.unpack_codes(true_grid, grid_quant['bits'], grid_quant['shape']).to(device),
+                    grid_quant, non_prune_mask, world_size)
+            true_density = quant.dequantize_params(
+                    quant.unpack_codes(true_density, density_quant['bits'], density_quant['shape']).to(device),
+                    density_quant, non_prune_mask, world_size)
+        else:
+            if grid_quant['mode'] != 'block':
+                group = torch.zeros_like(group)
+            true_grid = quant.dequantize_params(torch.from_numpy(true_grid).to(device), grid_quant, group=group)
+            true_density = quant.dequantize_params(torch.from_numpy(true_density).to(device), density_quant, group=group)
+    elif 'grid_dequant' in metadata:
+        grid_dequant = metadata.pop('grid_dequant')
+        density_dequant = metadata.pop('density_dequant')
+        true_grid = (true_grid.astype(np.float32) - grid_dequant['zero_point'])*grid_dequant['scale']
+        true_density = (true_density.astype(np.float32) - density_dequant['zero_point'])*density_dequant['scale']
+
+        true_grid = torch.from_numpy(true_grid).float().to(device)
+        true_density = torch.from_numpy(true_density).float().to(device)
+    else:
+        # not quantized (float16 values)
+        true_grid = torch.from_numpy(true_grid).float().to(device)
+        true_density = torch.from_numpy(true_density).float().to(device)
+
+    # build the actual feature and density grid
+    full_grid = torch.zeros(max_elements, k0_dim).to(device)
+    full_grid[non_prune_idx,:] = true_grid.reshape(-1, k0_dim)
+
+    full_density = torch.zeros(max_elements, 1).to(device) #- 99999
+    full_density[non_prune_idx,:] = true_density.reshape(-1, 1)
+
+    mdoel_state_dict =  metadata['model_state_dict']
+    rgbnet_npz = load_f('rgbnet.npz',allow_pickle=True)
+    for k,v in rgbnet_npz.item().items():
+        mdoel_state_dict['rgbnet.'+k] =v.to(device)
+    mdoel_state_dict['k0.grid'] = full_grid.T.reshape(1,k0_dim,*world_size )
+    mdoel_state_dict['density.grid'] = full_density.reshape(1,1,*world_size)
+    return model_kwargs, mdoel_state_dict, torch.tensor(len(non_prune_idx))
+
+
+def load_lod(path, device='cuda', n_bytes=None):
+    '''Load a compressed scene from the (prefix of the) LOD bitstream of the lod directory (see lib/lod.py).
+    The finest complete level is upsampled to world_size; the output is the same as load_vqdvgo.
+    '''
+    metadata = np.load(os.path.join(path, 'metadata.npz'), allow_pickle=True)['metadata'].item()
+    model_kwargs = metadata['model_kwargs']
+    k0_dim = model_kwargs['rgbnet_dim']
+    world_size = metadata['world_size'].cpu().numpy().tolist()
+    grids, level, n_levels = lod.decode_lod(path, n_bytes=n_bytes)
+    print(f'load_lod: level {level+1} / {n_levels} ({grids["k0"].shape[1:]} -> {world_size})')
+
+    mdoel_state_dict = metadata['model_state_dict']
+    rgbnet_npz = np.load(os.path.join(path, 'rgbnet.npz'), allow_pickle=True)['arr_0']
+    for k,v in rgbnet_npz.item().items():
+        mdoel_state_dict['rgbnet.'+k] = v.to(device)
+    k0 = torch.from_numpy(lod.resize(grids['k0'], world_size)).to(device)
+    density = torch.from_numpy(lod.resize(grids['density'], world_size)).to(device)
+    mdoel_state_dict['k0.grid'] = k0.reshape(1,k0_dim,*world_size)
+    mdoel_state_dict['density.grid'] = density.reshape(1,1,*world_size)
+    return model_kwargs, mdoel_state_dict, (density != 0).sum().cpu()
+
+
+''' Renderer
+'''
+class Renderer:
+    '''Render views of a loaded model with fixed render_kwargs.
+    The model is loaded once and reused across render calls.
+    '''
+    def __init__(self, model, render_kwargs, ndc=False, chunk=8192, planner=None):
+        self.model = model
+        self.render_kwargs = render_kwargs
+        self.ndc = ndc
+        self.chunk = chunk
+        self.planner = planner
+        self.voxels = None
+
+    @classmethod
+    def from_checkpoint(cls, ckpt_path, cfg, near, far, device=None, **render_kwargs):
+        '''Load a run.py checkpoint (coarse_last, fine_last, vq_last, ...) of the given config.
+        '''
+        model = utils.load_model(select_model_class(cfg.data), ckpt_path)
+        if device is not None:
+            model = model.to(device)
+        model.eval()
+        return cls(model, build_render_kwargs(cfg, near, far, **render_kwargs), ndc=cfg.data.ndc)
+
+    @classmethod
+    def from_compressed(cls, path, device='cuda', bricks=None, **render_kwargs):
+        '''Load a compressed scene (the extreme_saving directory), or only the given bricks of the morton layout.
+        The render_kwargs stored in its metadata are overridden by the given ones.
+        '''
+        return cls.from_state(path, *load_vqdvgo(path, device=device, bricks=bricks), device=device, **render_kwargs)
+
+    @classmethod
+    def from_lod(cls, path, device='cuda', n_bytes=None, **render_kwargs):
+        '''Load a compressed scene from the first n_bytes of its LOD bitstream (the lod directory).
+        '''
+        return cls.from_state(path, *load_lod(path, device=device, n_bytes=n_bytes), device=device, **render_kwargs)
+
+    @classmethod
+    def from_state(cls, path, model_kwargs, model_state_dict, voxels, device='cuda', **render_kwargs):
+        '''Build the model of a loaded scene (the output of load_vqdvgo or load_lod) of the directory path.
+        '''
+        model_kwargs['mask_cache_path'] = None
+        model = dvgo.DirectVoxGO(**model_kwargs)
+        model.load_state_dict(model_state_dict, strict=False)
+        model = model.to(device)
+        model.eval()
+        metadata = np.load(os.path.join(path, 'metadata.npz'), allow_pickle=True)['metadata'].item()
+        renderer = cls(model, dict(metadata.get('render_kwargs', {}), **render_kwargs))
+        renderer.voxels = voxels
+        return renderer
+
+    @torch.no_grad()
+    def render_rays(self, rays_o, rays_d, viewdirs, keys=('rgb_marched',), chunk=None, **render_kwargs):
+        '''Render a batch of flattened rays in chunks.
+        '''
+        render_kwargs = dict(self.render_kwargs, **render_kwargs)
+        if self.planner is not None and chunk is None:
+            chunks = self.planner.split(rays_o, rays_d, viewdirs, render_kwargs)
+        else:
+            chunk = chunk or self.chunk
+            chunks = zip(rays_o.split(chunk, 0), rays_d.split(chunk, 0), viewdirs.split(chunk, 0))
+        render_result_chunks = [
+            {k: v for k, v in self.model(ro, rd, vd, **render_kwargs).items() if k in keys}
+            for ro, rd, vd in chunks
+        ]
+        return {
+            k: torch.cat([ret[k] for ret in render_result_chunks])
+            for k in render_result_chunks[0].keys()
+        }
+
+    def get_rays(self, c2w, H, W, K):
+        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
+                H, W, K, torch.Tensor(c2w), self.ndc, inverse_y=self.render_kwargs.get('inverse_y', False),
+                flip_x=self.render_kwargs.get('flip_x', False), flip_y=self.render_kwargs.get('flip_y', False))
+        return rays_o.flatten(0,-2), rays_d.flatten(0,-2), viewdirs.flatten(0,-2)
+
+    @torch.no_grad()
+    def render_view(self, c2w, H, W, K, keys=('rgb_marched', 'depth', 'alphainv_last'), chunk=None):
+        '''Render one view. Output: dict of [H,W,C] tensors
+        '''
+        rays_o, rays_d, viewdirs = self.get_rays(c2w, H, W, K)
+        render_result = self.render_rays(rays_o, rays_d, viewdirs, keys=keys, chunk=chunk)
+        return {k: v.reshape(H,W,-1) for k, v in render_result.items()}
+
+    def render(self, poses, HW, Ks, keys=('rgb_marched', 'depth', 'alphainv_last'), chunk=None):
+        '''Render the given viewpoints. Output: dict of lists of [H,W,C] numpy arrays
+        '''
+        assert len(poses) == len(HW) and len(HW) == len(Ks)
+        results = {k: [] for k in keys}
+        for c2w, (H, W), K in zip(poses, HW, Ks):
+            render_result = self.render_view(c2w, H, W, K, keys=keys, chunk=chunk)
+            for k, v in render_result.items():
+                results[k].append(v.cpu().numpy())
+        return results
+
+    def render_parallel(self, poses, HW, Ks, n_workers, n_threads=1, tile_rows=None,
+                        keys=('rgb_marched', 'depth', 'alphainv_last')):
+        '''Render the given viewpoints on cpu with a pool of n_workers processes.
+        The model is placed in shared memory once and inherited by the forked workers,
+        each running n_threads intra-op threads. The views (or tiles of tile_rows rows)
+        are distributed to the workers and gathered in order.
+        Output: the same as render
+        '''
+        global _worker_renderer
+        assert not self.model.xyz_min.is_cuda, 'render_parallel is for cpu rendering'
+        assert len(poses) == len(HW) and len(HW) == len(Ks)
+        self.model.share_memory()
+        _worker_renderer = self
+        tasks = []
+        for i, (c2w, (H, W), K) in enumerate(zip(poses, HW, Ks)):
+            c2w = np.array(c2w.cpu() if torch.is_tensor(c2w) else c2w)
+            rows = tile_rows or H
+            for r in range(0, H, rows):
+                tasks.append((i, c2w, H, W, K, r, min(r+rows, H), keys))
+        results = {k: [None] * len(poses) for k in keys}
+        ctx = torch.multiprocessing.get_context('fork')
+        with ctx.Pool(n_workers, initializer=_init_render_worker, initargs=(n_threads,)) as pool:
+            for i, r, render_result in pool.imap_unordered(_render_tile, tasks):
+                H, W = HW[i]
+                for k, v in render_result.items():
+                    if results[k][i] is None:
+                        results[k][i] = np.empty([H, W, v.shape[-1]], dtype=v.dtype)
+                    results[k][i][r:r+len(v)] = v
+        _worker_renderer = None
+        return results
+
+
+class SharedRenderer:
+    '''Render the same views with several models (e.g., the fine and the vq model) in one pass.
+    The rays and the ray samples are generated once by the first model and each model is
+    evaluated on the shared samples; the mask_cache is evaluated once per distinct mask.
+    The samples are only shared by DirectVoxGO models of the same bbox and voxel size
+    rendered with the same sampling kwargs; otherwise the models are rendered separately.
+    '''
+    sample_keys = ['near', 'far', 'stepsize', 'inverse_y', 'flip_x', 'flip_y', 'shell_band']
+
+    def __init__(self, models, render_kwargs, ndc=False, chunk=8192):
+        assert len(models) == len(render_kwargs)
+        self.renderers = [Renderer(model, kwargs, ndc=ndc, chunk=chunk) for model, kwargs in zip(models, render_kwargs)]
+        self.shared = self.can_share(models, render_kwargs)
+        if not self.shared:
+            print('SharedRenderer: the models cannot share the ray samples, render them separately')
+        # models with identical mask_cache share the mask evaluation
+        self.mask_group = []
+        for i, model in enumerate(models):
+            same = [j for j in range(i) if self.same_mask(models[j].mask_cache, model.mask_cache)]
+            self.mask_group.append(self.mask_group[same[0]] if same else i)
+
+    @classmethod
+    def can_share(cls, models, render_kwargs):
+        model0, kwargs0 = models[0], render_kwargs[0]
+        for model, kwargs in zip(models, render_kwargs):
+            if type(model) is not dvgo.DirectVoxGO or kwargs.get('shell_band', 0) > 0:
+                return False
+            if any(kwargs.get(k) != kwargs0.get(k) for k in cls.sample_keys):
+                return False
+            if not (torch.equal(model.xyz_min, model0.xyz_min) and torch.equal(model.xyz_max, model0.xyz_max) and
+                    torch.equal(model.voxel_size, model0.voxel_size)):
+                return False
+        return True
+
+    @staticmethod
+    def same_mask(a, b):
+        if a is None or b is None:
+            return a is b
+        return a.world_size == b.world_size and torch.equal(a.mask_bits, b.mask_bits) and \
+               torch.equal(a.xyz2ijk_scale, b.xyz2ijk_scale) and torch.equal(a.xyz2ijk_shift, b.xyz2ijk_shift)
+
+    @torch.no_grad()
+    def render_rays(self, rays_o, rays_d, viewdirs, keys=('rgb_marched',), chunk=None):
+        '''Render a batch of flattened rays. Output: a list of the render results of each model.
+        '''
+        if not self.shared:
+            return [renderer.render_rays(rays_o, rays_d, viewdirs, keys=keys, chunk=chunk) for renderer in self.renderers]
+        chunk = chunk or self.renderers[0].chunk
+        sampler = self.renderers[0]
+        render_result_chunks = [[] for _ in self.renderers]
+        for ro, rd, vd in zip(rays_o.split(chunk, 0), rays_d.split(chunk, 0), viewdirs.split(chunk, 0)):
+            samples = sampler.model.sample_points(ro, rd, **sampler.render_kwargs)
+            mask_hits = {}
+            for i, renderer in enumerate(self.renderers):
+                group = self.mask_group[i]
+                if group not in mask_hits and renderer.model.mask_cache is not None:
+                    mask_hits[group] = renderer.model.mask_cache(samples[0])
+                ret = renderer.model.forward_samples(*samples, vd, mask_hit=mask_hits.get(group), **renderer.render_kwargs)
+                render_result_chunks[i].append({k: v for k, v in ret.items() if k in keys})
+        return [
+            {k: torch.cat([ret[k] for ret in chunks]) for k in chunks[0].keys()}
+            for chunks in render_result_chunks
+        ]
+
+    def render(self, poses, HW, Ks, keys=('rgb_marched', 'depth', 'alphainv_last'), chunk=None):
+        '''Render the given viewpoints. Output: a list of the render results (as Renderer.render) of each model.
+        '''
+        assert len(poses) == len(HW) and len(HW) == len(Ks)
+        results = [{k: [] for k in keys} for _ in self.renderers]
+        for c2w, (H, W), K in zip(poses, HW, Ks):
+            rays = self.renderers[0].get_rays(c2w, H, W, K)
+            for result, render_result in zip(results, self.render_rays(*rays, keys=keys, chunk=chunk)):
+                for k, v in render_result.items():
+                    result[k].append(v.reshape(H,W,-1).cpu().numpy())
+        return results
+
+
+''' Chunk planning
+'''
+class ChunkPlanner:
+    '''Split the rays into chunks that fill a memory budget.
+    The number of samples of each ray is estimated by a coarse march (probe_stride times
+    the stepsize) counting the occupied points in the mask_cache. The chunks are cut when the
+    estimated samples times the bytes per sample reach mem_budget (MB). On cuda the bytes per
+    sample are tuned online from the peak memory of each chunk.
+    '''
+    default_samples_per_ray = 256  # for the models w/o a probe
+
+    def __init__(self, model, mem_budget, probe_stride=8, min_chunk=256, max_chunk=1<<20):
+        self.model = model
+        self.mem_budget = mem_budget * 2**20
+        self.probe_stride = probe_stride
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.bytes_per_sample = self.init_bytes_per_sample(model)
+        self.records = []
+
+    @staticmethod
+    def init_bytes_per_sample(model):
+        # xyz, ray_id, step_id, density, alpha, weights, features, the rgbnet input and activations
+        rgbnet_kwargs = getattr(model, 'rgbnet_kwargs', {})
+        k0_dim = getattr(model, 'k0_dim', 12)
+        viewdirs_dim = 3 + 3 * 2 * rgbnet_kwargs.get('viewbase_pe', 4)
+        n_floats = 3 + 2 + 2 + 3 + k0_dim * 2 + viewdirs_dim + \
+                   rgbnet_kwargs.get('rgbnet_width', 128) * rgbnet_kwargs.get('rgbnet_depth', 3) + 3
+        return n_floats * 4 * 2  # x2 for the temporaries
+
+    @torch.no_grad()
+    def estimate_samples(self, rays_o, rays_d, render_kwargs):
+        '''Estimated number of occupied samples of each ray.'''
+        if not hasattr(self.model, 'mask_cache') or not hasattr(self.model, 'sample_ray') or \
+                isinstance(self.model, dcvgo.DirectContractedVoxGO):
+            return None
+        stride = self.probe_stride
+        probe_kwargs = dict(render_kwargs, stepsize=render_kwargs['stepsize'] * stride)
+        ray_pts, ray_id = self.model.sample_ray(rays_o=rays_o, rays_d=rays_d, **probe_kwargs)[:2]
+        hit = self.model.mask_cache(ray_pts)
+        return torch.bincount(ray_id[hit], minlength=len(rays_o)) * stride + 1
+
+    def plan(self, rays_o, rays_d, render_kwargs):
+        '''Chunk sizes and their estimated numbers of samples.'''
+        budget = max(int(self.mem_budget / self.bytes_per_sample), 1)
+        n_samples = self.estimate_samples(rays_o, rays_d, render_kwargs)
+        if n_samples is None:
+            n_samples = torch.full([len(rays_o)], self.default_samples_per_ray, device=rays_o.device)
+        chunk_id = (n_samples.cumsum(0) - 1) // budget
+        sizes = torch.bincount(chunk_id).tolist()
+        samples = torch.bincount(chunk_id, weights=n_samples.float()).tolist()
+        plan_sizes, plan_samples = [], []
+        for size, n in zip(sizes, samples):
+            # merge the too small chunks and split the too large ones
+            if plan_sizes and plan_sizes[-1] < self.min_chunk and plan_sizes[-1] + size <= self.max_chunk:
+                plan_sizes[-1] += size
+                plan_samples[-1] += n
+                continue
+            for i in range(0, size, self.max_chunk):
+                s = min(self.max_chunk, size - i)
+                plan_sizes.append(s)
+                plan_samples.append(n * s / max(size, 1))
+        return [s for s in plan_sizes if s > 0], [n for s, n in zip(plan_sizes, plan_samples) if s > 0]
+
+    def split(self, rays_o, rays_d, viewdirs, render_kwargs):
+        '''Yield the planned chunks; each chunk is timed until the next one is requested.'''
+        sizes, samples = self.plan(rays_o, rays_d, render_kwargs)
+        for ro, rd, vd, n in zip(rays_o.split(sizes), rays_d.split(sizes), viewdirs.split(sizes), samples):
+            use_cuda = ro.is_cuda
+            if use_cuda:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                mem_base = torch.cuda.memory_allocated()
+            eps_time = time.time()
+            yield ro, rd, vd
+            peak = 0
+            if use_cuda:
+                torch.cuda.synchronize()
+                peak = torch.cuda.max_memory_allocated() - mem_base
+                if n > 0 and peak > 0:
+                    self.bytes_per_sample = 0.7 * self.bytes_per_sample + 0.3 * peak / n
+            self.records.append((len(ro), n, time.time() - eps_time, peak))
+
+    def summary(self):
+        if len(self.records) == 0:
+            return
+        n_rays, n_samples, eps_time, peak = [np.array(v) for v in zip(*self.records)]
+        print(f'ChunkPlanner: {len(self.records)} chunks, {n_rays.mean():.0f} rays / '
+              f'{n_samples.mean():.0f} est. samples / {eps_time.mean()*1000:.1f} ms per chunk, '
+              f'{n_rays.sum() / eps_time.sum():.0f} rays/sec, peak {peak.max() / 2**20:.0f} MB, '
+              f'{self.bytes_per_sample:.0f} bytes/sample')
+
+
+''' Workers of Renderer.render_parallel
+'''
+_worker_renderer = None
+
+def _init_render_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def _render_tile(task):
+    i, c2w, H, W, K, r_start, r_end, keys = task
+    rays = _worker_renderer.get_rays(c2w, H, W, K)
+    rays = [r[r_start*W:r_end*W] for r in rays]
+    render_result = _worker_renderer.render_rays(*rays, keys=keys)
+    return i, r_start, {k: v.reshape(r_end-r_start, W, -1).numpy() for k, v in render_result.items()}
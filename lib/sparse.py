@@ -0,0 +1,208 @@
+'''Morton-ordered brick layout of the non-pruned voxels (see DirectVoxGO.quantize_reformat).
+The kept voxels are sorted by the Morton (Z-order) code of their grid index. As the brick size
+is a power of 2, the voxels of each brick_size^3 brick are contiguous in that order and the
+bricks themselves follow the Morton order of their brick coordinates.
+    bricks.bin: one zlib chunk per brick: the occupancy bits of the brick, then the values of
+                its kept voxels for each array, channel by channel (codes of <= 4 bits are packed
+                two per byte).
+    bricks.npz: the brick index: the brick coordinates [B, 3] and the byte offsets [B+1] of the
+                chunks, so that the bricks of a region or a view frustum are decoded alone.
+'''
+import os, zlib
+import numpy as np
+
+
+''' Morton code
+'''
+def part1by2(x):
+    '''Spread the (<= 21) bits of x to every third bit.'''
+    x = x.astype(np.int64) & 0x1fffff
+    x = (x | x << 32) & 0x1f00000000ffff
+    x = (x | x << 16) & 0x1f0000ff0000ff
+    x = (x | x << 8) & 0x100f00f00f00f00f
+    x = (x | x << 4) & 0x10c30c30c30c30c3
+    x = (x | x << 2) & 0x1249249249249249
+    return x
+
+def morton_code(ijk):
+    '''Morton code of the integer coordinates ijk [N, 3].'''
+    ijk = np.asarray(ijk)
+    return part1by2(ijk[:,0]) << 2 | part1by2(ijk[:,1]) << 1 | part1by2(ijk[:,2])
+
+
+def unravel(idx, world_size):
+    X, Y, Z = world_size
+    return np.stack([idx // (Y*Z), idx // Z % Y, idx % Z], -1)
+
+
+''' Writer
+'''
+def save_bricks(path, non_prune_mask, world_size, arrays, bits=None, brick_size=8):
+    '''Save the values of the kept voxels in the brick layout.
+    @non_prune_mask: the flattened mask [X*Y*Z] of the kept voxels.
+    @arrays:         dict of name -> values [N, C] of the kept voxels in the raster order.
+    @bits:           the uint8 arrays are packed two codes per byte if bits <= 4.
+    '''
+    assert brick_size & (brick_size - 1) == 0, 'brick_size should be a power of 2'
+    mask = np.asarray(non_prune_mask).reshape(-1).astype(bool)
+    ijk = unravel(np.nonzero(mask)[0], world_size)
+    order = np.argsort(morton_code(ijk), kind='stable')
+    ijk = ijk[order]
+    arrays = {k: np.ascontiguousarray(np.asarray(v)[order]) for k, v in arrays.items()}
+    brick_ijk = ijk // brick_size
+    _, starts = np.unique(morton_code(brick_ijk), return_index=True)
+    ends = np.append(starts[1:], len(ijk))
+
+    chunks, offsets = [], [0]
+    for s, e in zip(starts, ends):
+        local = ijk[s:e] - brick_ijk[s] * brick_size
+        occupancy = np.zeros([brick_size]*3, dtype=bool)
+        occupancy[local[:,0], local[:,1], local[:,2]] = True
+        chunk = [np.packbits(occupancy.reshape(-1)).tobytes()]
+        for v in arrays.values():
+            v = v[s:e].T
+            if v.dtype == np.uint8 and bits is not None and bits <= 4:
+                v = v.reshape(-1)
+                v = np.append(v, np.zeros(len(v) % 2, np.uint8))
+                v = v[0::2] | (v[1::2] << 4)
+            chunk.append(v.tobytes())
+        chunks.append(zlib.compress(b''.join(chunk), 9))
+        offsets.append(offsets[-1] + len(chunks[-1]))
+
+    with open(os.path.join(path, 'bricks.bin'), 'wb') as f:
+        f.write(b''.join(chunks))
+    np.savez_compressed(
+            os.path.join(path, 'bricks.npz'),
+            brick_ijk=brick_ijk[starts].astype(np.int32), offsets=np.array(offsets, dtype=np.int64),
+            brick_size=brick_size, world_size=np.array(world_size), bits=-1 if bits is None else bits,
+            names=np.array(list(arrays.keys())),
+            dtypes=np.array([v.dtype.str for v in arrays.values()]),
+            channels=np.array([v.shape[1] for v in arrays.values()]))
+
+
+''' Reader
+'''
+class BrickReader:
+    '''Random access to the bricks saved by save_bricks.
+    Usage:
+        reader = BrickReader(path)
+        idx, arrays, _ = reader.decode(reader.query_box(xyz_min, xyz_max, grid_min, grid_max))
+    '''
+    def __init__(self, path):
+        index = np.load(os.path.join(path, 'bricks.npz'))
+        self.path = os.path.join(path, 'bricks.bin')
+        self.brick_ijk = index['brick_ijk'].astype(np.int64)
+        self.offsets = index['offsets']
+        self.brick_size = int(index['brick_size'])
+        self.world_size = index['world_size'].tolist()
+        self.bits = int(index['bits'])
+        self.names = index['names'].tolist()
+        self.dtypes = [np.dtype(d) for d in index['dtypes'].tolist()]
+        self.channels = index['channels'].tolist()
+
+    def __len__(self):
+        return len(self.brick_ijk)
+
+    def brick_group(self):
+        '''Rank of each brick in the raster order of the bricks, i.e., the group of the 'block'
+        quantization mode (lib/quant.block_ids) when its block_size is the brick_size.'''
+        n_bricks = [(s + self.brick_size - 1) // self.brick_size for s in self.world_size]
+        raster = (self.brick_ijk[:,0] * n_bricks[1] + self.brick_ijk[:,1]) * n_bricks[2] + self.brick_ijk[:,2]
+        return np.argsort(np.argsort(raster))
+
+    def brick_bounds(self, grid_min, grid_max):
+        '''World-space bounds [B, 3] of the points interpolating the voxels of the bricks
+        (voxel i is centered at (i+0.5) voxels from grid_min, as grid.DenseGrid).'''
+        grid_min, grid_max = np.asarray(grid_min, np.float64), np.asarray(grid_max, np.float64)
+        voxel = (grid_max - grid_min) / np.array(self.world_size)
+        lo = (self.brick_ijk * self.brick_size - 0.5) * voxel + grid_min
+        hi = (self.brick_ijk * self.brick_size + self.brick_size + 0.5) * voxel + grid_min
+        return lo, hi
+
+    def box_voxels(self, xyz_min, xyz_max, grid_min, grid_max):
+        '''Voxel range [2, 3] (inclusive) trilinearly interpolated by the points of the world-space
+        box [xyz_min, xyz_max]; the corners of a point p are the voxels floor(p/voxel - 0.5) + {0, 1}.
+        Output: None if no voxel of the grid is interpolated.
+        '''
+        grid_min, grid_max = np.asarray(grid_min, np.float64), np.asarray(grid_max, np.float64)
+        voxel = (grid_max - grid_min) / np.array(self.world_size)
+        lo = np.floor((np.asarray(xyz_min) - grid_min) / voxel - 0.5).astype(np.int64)
+        hi = np.floor((np.asarray(xyz_max) - grid_min) / voxel - 0.5).astype(np.int64) + 1
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, np.array(self.world_size) - 1)
+        if (lo > hi).any():
+            return None
+        return np.stack([lo, hi])
+
+    def query_box(self, xyz_min, xyz_max, grid_min, grid_max):
+        '''Indices of the bricks intersecting the world-space box [xyz_min, xyz_max].'''
+        lo, hi = self.brick_bounds(grid_min, grid_max)
+        eps = 1e-6 * (hi[:1] - lo[:1])
+        hit = (hi + eps >= np.asarray(xyz_min)).all(-1) & (lo - eps <= np.asarray(xyz_max)).all(-1)
+        return np.nonzero(hit)[0]
+
+    def missing_bricks(self, bricks, xyz_min, xyz_max, grid_min, grid_max):
+        '''Debug check of query_box: the indices of the bricks holding a voxel interpolated by a point
+        of the box (see box_voxels) that are not in bricks (empty if the query is conservative).'''
+        voxels = self.box_voxels(xyz_min, xyz_max, grid_min, grid_max)
+        if voxels is None:
+            return np.zeros([0], dtype=np.int64)
+        voxels = voxels // self.brick_size
+        needed = ((self.brick_ijk >= voxels[0]) & (self.brick_ijk <= voxels[1])).all(-1)
+        needed[np.asarray(bricks, dtype=np.int64)] = False
+        return np.nonzero(needed)[0]
+
+    def query_frustum(self, c2w, K, H, W, near, far, grid_min, grid_max, inverse_y=False):
+        '''Indices of the bricks (conservatively) intersecting the view frustum of a camera of dvgo.get_rays.'''
+        c2w, K = np.asarray(c2w, np.float64)[:3,:4], np.asarray(K, np.float64)
+        uv = np.array([[0, 0], [W, 0], [W, H], [0, H]], dtype=np.float64)
+        dirs = np.stack([(uv[:,0]-K[0][2])/K[0][0], (uv[:,1]-K[1][2])/K[1][1], np.ones(4)], -1)
+        if not inverse_y:
+            dirs[:,1:] *= -1
+        dirs = dirs @ c2w[:,:3].T
+        pts = np.concatenate([c2w[:,3] + dirs*near, c2w[:,3] + dirs*far])
+        center = pts.mean(0)
+        faces = [(0, 1, 2), (4, 6, 5)] + [(i, (i+1)%4, i+4) for i in range(4)]
+        lo, hi = self.brick_bounds(grid_min, grid_max)
+        corners = np.stack([np.where([(c >> a) & 1 for a in range(3)], hi, lo) for c in range(8)], 1)
+        inside = np.ones(len(lo), dtype=bool)
+        for a, b, c in faces:
+            normal = np.cross(pts[b] - pts[a], pts[c] - pts[a])
+            if normal @ (center - pts[a]) < 0:
+                normal = -normal
+            inside &= ((corners - pts[a]) @ normal >= 0).any(-1)
+        return np.nonzero(inside)[0]
+
+    def decode(self, bricks=None):
+        '''Decode the given bricks (all by default).
+        Output: the raster indices [N] of their kept voxels, the dict of name -> values [N, C]
+                and the brick [N] of each voxel.
+        '''
+        bricks = np.arange(len(self)) if bricks is None else np.sort(np.asarray(bricks, dtype=np.int64))
+        bs = self.brick_size
+        n_occ = bs**3 // 8
+        X, Y, Z = self.world_size
+        idx, brick, values = [], [], {k: [] for k in self.names}
+        with open(self.path, 'rb') as f:
+            for b in bricks:
+                f.seek(self.offsets[b])
+                chunk = zlib.decompress(f.read(self.offsets[b+1] - self.offsets[b]))
+                local = np.argwhere(np.unpackbits(np.frombuffer(chunk[:n_occ], np.uint8)).reshape(bs, bs, bs))
+                local = local[np.argsort(morton_code(local), kind='stable')]
+                ijk = local + self.brick_ijk[b] * bs
+                idx.append((ijk[:,0] * Y + ijk[:,1]) * Z + ijk[:,2])
+                brick.append(np.full([len(local)], b))
+                pos = n_occ
+                for k, dtype, C in zip(self.names, self.dtypes, self.channels):
+                    n = len(local) * C
+                    packed = dtype == np.uint8 and 0 < self.bits <= 4
+                    nbytes = (n + 1) // 2 if packed else n * dtype.itemsize
+                    v = np.frombuffer(chunk[pos:pos+nbytes], dtype)
+                    if packed:
+                        v = np.stack([v & 0x0f, v >> 4], -1).reshape(-1)[:n]
+                    values[k].append(v.reshape(C, -1).T)
+                    pos += nbytes
+        idx = np.concatenate(idx) if len(idx) else np.zeros([0], dtype=np.int64)
+        brick = np.concatenate(brick) if len(brick) else np.zeros([0], dtype=np.int64)
+        values = {k: np.concatenate(v) if len(v) else np.zeros([0, C], dtype)
+                  for (k, v), dtype, C in zip(values.items(), self.dtypes, self.channels)}
+        return idx, values, brick
@@ -1,4 +1,4 @@
-import os, math
+import os, math, time
 import numpy as np
 import scipy.signal
 from typing import List, Optional
@@ -46,6 +46,52 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     return MaskedAdam(param_group)
 
 
+class ModuleTimer:
+    '''Accumulate the wall time of the forward calls of a module (synchronized on CUDA).
+    usage:
+        with ModuleTimer(model.rgbnet) as timer:
+            render ...
+        print(timer.elapsed, timer.calls)
+    or timer = ModuleTimer(model.rgbnet).attach() ... timer.remove()
+    (a None module is not timed)
+    '''
+    def __init__(self, module):
+        self.module = module
+        self.elapsed = 0
+        self.calls = 0
+        self.handles = []
+
+    def sync(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def before(self, module, inputs):
+        self.sync()
+        self.start_time = time.time()
+
+    def after(self, module, inputs, outputs):
+        self.sync()
+        self.elapsed += time.time() - self.start_time
+        self.calls += 1
+
+    def attach(self):
+        if self.module is not None:
+            self.handles = [self.module.register_forward_pre_hook(self.before),
+                            self.module.register_forward_hook(self.after)]
+        return self
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, type, value, traceback):
+        self.remove()
+
+
 ''' Checkpoint utils
 '''
 def load_checkpoint(model, optimizer, ckpt_path, no_reload_optimizer, strict=True):
@@ -1,4 +1,4 @@
-import os, sys, copy, glob, json, time, random, argparse
+import os, sys, copy, glob, json, time, random, shutil, argparse
 from tqdm import tqdm, trange
 
 import mmengine
@@ -7,9 +7,13 @@ import numpy as np
 
 import torch
 import torch.nn.functional as F
+from torch.nn.utils import parametrize
 
-from lib import utils, dvgo, dcvgo, dmpigo
+from lib import utils, dvgo, dcvgo, dmpigo, quant, lod
 from lib.load_data import load_data
+from lib.pipeline import Pipeline
+from lib.quant import QUANT_MODES
+from lib.renderer import Renderer, SharedRenderer, ChunkPlanner, select_model_class, build_render_kwargs
 
 from torch_efficient_distloss import flatten_eff_distloss
 
@@ -31,6 +35,8 @@ def config_parser():
     parser.add_argument("--export_bbox_and_cams_only", type=str, default='',
                         help='export scene bbox and camera poses for debugging and 3d visualization')
     parser.add_argument("--export_coarse_only", type=str, default='')
+    parser.add_argument("--force_stages", type=str, nargs='*', default=[], choices=['coarse', 'fine', 'vq'],
+                        help='rerun these training stages even if their artifacts are still valid')
 
     # testing options
     parser.add_argument("--render_only", action='store_true',
@@ -46,6 +52,20 @@ def config_parser():
     parser.add_argument("--eval_ssim", action='store_true')
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
+    parser.add_argument("--render_workers", type=int, default=0,
+                        help='render the views on cpu with this many worker processes (0 to disable)')
+    parser.add_argument("--render_threads", type=int, default=1,
+                        help='number of torch threads of each render worker')
+    parser.add_argument("--render_shared", action='store_true',
+                        help='render the fine and the vq model in one pass sharing the ray samples (with --render_fine)')
+    parser.add_argument("--render_mem_budget", type=float, default=0,
+                        help='memory budget (MB) of the adaptive ray chunks (0 to use fixed chunks of 8192 rays)')
+    parser.add_argument("--shell_band", type=float, default=0,
+                        help='render with two-pass shell-guided sampling, only sampling this many voxels around the first shell crossing (0 to disable, DirectVoxGO only)')
+    parser.add_argument("--shell_coarse_step", type=float, default=4,
+                        help='stepsize multiplier of the coarse pass in shell-guided sampling')
+    parser.add_argument("--render_deferred", action='store_true',
+                        help='render with deferred shading (run the colors MLP once per ray)')
     
     # logging/saving options
     parser.add_argument("--i_print",   type=int, default=500,
@@ -62,6 +82,38 @@ def config_parser():
             help='quantile threshold for pruned voxels')
     parser.add_argument("--importance_final",  type=float,  default=1.0,
         help='quantile threshold for final pruned voxels')
+    parser.add_argument("--quant_mode",  type=str,  default='tensor', choices=QUANT_MODES,
+        help='quantization of the final voxels: one scale per tensor, per channel or per channel of each spatial block')
+    parser.add_argument("--quant_bits",  type=int,  default=8,
+        help='bit-width of the final quantization (codes of <= 4 bits are packed, except in the tensor mode)')
+    parser.add_argument("--quant_block",  type=int,  default=16,
+        help='spatial block size of the block quantization mode')
+    parser.add_argument("--layout",  type=str,  default='raster', choices=['raster', 'morton'],
+        help='storage of the final voxels: raster order, or Morton-ordered bricks w/ random access (see lib/sparse.py)')
+    parser.add_argument("--brick_size",  type=int,  default=8,
+        help='brick size of the morton layout (a power of 2; the block quantization mode uses quant_block)')
+    parser.add_argument("--lod_levels",  type=int,  default=0,
+        help='also write the final voxels as a progressive LOD bitstream of this many levels to basedir/expname/lod (0 to disable)')
+    parser.add_argument("--target_size",  type=float,  default=0,
+        help='search the final pruning threshold for this size (bytes) of the compressed scene (0 to use importance_final)')
+    parser.add_argument("--target_voxels",  type=int,  default=0,
+        help='search the final pruning threshold for this number of kept voxels (0 to use importance_final)')
+    parser.add_argument("--qat_iters",  type=int,  default=0,
+        help='iterations of quantization-aware fine-tuning after the final pruning (0 to disable)')
+    parser.add_argument("--qat_lr_scale",  type=float,  default=0.1,
+        help='learning rates of the quantization-aware fine-tuning relative to fine_train')
+    parser.add_argument("--qat_refit_every",  type=int,  default=500,
+        help='refit the quantization scale and offset every this many iterations of the fine-tuning')
+    parser.add_argument("--distill_iters",  type=int,  default=0,
+        help='iterations of distilling rgbnet into a smaller MLP after the final pruning (0 to disable)')
+    parser.add_argument("--distill_width",  type=int,  default=64,
+        help='width of the distilled rgbnet')
+    parser.add_argument("--distill_depth",  type=int,  default=2,
+        help='depth (number of linear layers) of the distilled rgbnet')
+    parser.add_argument("--distill_lr",  type=float,  default=1e-3,
+        help='learning rate of the distilled rgbnet')
+    parser.add_argument("--distill_testskip",  type=int,  default=8,
+        help='compare the rgbnet and the distilled one on every distill_testskip-th test view')
     parser.add_argument("--k_expire",  type=int,  default=10,
             help='expireed k code per iteration')
     parser.add_argument("--render_fine",  action="store_true", 
@@ -76,8 +128,12 @@ def config_parser():
 def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, dump_images=False,
                       render_factor=0, render_video_flipy=False, render_video_rot90=0,
-                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False):
+                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False,
+                      render_workers=0, render_threads=1, mem_budget=0, rendered=None, render_time=0,
+                      time_mlp=False):
     '''Render images for the given viewpoints; run evaluation if gt given.
+    The views already rendered by render_viewpoints_shared are given by rendered and render_time.
+    @time_mlp: also time the rgbnet forward calls (appended to mean.txt).
     '''
     assert len(render_poses) == len(HW) and len(HW) == len(Ks)
 
@@ -95,27 +151,22 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     lpips_alex = []
     lpips_vgg = []
     eps_time = time.time()
-    
+    renderer = Renderer(model, render_kwargs, ndc=ndc)
+    if mem_budget > 0:
+        renderer.planner = ChunkPlanner(model, mem_budget)
+    mlp_timer = utils.ModuleTimer(model.rgbnet if time_mlp else None).attach()
+    if rendered is None and render_workers > 0:
+        rendered = renderer.render_parallel(render_poses, HW, Ks, render_workers, render_threads)
+
     for i, c2w in enumerate(tqdm(render_poses)):
 
         H, W = HW[i]
         K = Ks[i]
         c2w = torch.Tensor(c2w)
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        keys = ['rgb_marched', 'depth', 'alphainv_last']
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
-        render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
-        ]
-        render_result = {
-            k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
-            for k in render_result_chunks[0].keys()
-        }
+        if rendered is not None:
+            render_result = {k: torch.from_numpy(v[i]) for k, v in rendered.items()}
+        else:
+            render_result = renderer.render_view(c2w, H, W, K)
         rgb = render_result['rgb_marched'].cpu().numpy()
         depth = render_result['depth'].cpu().numpy()
         bgmap = render_result['alphainv_last'].cpu().numpy()
@@ -135,25 +186,32 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                 lpips_alex.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='alex', device=c2w.device))
             if eval_lpips_vgg:
                 lpips_vgg.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
-    test_eps = time.time() - eps_time
-    voxels = torch.sum(model.mask_cache.mask).cpu()
+    test_eps = time.time() - eps_time + render_time
+    mlp_timer.remove()
+    if renderer.planner is not None:
+        renderer.planner.summary()
+    voxels = model.mask_cache.count().cpu()
+    extra = []
+    if time_mlp:
+        print(f'Testing mlp time {mlp_timer.elapsed:.3f} sec in {mlp_timer.calls} calls ({test_eps:.3f} sec in total)')
+        extra = [mlp_timer.elapsed]
 
     if len(psnrs):
         print('Testing psnr', np.mean(psnrs), '(avg)')
         if eval_ssim and not eval_lpips_vgg and not eval_lpips_alex:
             print('Testing ssim', np.mean(ssims), '(avg)')
-            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), 0., 0., voxels, test_eps]))
+            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), 0., 0., voxels, test_eps] + extra))
         elif eval_ssim and eval_lpips_vgg and not eval_lpips_alex:
             print('Testing ssim', np.mean(ssims), '(avg)')
             print('Testing lpips (vgg)', np.mean(lpips_vgg), '(avg)')
-            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), np.mean(lpips_vgg), 0., voxels, test_eps]))
+            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), np.mean(lpips_vgg), 0., voxels, test_eps] + extra))
         elif eval_ssim and eval_lpips_vgg and eval_lpips_alex:
             print('Testing ssim', np.mean(ssims), '(avg)')
             print('Testing lpips (vgg)', np.mean(lpips_vgg), '(avg)')
             print('Testing lpips (alex)', np.mean(lpips_alex), '(avg)')
-            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), np.mean(lpips_vgg), np.mean(lpips_alex), voxels, test_eps]))
+            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), np.mean(ssims), np.mean(lpips_vgg), np.mean(lpips_alex), voxels, test_eps] + extra))
         else:
-            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), 0., 0., 0., voxels, test_eps]))
+            np.savetxt(f'{savedir}/mean.txt', np.asarray([np.mean(psnrs), 0., 0., 0., voxels, test_eps] + extra))
 
     if render_video_flipy:
         for i in range(len(rgbs)):
@@ -180,6 +238,28 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     return rgbs, depths, bgmaps
 
 
+@torch.no_grad()
+def render_viewpoints_shared(viewpoints_kwargs, render_poses, HW, Ks, render_factor=0):
+    '''Render the viewpoints once for several models sharing the rays and ray samples.
+    @viewpoints_kwargs: the render_viewpoints kwargs (model, ndc, render_kwargs) of each model.
+    Output: the rendered and render_time kwargs of render_viewpoints for each model; the time of
+            the shared pass is reported for every model.
+    '''
+    if render_factor!=0:
+        HW = np.copy(HW)
+        Ks = np.copy(Ks)
+        HW = (HW/render_factor).astype(int)
+        Ks[:, :2, :3] /= render_factor
+    eps_time = time.time()
+    renderer = SharedRenderer(
+            [kwargs['model'] for kwargs in viewpoints_kwargs],
+            [kwargs['render_kwargs'] for kwargs in viewpoints_kwargs],
+            ndc=viewpoints_kwargs[0]['ndc'])
+    rendered = renderer.render(render_poses, HW, Ks)
+    render_time = time.time() - eps_time
+    return [{'rendered': r, 'render_time': render_time} for r in rendered]
+
+
 def seed_everything():
     '''Seed everything for better reproducibility.
     (some pytorch operation is non-deterministic like the backprop of grid_samples)
@@ -213,33 +293,31 @@ def load_everything(args, cfg):
 
 
 def _compute_bbox_by_cam_frustrm_bounded(cfg, HW, Ks, poses, i_train, near, far):
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        if cfg.data.ndc:
-            pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far])
-        else:
-            pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
-        xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2)))
-        xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2)))
+    # Only the corner rays of each view are needed: the near/far cross-sections of a
+    # frustum are convex quads, or spherical quads whose extremes get_frustum_extreme_dirs gives
+    rays_o, rays_d, viewdirs = dvgo.get_corner_rays_of_views(
+            HW=HW[i_train], Ks=Ks[i_train], c2ws=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    if cfg.data.ndc:
+        pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far]).flatten(0,-2)
+    else:
+        dirs, valid = dvgo.get_frustum_extreme_dirs(viewdirs)
+        cam_o = rays_o[:,:1].expand(dirs.shape)
+        pts_nf = torch.cat([(cam_o+dirs*near)[valid], (cam_o+dirs*far)[valid]])
+    xyz_min = pts_nf.amin(0)
+    xyz_max = pts_nf.amax(0)
     return xyz_min, xyz_max
 
 def _compute_bbox_by_cam_frustrm_unbounded(cfg, HW, Ks, poses, i_train, near_clip):
     # Find a tightest cube that cover all camera centers
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        pts = rays_o + rays_d * near_clip
-        xyz_min = torch.minimum(xyz_min, pts.amin((0,1)))
-        xyz_max = torch.maximum(xyz_max, pts.amax((0,1)))
+    rays_o, rays_d, viewdirs = dvgo.get_corner_rays_of_views(
+            HW=HW[i_train], Ks=Ks[i_train], c2ws=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    pts = (rays_o + rays_d * near_clip).flatten(0,-2)
+    xyz_min = pts.amin(0)
+    xyz_max = pts.amax(0)
     center = (xyz_min + xyz_max) * 0.5
     radius = (center - xyz_min).max() * cfg.data.unbounded_inner_r
     xyz_min = center - radius
@@ -265,18 +343,16 @@ def compute_bbox_by_coarse_geo(model_class, model_path, thres):
     print('compute_bbox_by_coarse_geo: start')
     eps_time = time.time()
     model = utils.load_model(model_class, model_path)
-    interp = torch.stack(torch.meshgrid(
-        torch.linspace(0, 1, model.world_size[0]),
-        torch.linspace(0, 1, model.world_size[1]),
-        torch.linspace(0, 1, model.world_size[2]),
-    ), -1)
-    dense_xyz = model.xyz_min * (1-interp) + model.xyz_max * interp
-    density = model.density(dense_xyz)
+    density = model.density.sample_lattice(model.world_size)[0,0]
     alpha = model.activate_density(density)
     mask = (alpha > thres)
-    active_xyz = dense_xyz[mask]
-    xyz_min = active_xyz.amin(0)
-    xyz_max = active_xyz.amax(0)
+    # bbox of the active lattice points, found per axis w/o building the dense xyz
+    active_ijk = [mask.movedim(i, 0).flatten(1).any(1).nonzero()[:,0] for i in range(3)]
+    ijk_min = torch.stack([ijk.min() for ijk in active_ijk])
+    ijk_max = torch.stack([ijk.max() for ijk in active_ijk])
+    world_size_1 = (model.world_size - 1).clamp(min=1).to(model.xyz_min)
+    xyz_min = model.xyz_min + (model.xyz_max - model.xyz_min) * ijk_min / world_size_1
+    xyz_max = model.xyz_min + (model.xyz_max - model.xyz_min) * ijk_max / world_size_1
     print('compute_bbox_by_coarse_geo: xyz_min', xyz_min)
     print('compute_bbox_by_coarse_geo: xyz_max', xyz_max)
     eps_time = time.time() - eps_time
@@ -325,12 +401,7 @@ def create_new_model_for_vq(cfg_model, coarse_ckpt_path, strict=False):
     return model
 
 def load_existed_model(args, cfg, cfg_train, reload_ckpt_path):
-    if cfg.data.ndc:
-        model_class = dmpigo.DirectMPIGO
-    elif cfg.data.unbounded_inward:
-        model_class = dcvgo.DirectContractedVoxGO
-    else:
-        model_class = dvgo.DirectVoxGO
+    model_class = select_model_class(cfg.data)
     model = utils.load_model(model_class, reload_ckpt_path).to(device)
     optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
     model, optimizer, start = utils.load_checkpoint(
@@ -394,21 +465,15 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
         print(f'scene_rep_reconstruction ({stage}): reload from {reload_ckpt_path}')
         model, optimizer, start = load_existed_model(args, cfg, cfg_train, reload_ckpt_path)
     # init rendering setup
-    render_kwargs = {
-        'near': data_dict['near'],
-        'far': data_dict['far'],
-        'bg': 1 if cfg.data.white_bkgd else 0,
-        'rand_bkgd': cfg.data.rand_bkgd,
-        'stepsize': cfg_model.stepsize,
-        'inverse_y': cfg.data.inverse_y,
-        'flip_x': cfg.data.flip_x,
-        'flip_y': cfg.data.flip_y,
-        'depth_label': cfg_train.depth_label,
-        'weight_surface_distill':cfg_train.weight_surface_distill,
-        'entropy_loss_after': cfg_train.entropy_loss_after,
-        'entropy_loss_before': cfg_train.entropy_loss_before,
-        'depth_entropy_every': cfg_train.depth_entropy_every,
-    }
+    render_kwargs = build_render_kwargs(
+        cfg, data_dict['near'], data_dict['far'], stepsize=cfg_model.stepsize,
+        rand_bkgd=cfg.data.rand_bkgd,
+        depth_label=cfg_train.depth_label,
+        weight_surface_distill=cfg_train.weight_surface_distill,
+        entropy_loss_after=cfg_train.entropy_loss_after,
+        entropy_loss_before=cfg_train.entropy_loss_before,
+        depth_entropy_every=cfg_train.depth_entropy_every,
+        deferred_shading=cfg_model.get('deferred_shading', False))
 
     # init batch rays sampler
     def gather_training_rays():
@@ -451,7 +516,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                     stepsize=cfg_model.stepsize, downrate=cfg_train.pervoxel_lr_downrate,
                     irregular_shape=data_dict['irregular_shape'])
             optimizer.set_pervoxel_lr(cnt)
-            model.mask_cache.mask[cnt.squeeze() <= 2] = False
+            model.mask_cache.update_and(cnt.squeeze() > 2)
         per_voxel_init()
 
     if cfg_train.maskout_lt_nviews > 0:
@@ -470,16 +535,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             render_viewpoints_kwargs = {
             'model': model,
             'ndc': cfg.data.ndc,
-            'render_kwargs': {
-                'near': data_dict['near'],
-                'far': data_dict['far'],
-                'bg': 1 if cfg.data.white_bkgd else 0,
-                'stepsize': stepsize,
-                'inverse_y': cfg.data.inverse_y,
-                'flip_x': cfg.data.flip_x,
-                'flip_y': cfg.data.flip_y,
-                'render_depth': True,
-                },
+            'render_kwargs': build_render_kwargs(
+                cfg, data_dict['near'], data_dict['far'], stepsize=stepsize, render_depth=True),
             }      
             importance_savedir = os.path.join(cfg.basedir, cfg.expname)
             init_importance(
@@ -487,6 +544,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                 HW=data_dict['HW'][data_dict['i_train']],
                 Ks=data_dict['Ks'][data_dict['i_train']],
                 savedir=importance_savedir,
+                mem_budget=args.render_mem_budget,
                 **render_viewpoints_kwargs)
         
         # renew occupancy grid
@@ -626,10 +684,175 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             'optimizer_state_dict': optimizer.state_dict(),
         }, last_ckpt_path)
         print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', last_ckpt_path)
-        print("{} mask's shape:{}, mask's total number:{}".format(stage, model.mask_cache.mask.shape, model.mask_cache.mask.shape[0] * model.mask_cache.mask.shape[1] * model.mask_cache.mask.shape[-1]))
-        print("{} mask's true number:{}".format(stage, torch.sum(model.mask_cache.mask)))      
+        print("{} mask's shape:{}, mask's total number:{}".format(stage, model.mask_cache.world_size, np.prod(model.mask_cache.world_size)))
+        print("{} mask's true number:{}".format(stage, model.mask_cache.count()))      
+
+    return np.prod(model.mask_cache.world_size), model.mask_cache.count()
 
-    return model.mask_cache.mask.shape[0] * model.mask_cache.mask.shape[1] * model.mask_cache.mask.shape[-1], torch.sum(model.mask_cache.mask)
+
+def quantization_aware_finetune(args, cfg, model, data_dict, non_prune_mask):
+    '''Fine-tune the pruned model w/ its grids fake-quantized as in the final quantize_reformat.
+    Only the kept voxels are updated (the gradient passes straight through the rounding); the
+    scale and offset are refit every args.qat_refit_every iterations.
+    '''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    HW, Ks, near, far, i_train, poses, images = [
+        data_dict[k] for k in ['HW', 'Ks', 'near', 'far', 'i_train', 'poses', 'images']]
+    cfg_train = copy.deepcopy(cfg.fine_train)
+    for k in cfg_train.keys():
+        if k.startswith('lrate_') and k != 'lrate_decay':
+            cfg_train[k] = cfg_train[k] * args.qat_lr_scale
+
+    # fake-quantize the grids and render w/o the importance
+    quant_kwargs = dict(bits=args.quant_bits, mode=args.quant_mode,
+                        world_size=model.world_size.tolist(), block_size=args.quant_block)
+    fake_quants = [quant.FakeQuantize(non_prune_mask, **quant_kwargs).to(device) for _ in range(2)]
+    for grid, fake_quant in zip([model.density, model.k0], fake_quants):
+        parametrize.register_parametrization(grid, 'grid', fake_quant)
+    importance, model.importance = model.importance, None
+    optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
+    render_kwargs = build_render_kwargs(
+        cfg, near, far, stepsize=cfg.fine_model_and_render.stepsize, rand_bkgd=cfg.data.rand_bkgd)
+
+    if data_dict['irregular_shape']:
+        rgb_tr_ori = [images[i].to('cpu' if cfg.data.load2gpu_on_the_fly else device) for i in i_train]
+    else:
+        rgb_tr_ori = images[i_train].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
+    rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = dvgo.get_training_rays_flatten(
+            rgb_tr_ori=rgb_tr_ori,
+            train_poses=poses[i_train],
+            HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    index_generator = dvgo.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
+
+    torch.cuda.empty_cache()
+    psnr_lst = []
+    time0 = time.time()
+    decay_factor = 0.1 ** (1/(cfg_train.lrate_decay * 1000))
+    for global_step in trange(1, 1+args.qat_iters):
+        if global_step % args.qat_refit_every == 0:
+            for grid, fake_quant in zip([model.density, model.k0], fake_quants):
+                fake_quant.refit(grid.parametrizations.grid.original)
+
+        sel_i = next(index_generator)
+        target = rgb_tr[sel_i].to(device)
+        rays_o = rays_o_tr[sel_i].to(device)
+        rays_d = rays_d_tr[sel_i].to(device)
+        viewdirs = viewdirs_tr[sel_i].to(device)
+
+        render_result = model(
+            rays_o, rays_d, viewdirs,
+            global_step=global_step, target=target, is_train=True,
+            **render_kwargs)
+        optimizer.zero_grad(set_to_none=True)
+        loss = F.mse_loss(render_result['rgb_marched'], target)
+        loss.backward()
+        optimizer.step()
+        psnr_lst.append(utils.mse2psnr(loss.detach()).item())
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = param_group['lr'] * decay_factor
+
+        if global_step%args.i_print==0:
+            eps_time = time.time() - time0
+            eps_time_str = f'{eps_time//3600:02.0f}:{eps_time//60%60:02.0f}:{eps_time%60:02.0f}'
+            tqdm.write(f'quantization_aware_finetune: iter {global_step:6d} / '
+                       f'Loss: {loss.item():.9f} / '
+                       f'PSNR: {np.mean(psnr_lst):5.2f} / '
+                       f'Eps: {eps_time_str}')
+            psnr_lst = []
+
+    # keep the fine-tuned full-precision values; the final quantize_reformat encodes them
+    for grid in [model.density, model.k0]:
+        parametrize.remove_parametrizations(grid, 'grid', leave_parametrized=False)
+    model.importance = importance
+
+
+def distill_rgbnet(args, cfg, model, data_dict):
+    '''Replace rgbnet by a smaller MLP (args.distill_width, args.distill_depth) distilled from it.
+    The grids are frozen; the student is fit to the colors of the teacher at the ray samples of
+    the training rays, weighted by their rendering weights. The test views (every
+    args.distill_testskip-th) are rendered w/ both MLPs to report the PSNR and the MLP time.
+    '''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    HW, Ks, near, far, i_train, i_test, poses, images = [
+        data_dict[k] for k in ['HW', 'Ks', 'near', 'far', 'i_train', 'i_test', 'poses', 'images']]
+    render_kwargs = build_render_kwargs(cfg, near, far, stepsize=cfg.fine_model_and_render.stepsize, render_depth=True)
+    importance, model.importance = model.importance, None
+    model.requires_grad_(False)
+
+    # render the test views w/ the teacher and the student
+    i_test = i_test[::args.distill_testskip]
+    distill_dir = os.path.join(cfg.basedir, cfg.expname, 'distill')
+    def evaluate(name):
+        savedir = os.path.join(distill_dir, name)
+        os.makedirs(savedir, exist_ok=True)
+        render_viewpoints(
+                model, poses[i_test], HW[i_test], Ks[i_test], cfg.data.ndc, render_kwargs,
+                gt_imgs=[images[i].cpu().numpy() for i in i_test], savedir=savedir,
+                mem_budget=args.render_mem_budget, time_mlp=True)
+        psnr, _, _, _, _, test_time, mlp_time = np.loadtxt(os.path.join(savedir, 'mean.txt'))
+        rgbnet_bytes = sum(p.numel() * 2 for p in model.rgbnet.parameters())
+        return psnr, test_time, mlp_time, rgbnet_bytes
+
+    teacher = model.rgbnet
+    teacher_width, teacher_depth = model.rgbnet_kwargs['rgbnet_width'], model.rgbnet_kwargs['rgbnet_depth']
+    teacher_eval = evaluate('teacher')
+    model.set_rgbnet(args.distill_width, args.distill_depth)
+    student = model.rgbnet
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.distill_lr)
+
+    if data_dict['irregular_shape']:
+        rgb_tr_ori = [images[i].to('cpu' if cfg.data.load2gpu_on_the_fly else device) for i in i_train]
+    else:
+        rgb_tr_ori = images[i_train].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
+    _, rays_o_tr, rays_d_tr, viewdirs_tr, _ = dvgo.get_training_rays_flatten(
+            rgb_tr_ori=rgb_tr_ori,
+            train_poses=poses[i_train],
+            HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    index_generator = dvgo.batch_indices_generator(len(rays_o_tr), cfg.fine_train.N_rand)
+
+    torch.cuda.empty_cache()
+    loss_lst = []
+    time0 = time.time()
+    decay_factor = 0.1 ** (1/args.distill_iters)
+    for global_step in trange(1, 1+args.distill_iters):
+        sel_i = next(index_generator)
+        rays_o = rays_o_tr[sel_i].to(device)
+        rays_d = rays_d_tr[sel_i].to(device)
+        viewdirs = viewdirs_tr[sel_i].to(device)
+
+        # the samples only depend on the frozen density, so both passes share them
+        with torch.no_grad():
+            model.rgbnet = teacher
+            target = model(rays_o, rays_d, viewdirs, **render_kwargs)
+        model.rgbnet = student
+        render_result = model(rays_o, rays_d, viewdirs, **render_kwargs)
+        optimizer.zero_grad(set_to_none=True)
+        loss = (target['weights'].unsqueeze(-1) * (render_result['raw_rgb'] - target['raw_rgb']).pow(2)).sum() / len(rays_o)
+        loss.backward()
+        optimizer.step()
+        loss_lst.append(loss.item())
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = param_group['lr'] * decay_factor
+
+        if global_step%args.i_print==0:
+            eps_time = time.time() - time0
+            eps_time_str = f'{eps_time//3600:02.0f}:{eps_time//60%60:02.0f}:{eps_time%60:02.0f}'
+            tqdm.write(f'distill_rgbnet: iter {global_step:6d} / '
+                       f'Loss: {np.mean(loss_lst):.9f} / '
+                       f'Eps: {eps_time_str}')
+            loss_lst = []
+
+    student.requires_grad_(False)
+    student_eval = evaluate('student')
+    model.importance = importance
+    (t_psnr, t_time, t_mlp, t_bytes), (s_psnr, s_time, s_mlp, s_bytes) = teacher_eval, student_eval
+    print(f'distill_rgbnet: rgbnet {teacher_width}x{teacher_depth} -> {args.distill_width}x{args.distill_depth}: '
+          f'psnr {t_psnr:.3f} -> {s_psnr:.3f} ({s_psnr-t_psnr:+.3f}) / '
+          f'mlp time {t_mlp:.3f} -> {s_mlp:.3f} sec ({t_mlp/max(s_mlp, 1e-9):.2f}x) / '
+          f'test time {t_time:.3f} -> {s_time:.3f} sec / '
+          f'rgbnet {t_bytes} -> {s_bytes} bytes (fp16)')
 
 
 def tensor_quantize(args, cfg, cfg_model, xyz_min, xyz_max, data_dict, stage, load_ckpt_path=None):
@@ -648,16 +871,8 @@ def tensor_quantize(args, cfg, cfg_model, xyz_min, xyz_max, data_dict, stage, lo
     render_viewpoints_kwargs = {
     'model': model,
     'ndc': cfg.data.ndc,
-    'render_kwargs': {
-        'near': data_dict['near'],
-        'far': data_dict['far'],
-        'bg': 1 if cfg.data.white_bkgd else 0,
-        'stepsize': stepsize,
-        'inverse_y': cfg.data.inverse_y,
-        'flip_x': cfg.data.flip_x,
-        'flip_y': cfg.data.flip_y,
-        'render_depth': True,
-        },
+    'render_kwargs': build_render_kwargs(
+        cfg, data_dict['near'], data_dict['far'], stepsize=stepsize, render_depth=True),
     }      
     importance_savedir = os.path.join(cfg.basedir, cfg.expname)
     init_importance(
@@ -665,11 +880,46 @@ def tensor_quantize(args, cfg, cfg_model, xyz_min, xyz_max, data_dict, stage, lo
         HW=data_dict['HW'][data_dict['i_train']],
         Ks=data_dict['Ks'][data_dict['i_train']],
         savedir=importance_savedir,if_final=True,
+        mem_budget=args.render_mem_budget,
         **render_viewpoints_kwargs)
 
     #=================== Apply final voxel pruning and tensor quantize  ====================
-    model.quantize_reformat(args.importance_final, args.if_quantize,
-                                    save_path=os.path.join(cfg.basedir, cfg.expname))
+    thres = args.importance_final
+    if args.target_size > 0 or args.target_voxels > 0:
+        thres = model.search_prune_thres(
+                target_size=args.target_size if args.target_size > 0 else None,
+                target_voxels=args.target_voxels if args.target_voxels > 0 else None,
+                bits=args.quant_bits, quant_mode=args.quant_mode, block_size=args.quant_block)
+    qat = args.qat_iters > 0 and args.if_quantize
+    if qat or args.distill_iters > 0:
+        # prune before fine-tuning the kept voxels or distilling the rgbnet on them
+        model.quantize_reformat(thres, False)
+        model.update_occupancy_cache(global_step=-1, cur_thres=1)
+    if qat:
+        # fine-tune the kept voxels through the quantization before encoding them
+        quantization_aware_finetune(args, cfg, model, data_dict, model.non_prune_mask)
+    if args.distill_iters > 0:
+        # the smaller rgbnet is saved w/ the compressed scene
+        distill_rgbnet(args, cfg, model, data_dict)
+    model.quantize_reformat(thres, args.if_quantize,
+                                    save_path=os.path.join(cfg.basedir, cfg.expname),
+                                    render_kwargs=render_viewpoints_kwargs['render_kwargs'],
+                                    bits=args.quant_bits, quant_mode=args.quant_mode, block_size=args.quant_block,
+                                    layout=args.layout, brick_size=args.brick_size)
+    if args.target_size > 0:
+        savedir = os.path.join(cfg.basedir, cfg.expname, 'extreme_saving')
+        size = sum(os.path.getsize(os.path.join(savedir, f)) for f in os.listdir(savedir))
+        print(f'scene_rep_reconstruction ({stage}): compressed size {size} bytes (target {args.target_size:.0f} bytes)')
+    if args.lod_levels > 0:
+        # the LOD bitstream w/ the metadata and rgbnet needed to render any of its prefixes
+        lod_dir = os.path.join(cfg.basedir, cfg.expname, 'lod')
+        os.makedirs(lod_dir, exist_ok=True)
+        for name in ['metadata.npz', 'rgbnet.npz']:
+            shutil.copy(os.path.join(cfg.basedir, cfg.expname, 'extreme_saving', name), lod_dir)
+        grids = {'density': model.density.grid[0].cpu().numpy(), 'k0': model.k0.grid[0].cpu().numpy()}
+        level_bytes = lod.encode_lod(lod_dir, grids, model.non_prune_mask.reshape(model.world_size.tolist()).cpu().numpy(),
+                                     bits=args.quant_bits, n_levels=args.lod_levels)
+        print(f'scene_rep_reconstruction ({stage}): LOD bytes per level (coarse first) {level_bytes}')
     model.update_occupancy_cache(global_step=-1, cur_thres=1)
         
     torch.save({
@@ -690,27 +940,37 @@ def train(args, cfg, data_dict):
             file.write('{} = {}\n'.format(arg, attr))
     cfg.dump(os.path.join(cfg.basedir, cfg.expname, 'config.py'))
 
+    # each stage is reused while its inputs and upstream stages are unchanged
+    pipeline = Pipeline(os.path.join(cfg.basedir, cfg.expname), force=args.force_stages)
+    data_inputs = {'data': cfg.data, 'seed': args.seed}
+
     # coarse geometry searching (only works for inward bounded scenes)
     eps_coarse = time.time()
     xyz_min_coarse, xyz_max_coarse = compute_bbox_by_cam_frustrm(args=args, cfg=cfg, **data_dict)
-    if not os.path.exists(os.path.join(cfg.basedir, cfg.expname, f'corse_last.tar')):
-        if cfg.coarse_train.N_iters > 0:
-            coarse_n_mask, coarse_true_mask = scene_rep_reconstruction(
+    if cfg.coarse_train.N_iters > 0:
+        coarse_n_mask, coarse_true_mask = pipeline.run(
+                'coarse',
+                lambda: scene_rep_reconstruction(
                     args=args, cfg=cfg,
                     cfg_model=cfg.coarse_model_and_render, cfg_train=cfg.coarse_train,
                     xyz_min=xyz_min_coarse, xyz_max=xyz_max_coarse,
-                    data_dict=data_dict, stage='coarse')
-            eps_coarse = time.time() - eps_coarse
-            eps_time_str = f'{eps_coarse//3600:02.0f}:{eps_coarse//60%60:02.0f}:{eps_coarse%60:02.0f}'
-            coarse_time = eps_time_str[:]
-            print('train: coarse geometry searching in', eps_time_str)
-            coarse_ckpt_path = os.path.join(cfg.basedir, cfg.expname, f'coarse_last.tar')
-        else:
-            print('train: skip coarse geometry searching')
-            coarse_ckpt_path = None
-            coarse_time = 0
-            coarse_n_mask = None
-            coarse_true_mask = None
+                    data_dict=data_dict, stage='coarse'),
+                inputs=dict(data_inputs, model=cfg.coarse_model_and_render, train=cfg.coarse_train,
+                            xyz_min=xyz_min_coarse, xyz_max=xyz_max_coarse),
+                artifacts=['coarse_last.tar']) or (None, None)
+        eps_coarse = time.time() - eps_coarse
+        eps_time_str = f'{eps_coarse//3600:02.0f}:{eps_coarse//60%60:02.0f}:{eps_coarse%60:02.0f}'
+        coarse_time = eps_time_str[:]
+        print('train: coarse geometry searching in', eps_time_str)
+        coarse_ckpt_path = os.path.join(cfg.basedir, cfg.expname, f'coarse_last.tar')
+        coarse_deps = ['coarse']
+    else:
+        print('train: skip coarse geometry searching')
+        coarse_ckpt_path = None
+        coarse_time = 0
+        coarse_n_mask = None
+        coarse_true_mask = None
+        coarse_deps = []
 
     # fine detail reconstruction
     eps_fine = time.time()
@@ -720,34 +980,48 @@ def train(args, cfg, data_dict):
         xyz_min_fine, xyz_max_fine = compute_bbox_by_coarse_geo(
                 model_class=dvgo.DirectVoxGO, model_path=coarse_ckpt_path,
                 thres=cfg.fine_model_and_render.bbox_thres)
-    if not os.path.exists(os.path.join(cfg.basedir, cfg.expname, f'fine_last.tar')):
-        cfg.fine_train.update(dict(
-            cur_thres = args.importance_prune,
-        ))
-        fine_n_mask, fine_true_mask = scene_rep_reconstruction(
+    cfg.fine_train.update(dict(
+        cur_thres = args.importance_prune,
+    ))
+    fine_n_mask, fine_true_mask = pipeline.run(
+            'fine',
+            lambda: scene_rep_reconstruction(
                 args=args, cfg=cfg,
                 cfg_model=cfg.fine_model_and_render, cfg_train=cfg.fine_train,
                 xyz_min=xyz_min_fine, xyz_max=xyz_max_fine,
                 data_dict=data_dict, stage='fine',
-                coarse_ckpt_path=coarse_ckpt_path)
-        eps_fine = time.time() - eps_fine
-        eps_time_str = f'{eps_fine//3600:02.0f}:{eps_fine//60%60:02.0f}:{eps_fine%60:02.0f}'
-        fine_time = eps_time_str[:]
-        print('train: fine detail reconstruction in', eps_time_str)
-    else:
-        print('train: skip fine optimization')
-        fine_time = 0
-        fine_n_mask = None
-        fine_true_mask = None
-    
+                coarse_ckpt_path=coarse_ckpt_path),
+            inputs=dict(data_inputs, model=cfg.fine_model_and_render, train=cfg.fine_train,
+                        xyz_min=xyz_min_fine, xyz_max=xyz_max_fine),
+            artifacts=['fine_last.tar', 'importance.pth'],
+            deps=coarse_deps) or (None, None)
+    eps_fine = time.time() - eps_fine
+    eps_time_str = f'{eps_fine//3600:02.0f}:{eps_fine//60%60:02.0f}:{eps_fine%60:02.0f}'
+    fine_time = eps_time_str[:]
+    print('train: fine detail reconstruction in', eps_time_str)
+
     ## quantize and saving
     eps_non_vq = time.time()
-    tensor_quantize(
-        args=args, cfg=cfg,
-        cfg_model=cfg.vq_model_and_render, 
-        xyz_min=xyz_min_fine, xyz_max=xyz_max_fine,
-        data_dict=data_dict, stage='vq',
-        load_ckpt_path=os.path.join(cfg.basedir, cfg.expname, f'fine_last.tar'))
+    pipeline.run(
+            'vq',
+            lambda: tensor_quantize(
+                args=args, cfg=cfg,
+                cfg_model=cfg.vq_model_and_render,
+                xyz_min=xyz_min_fine, xyz_max=xyz_max_fine,
+                data_dict=data_dict, stage='vq',
+                load_ckpt_path=os.path.join(cfg.basedir, cfg.expname, f'fine_last.tar')),
+            inputs=dict(data_inputs, model=cfg.vq_model_and_render,
+                        stepsize=cfg.fine_model_and_render.stepsize,
+                        importance_final=args.importance_final, if_quantize=args.if_quantize,
+                        target_size=args.target_size, target_voxels=args.target_voxels,
+                        quant_mode=args.quant_mode, quant_bits=args.quant_bits, quant_block=args.quant_block,
+                        layout=args.layout, brick_size=args.brick_size, lod_levels=args.lod_levels,
+                        qat_iters=args.qat_iters, qat_lr_scale=args.qat_lr_scale, qat_refit_every=args.qat_refit_every,
+                        distill_iters=args.distill_iters, distill_width=args.distill_width,
+                        distill_depth=args.distill_depth, distill_lr=args.distill_lr,
+                        distill_testskip=args.distill_testskip),
+            artifacts=['vq_last.tar', 'importance_final.pth', 'extreme_saving', 'extreme_saving.zip', 'lod', 'distill'],
+            deps=['fine'])
     eps_vq = time.time() - eps_non_vq
     vq_time = f'{eps_vq//3600:02.0f}:{eps_vq//60%60:02.0f}:{eps_vq%60:02.0f}'
     print('train: fine quantization in', vq_time)
@@ -765,7 +1039,7 @@ def train(args, cfg, data_dict):
         file.write('train: vector quantization in {}\n'.format(vq_time))
         file.write('train: finish in {}\n'.format(eps_time_str))
 
-def init_importance(model, render_poses, HW, Ks, ndc, render_kwargs, savedir=None, if_final=False, render_factor=0, ):
+def init_importance(model, render_poses, HW, Ks, ndc, render_kwargs, savedir=None, if_final=False, render_factor=0, mem_budget=0):
     '''Render images for the given viewpoints; run evaluation if gt given.
     '''
     if if_final:
@@ -786,6 +1060,7 @@ def init_importance(model, render_poses, HW, Ks, ndc, render_kwargs, savedir=Non
    
     pseudo_grid = torch.ones_like(model.density.grid)
     pseudo_grid.requires_grad = True
+    planner = ChunkPlanner(model, mem_budget) if mem_budget > 0 else None
     for i, c2w in enumerate(tqdm(render_poses)):
 
         H, W = HW[i]
@@ -793,19 +1068,25 @@ def init_importance(model, render_poses, HW, Ks, ndc, render_kwargs, savedir=Non
         c2w = torch.Tensor(c2w)
         rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
                 H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+                flip_x=render_kwargs['flip_x'], flip_y=render_kwargs['flip_y'])
         rays_o = rays_o.flatten(0,-2)
         rays_d = rays_d.flatten(0,-2)
         viewdirs = viewdirs.flatten(0,-2)
       
+        if planner is not None:
+            chunks = planner.split(rays_o, rays_d, viewdirs, render_kwargs)
+        else:
+            chunks = zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
         i = 0
-        for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0)):
+        for ro, rd, vd in chunks:
             ret = model.forward_imp(ro, rd, vd, pseudo_grid, **render_kwargs)
 
             if (ret['weights'].size(0) !=0) and (ret['sampled_pseudo_grid'].size(0) !=0):
                 (ret['weights'].detach()*ret['sampled_pseudo_grid']).sum().backward()
             i += 1
 
+    if planner is not None:
+        planner.summary()
     model.importance = pseudo_grid.grad.clone()
     model.density.grid.grad = None
     torch.save(model.importance, imp_path)
@@ -818,6 +1099,8 @@ if __name__=='__main__':
     parser = config_parser()
     args = parser.parse_args()
     cfg = mmengine.Config.fromfile(args.config)
+    assert args.shell_band <= 0 or select_model_class(cfg.data) is dvgo.DirectVoxGO, \
+            '--shell_band is only supported by DirectVoxGO (not the ndc or unbounded_inward configs)'
 
     # init enviroment
     if torch.cuda.is_available():
@@ -838,14 +1121,13 @@ if __name__=='__main__':
         near, far = data_dict['near'], data_dict['far']
         if data_dict['near_clip'] is not None:
             near = data_dict['near_clip']
+        rays_o, rays_d, viewdirs = dvgo.get_corner_rays_of_views(
+                HW[i_train], Ks[i_train], poses[i_train], cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,)
         cam_lst = []
-        for c2w, (H, W), K in zip(poses[i_train], HW[i_train], Ks[i_train]):
-            rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                    H, W, K, c2w, cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                    flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,)
-            cam_o = rays_o[0,0].cpu().numpy()
-            cam_d = rays_d[[0,0,-1,-1],[0,-1,0,-1]].cpu().numpy()
-            cam_lst.append(np.array([cam_o, *(cam_o+cam_d*max(near, far*0.05))]))
+        for ro, rd in zip(rays_o.cpu().numpy(), rays_d.cpu().numpy()):
+            cam_o = ro[0]
+            cam_lst.append(np.array([cam_o, *(cam_o+rd*max(near, far*0.05))]))
         np.savez_compressed(args.export_bbox_and_cams_only,
             xyz_min=xyz_min.cpu().numpy(), xyz_max=xyz_max.cpu().numpy(),
             cam_lst=np.array(cam_lst))
@@ -872,12 +1154,7 @@ if __name__=='__main__':
         ckpt_path_fine = os.path.join(cfg.basedir, cfg.expname, 'fine_last.tar')
         if args.if_quantize:
             ckpt_path_vq = os.path.join(cfg.basedir, cfg.expname, 'vq_last.tar')
-        if cfg.data.ndc:
-            model_class = dmpigo.DirectMPIGO
-        elif cfg.data.unbounded_inward:
-            model_class = dcvgo.DirectContractedVoxGO
-        else:
-            model_class = dvgo.DirectVoxGO
+        model_class = select_model_class(cfg.data)
         
         model_fine = utils.load_model(model_class, ckpt_path_fine).to(device)
         if args.if_quantize:
@@ -886,31 +1163,25 @@ if __name__=='__main__':
         fine_render_viewpoints_kwargs = {
             'model': model_fine,
             'ndc': cfg.data.ndc,
-            'render_kwargs': {
-                'near': data_dict['near'],
-                'far': data_dict['far'],
-                'bg': 1 if cfg.data.white_bkgd else 0,
-                'stepsize': stepsize,
-                'inverse_y': cfg.data.inverse_y,
-                'flip_x': cfg.data.flip_x,
-                'flip_y': cfg.data.flip_y,
-                'render_depth': True,
-            },
+            'render_workers': args.render_workers,
+            'render_threads': args.render_threads,
+            'mem_budget': args.render_mem_budget,
+            'render_kwargs': build_render_kwargs(
+                cfg, data_dict['near'], data_dict['far'], stepsize=stepsize, render_depth=True,
+                shell_band=args.shell_band, shell_coarse_step=args.shell_coarse_step,
+                deferred_shading=args.render_deferred or cfg.fine_model_and_render.get('deferred_shading', False)),
         }
         if args.if_quantize:
             vq_render_viewpoints_kwargs = {
                 'model': model_vq,
                 'ndc': cfg.data.ndc,
-                'render_kwargs': {
-                    'near': data_dict['near'],
-                    'far': data_dict['far'],
-                    'bg': 1 if cfg.data.white_bkgd else 0,
-                    'stepsize': stepsize,
-                    'inverse_y': cfg.data.inverse_y,
-                    'flip_x': cfg.data.flip_x,
-                    'flip_y': cfg.data.flip_y,
-                    'render_depth': True,
-                },
+                'render_workers': args.render_workers,
+                'render_threads': args.render_threads,
+                'mem_budget': args.render_mem_budget,
+                'render_kwargs': build_render_kwargs(
+                    cfg, data_dict['near'], data_dict['far'], stepsize=stepsize, render_depth=True,
+                    shell_band=args.shell_band, shell_coarse_step=args.shell_coarse_step,
+                    deferred_shading=args.render_deferred or cfg.vq_model_and_render.get('deferred_shading', False)),
             }
 
         model_fine.eval()
@@ -930,6 +1201,13 @@ if __name__=='__main__':
 
     # render trainset and eval
     if args.render_train:
+        shared = [{}, {}]
+        if args.render_shared and args.render_fine and args.if_quantize:
+            shared = render_viewpoints_shared(
+                    [fine_render_viewpoints_kwargs, vq_render_viewpoints_kwargs],
+                    render_poses=data_dict['poses'][data_dict['i_train']],
+                    HW=data_dict['HW'][data_dict['i_train']],
+                    Ks=data_dict['Ks'][data_dict['i_train']])
         if args.render_fine:
             testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_train_fine_last')
             os.makedirs(testsavedir, exist_ok=True)
@@ -941,7 +1219,7 @@ if __name__=='__main__':
                     gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
                     savedir=testsavedir, dump_images=args.dump_images,
                     eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
-                    **fine_render_viewpoints_kwargs)
+                    **fine_render_viewpoints_kwargs, **shared[0])
             imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
             imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
@@ -955,12 +1233,19 @@ if __name__=='__main__':
                 gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
                 savedir=testsavedir, dump_images=args.dump_images,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
-                **vq_render_viewpoints_kwargs)
+                **vq_render_viewpoints_kwargs, **shared[1])
         imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
         imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
     # render testset and eval
     if args.render_test:
+        shared = [{}, {}]
+        if args.render_shared and args.render_fine and args.if_quantize:
+            shared = render_viewpoints_shared(
+                    [fine_render_viewpoints_kwargs, vq_render_viewpoints_kwargs],
+                    render_poses=data_dict['poses'][data_dict['i_test']],
+                    HW=data_dict['HW'][data_dict['i_test']],
+                    Ks=data_dict['Ks'][data_dict['i_test']])
         if args.render_fine:
             testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_test_fine_last')
             os.makedirs(testsavedir, exist_ok=True)
@@ -972,7 +1257,7 @@ if __name__=='__main__':
                     gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
                     savedir=testsavedir, dump_images=args.dump_images,
                     eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
-                    **fine_render_viewpoints_kwargs)
+                    **fine_render_viewpoints_kwargs, **shared[0])
             imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
             imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
@@ -987,12 +1272,20 @@ if __name__=='__main__':
                     gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
                     savedir=testsavedir, dump_images=args.dump_images,
                     eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
-                    **vq_render_viewpoints_kwargs)
+                    **vq_render_viewpoints_kwargs, **shared[1])
             imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
             imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
     # render video
     if args.render_video:
+        shared = [{}, {}]
+        if args.render_shared and args.render_fine and args.if_quantize:
+            shared = render_viewpoints_shared(
+                    [fine_render_viewpoints_kwargs, vq_render_viewpoints_kwargs],
+                    render_poses=data_dict['render_poses'],
+                    HW=data_dict['HW'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
+                    Ks=data_dict['Ks'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
+                    render_factor=args.render_video_factor)
         if args.render_fine:
             testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_video_fine_last')
             os.makedirs(testsavedir, exist_ok=True)
@@ -1005,7 +1298,7 @@ if __name__=='__main__':
                     render_video_flipy=args.render_video_flipy,
                     render_video_rot90=args.render_video_rot90,
                     savedir=testsavedir, dump_images=args.dump_images,
-                    **fine_render_viewpoints_kwargs)
+                    **fine_render_viewpoints_kwargs, **shared[0])
             imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
             import matplotlib.pyplot as plt
             depths_vis = depths * (1-bgmaps) + bgmaps
@@ -1025,7 +1318,7 @@ if __name__=='__main__':
                     render_video_flipy=args.render_video_flipy,
                     render_video_rot90=args.render_video_rot90,
                     savedir=testsavedir, dump_images=args.dump_images,
-                    **vq_render_viewpoints_kwargs)
+                    **vq_render_viewpoints_kwargs, **shared[1])
             imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
             import matplotlib.pyplot as plt
             depths_vis = depths * (1-bgmaps) + bgmaps
@@ -10,6 +10,7 @@ import torch
 
 from lib import utils, dvgo, dcvgo, dmpigo
 from lib.load_data import load_data
+from lib.renderer import Renderer, ChunkPlanner, select_model_class, build_render_kwargs, load_vqdvgo, load_lod
 
 import math
 
@@ -46,6 +47,28 @@ def config_parser():
     parser.add_argument("--eval_ssim", action='store_true')
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
+    parser.add_argument("--render_workers", type=int, default=0,
+                        help='render the views on cpu with this many worker processes (0 to disable)')
+    parser.add_argument("--render_threads", type=int, default=1,
+                        help='number of torch threads of each render worker')
+    parser.add_argument("--render_mem_budget", type=float, default=0,
+                        help='memory budget (MB) of the adaptive ray chunks (0 to use fixed chunks of 8192 rays)')
+    parser.add_argument("--shell_band", type=float, default=0,
+                        help='render with two-pass shell-guided sampling, only sampling this many voxels around the first shell crossing (0 to disable, DirectVoxGO only)')
+    parser.add_argument("--shell_coarse_step", type=float, default=4,
+                        help='stepsize multiplier of the coarse pass in shell-guided sampling')
+    parser.add_argument("--render_deferred", action='store_true',
+                        help='render with deferred shading (run the colors MLP once per ray)')
+    parser.add_argument("--alpha_cache", type=str, default='', choices=['', 'float32', 'float16', 'uint8'],
+                        help='precompute the activated alpha grid in the given precision for rendering')
+    parser.add_argument("--bake_rgbnet", action='store_true',
+                        help='bake the first rgbnet layer into the feature grid for cheaper shading')
+    parser.add_argument("--bake_half", action='store_true',
+                        help='store the baked features in float16')
+    parser.add_argument("--bake_sh", type=int, default=-1,
+                        help='distill k0 + rgbnet into per-voxel SH colors of this degree (<= 3), -1 to disable')
+    parser.add_argument("--lod_bytes", type=int, default=-1,
+                        help='load the first lod_bytes of the LOD bitstream (basedir/expname/lod) instead of extreme_saving (0 for all of it)')
     
     # logging/saving options
     parser.add_argument("--i_print",   type=int, default=500,
@@ -59,7 +82,8 @@ def config_parser():
 def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, dump_images=False,
                       render_factor=0, render_video_flipy=False, render_video_rot90=0,
-                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, voxels=None):
+                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False,
+                      render_workers=0, render_threads=1, mem_budget=0, voxels=None):
     '''Render images for the given viewpoints; run evaluation if gt given.
     '''
     assert len(render_poses) == len(HW) and len(HW) == len(Ks)
@@ -78,27 +102,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     lpips_alex = []
     lpips_vgg = []
     eps_time = time.time()
+    renderer = Renderer(model, render_kwargs, ndc=ndc)
+    if mem_budget > 0:
+        renderer.planner = ChunkPlanner(model, mem_budget)
+    if render_workers > 0:
+        rendered = renderer.render_parallel(render_poses, HW, Ks, render_workers, render_threads)
 
     for i, c2w in enumerate(tqdm(render_poses)):
 
         H, W = HW[i]
         K = Ks[i]
         c2w = torch.Tensor(c2w)
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        keys = ['rgb_marched', 'depth', 'alphainv_last']
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
-        render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
-        ]
-        render_result = {
-            k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
-            for k in render_result_chunks[0].keys()
-        }
+        if render_workers > 0:
+            render_result = {k: torch.from_numpy(v[i]) for k, v in rendered.items()}
+        else:
+            render_result = renderer.render_view(c2w, H, W, K)
         rgb = render_result['rgb_marched'].cpu().numpy()
         depth = render_result['depth'].cpu().numpy()
         bgmap = render_result['alphainv_last'].cpu().numpy()
@@ -120,6 +138,8 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
                 lpips_vgg.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
 
     test_eps = time.time() - eps_time
+    if renderer.planner is not None:
+        renderer.planner.summary()
 
     if len(psnrs):
         print('Testing psnr', np.mean(psnrs), '(avg)')
@@ -196,33 +216,31 @@ def load_everything(args, cfg):
 
 
 def _compute_bbox_by_cam_frustrm_bounded(cfg, HW, Ks, poses, i_train, near, far):
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        if cfg.data.ndc:
-            pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far])
-        else:
-            pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
-        xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2)))
-        xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2)))
+    # Only the corner rays of each view are needed: the near/far cross-sections of a
+    # frustum are convex quads, or spherical quads whose extremes get_frustum_extreme_dirs gives
+    rays_o, rays_d, viewdirs = dvgo.get_corner_rays_of_views(
+            HW=HW[i_train], Ks=Ks[i_train], c2ws=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    if cfg.data.ndc:
+        pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far]).flatten(0,-2)
+    else:
+        dirs, valid = dvgo.get_frustum_extreme_dirs(viewdirs)
+        cam_o = rays_o[:,:1].expand(dirs.shape)
+        pts_nf = torch.cat([(cam_o+dirs*near)[valid], (cam_o+dirs*far)[valid]])
+    xyz_min = pts_nf.amin(0)
+    xyz_max = pts_nf.amax(0)
     return xyz_min, xyz_max
 
 def _compute_bbox_by_cam_frustrm_unbounded(cfg, HW, Ks, poses, i_train, near_clip):
     # Find a tightest cube that cover all camera centers
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        pts = rays_o + rays_d * near_clip
-        xyz_min = torch.minimum(xyz_min, pts.amin((0,1)))
-        xyz_max = torch.maximum(xyz_max, pts.amax((0,1)))
+    rays_o, rays_d, viewdirs = dvgo.get_corner_rays_of_views(
+            HW=HW[i_train], Ks=Ks[i_train], c2ws=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    pts = (rays_o + rays_d * near_clip).flatten(0,-2)
+    xyz_min = pts.amin(0)
+    xyz_max = pts.amax(0)
     center = (xyz_min + xyz_max) * 0.5
     radius = (center - xyz_min).max() * cfg.data.unbounded_inner_r
     xyz_min = center - radius
@@ -303,58 +321,14 @@ def bin2dec(b, bits):
     mask = 2 ** torch.arange(bits - 1, -1, -1).to(b.device, b.dtype)
     return torch.sum(mask * b, -1)
 
-def load_vqdvgo(path, device='cuda'):
-    def load_f(name, allow_pickle=False,array_name='arr_0'):
-        return np.load(os.path.join(path,name),allow_pickle=allow_pickle)[array_name]
-
-    metadata = load_f('metadata.npz',allow_pickle=True,array_name='metadata')
-    metadata = metadata.item()
-
-    ## prepare needed model kwargs 
-    grid_dequant = metadata.pop('grid_dequant')
-    density_dequant = metadata.pop('density_dequant')
-    model_kwargs = metadata['model_kwargs']
-    k0_dim  = model_kwargs['rgbnet_dim']
-    world_size = metadata['world_size'].cpu().numpy().tolist()
-    max_elements = metadata['world_size'].prod().item()
-
-    ## loading the masks  
-    non_prune_mask = load_f('non_prune_mask.npz') 
-    non_prune_mask = np.unpackbits(non_prune_mask)
-    non_prune_mask = non_prune_mask[:max_elements] #.reshape(world_size)
-    non_prune_mask = torch.from_numpy(non_prune_mask).bool().to(device)
-
-    ## loading the non-vq-feature and non-prune density
-    true_grid = load_f('non_prune_grid.npz')
-    true_density = load_f('non_prune_density.npz')
-
-    true_grid = (true_grid.astype(np.float32) - grid_dequant['zero_point'])*grid_dequant['scale']
-    true_density = (true_density.astype(np.float32) - density_dequant['zero_point'])*density_dequant['scale']
-
-    true_grid = torch.from_numpy(true_grid).float().to(device)
-    true_density = torch.from_numpy(true_density).float().to(device)
-
-    # build the actual feature and density grid
-    full_grid = torch.zeros(max_elements, k0_dim).to(device)
-    full_grid[non_prune_mask,:] = true_grid
-
-    full_density = torch.zeros(max_elements, 1).to(device) #- 99999
-    full_density[non_prune_mask,:] = true_density
-
-    mdoel_state_dict =  metadata['model_state_dict']
-    rgbnet_npz = load_f('rgbnet.npz',allow_pickle=True)
-    for k,v in rgbnet_npz.item().items():
-        mdoel_state_dict['rgbnet.'+k] =v.to(device)
-    mdoel_state_dict['k0.grid'] = full_grid.T.reshape(1,k0_dim,*world_size )
-    mdoel_state_dict['density.grid'] = full_density.reshape(1,1,*world_size)
-    return model_kwargs, mdoel_state_dict, torch.sum(non_prune_mask).cpu()
-
 if __name__=='__main__':
 
     # load setup
     parser = config_parser()
     args = parser.parse_args()
     cfg = mmengine.Config.fromfile(args.config)
+    assert args.shell_band <= 0 or select_model_class(cfg.data) is dvgo.DirectVoxGO, \
+            '--shell_band is only supported by DirectVoxGO (not the ndc or unbounded_inward configs)'
 
     # init enviroment
     if torch.cuda.is_available():
@@ -366,20 +340,26 @@ if __name__=='__main__':
 
     data_dict = load_everything(args=args, cfg=cfg)
 
-    if cfg.data.ndc:
-        model_class = dmpigo.DirectMPIGO
-    elif cfg.data.unbounded_inward:
-        model_class = dcvgo.DirectContractedVoxGO
+    model_class = select_model_class(cfg.data)
+    if args.lod_bytes >= 0:
+        ckpt_name = f'lod_{args.lod_bytes}'
+        model_kwargs, mdoel_state_dict,voxels = load_lod(os.path.join(cfg.basedir, cfg.expname,'lod'),device=device,
+                                                         n_bytes=args.lod_bytes or None)
     else:
-        model_class = dvgo.DirectVoxGO
-    ckpt_name = 'extreme_last'
-    model_kwargs, mdoel_state_dict,voxels = load_vqdvgo(os.path.join(cfg.basedir, cfg.expname,'extreme_saving'),device=device)
+        ckpt_name = 'extreme_last'
+        model_kwargs, mdoel_state_dict,voxels = load_vqdvgo(os.path.join(cfg.basedir, cfg.expname,'extreme_saving'),device=device)
     model_kwargs['mask_cache_path'] = None
     model = model_class(**model_kwargs)
     model.eval()
     model.load_state_dict(mdoel_state_dict, strict=False)
     
     model.to(device)
+    if args.bake_rgbnet:
+        model.bake_rgbnet(half=args.bake_half)
+    if args.bake_sh >= 0:
+        model.bake_sh(degree=args.bake_sh, half=args.bake_half)
+    if args.alpha_cache:
+        model.build_alpha_cache(cfg.fine_model_and_render.stepsize, dtype=getattr(torch, args.alpha_cache))
     # model.mask_cache.mask[:] = True
     # model.update_occupancy_cache(global_step=-1)
 
@@ -387,16 +367,13 @@ if __name__=='__main__':
     render_viewpoints_kwargs = {
         'model': model,
         'ndc': cfg.data.ndc,
-        'render_kwargs': {
-            'near': data_dict['near'],
-            'far': data_dict['far'],
-            'bg': 1 if cfg.data.white_bkgd else 0,
-            'stepsize': stepsize,
-            'inverse_y': cfg.data.inverse_y,
-            'flip_x': cfg.data.flip_x,
-            'flip_y': cfg.data.flip_y,
-            'render_depth': True,
-        },
+        'render_workers': args.render_workers,
+        'render_threads': args.render_threads,
+        'mem_budget': args.render_mem_budget,
+        'render_kwargs': build_render_kwargs(
+            cfg, data_dict['near'], data_dict['far'], stepsize=stepsize, render_depth=True,
+            shell_band=args.shell_band, shell_coarse_step=args.shell_coarse_step,
+            deferred_shading=args.render_deferred or cfg.fine_model_and_render.get('deferred_shading', False)),
     }
    
     # render trainset and eval
@@ -0,0 +1,214 @@
+'''Benchmark the trilinear interpolation of the feature grid.
+Compare a gather-based TrilinearIntepolation (and the codebook decode of a VQGrid) with the
+previous 8x grid_sample implementation of lib/grid.py and plain F.grid_sample.
+
+Example:
+    python tools/bench_interp.py --channels 12 --world_size 160 --n_pts 1000000
+'''
+import os, sys, time, argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import grid
+
+
+class LegacyTrilinearIntepolation(nn.Module):
+    '''The previous implementation of TrilinearIntepolation (lib/grid.py) for reference
+    (8 grid_sample + gather and 8 vq calls; the blending broadcast is fixed for channels > 1).'''
+
+    def sample_at_integer_locs(self, input_feats, index_tensor):
+        batch_size, num_chans, num_d, height, width = input_feats.shape
+        grid_height, grid_width = index_tensor.shape[1],index_tensor.shape[2]
+        xy_grid = index_tensor[..., 0:2]
+        xy_grid[..., 0] = xy_grid[..., 0] - ((width-1.0)/2.0)
+        xy_grid[..., 0] = xy_grid[..., 0] / ((width-1.0)/2.0)
+        xy_grid[..., 1] = xy_grid[..., 1] - ((height-1.0)/2.0)
+        xy_grid[..., 1] = xy_grid[..., 1] / ((height-1.0)/2.0)
+        xy_grid = torch.clamp(xy_grid, min=-1.0, max=1.0)
+        sampled_in_2d = F.grid_sample(input=input_feats.view(batch_size, num_chans*num_d, height, width),
+                                        grid=xy_grid, mode='nearest').view(batch_size, num_chans, num_d, grid_height, grid_width)
+        z_grid = index_tensor[..., 2].view(batch_size, 1, 1, grid_height, grid_width)
+        z_grid = z_grid.long().clamp(min=0, max=num_d-1)
+        z_grid = z_grid.expand(batch_size,num_chans, 1, grid_height, grid_width)
+        sampled_in_3d = sampled_in_2d.gather(2, z_grid).squeeze(2)
+        return sampled_in_3d
+
+    def forward(self, input_feats, sampling_grid, vq):
+        batch_size, num_chans, num_d, height, width = input_feats.shape
+        grid_height, grid_width = sampling_grid.shape[1],sampling_grid.shape[2]
+        sampling_grid = torch.clamp(sampling_grid, min=-1.0, max=1.0)
+        sampling_grid = (sampling_grid+1)/2.0
+        scaling_factor = torch.FloatTensor([width-1.0, height-1.0, num_d-1.0]).to(input_feats.device).view(1, 1, 1, 3)
+        sampling_grid = scaling_factor*sampling_grid
+        x, y, z = torch.split(sampling_grid, split_size_or_sections=1, dim=3)
+        x_0, y_0, z_0 = torch.split(sampling_grid.floor(), split_size_or_sections=1, dim=3)
+        x_1, y_1, z_1 = x_0+1.0, y_0+1.0, z_0+1.0
+        u, v, w = x-x_0, y-y_0, z-z_0
+        u, v, w = map(lambda x:x.view(batch_size, 1, grid_height, grid_width).expand(
+                                    batch_size, num_chans, grid_height, grid_width),  [u, v, w])
+        c = {}
+        for i, xi in enumerate([x_0, x_1]):
+            for j, yj in enumerate([y_0, y_1]):
+                for k, zk in enumerate([z_0, z_1]):
+                    c_ijk = self.sample_at_integer_locs(input_feats, torch.cat([xi, yj, zk], dim=3))
+                    c[i,j,k] = vq(c_ijk.permute(0,2,3,1).flatten(1,2))[0].permute(0,2,1).reshape(c_ijk.shape)
+        c_xyz = 0
+        for (i, j, k), c_ijk in c.items():
+            c_xyz = c_xyz + (u if i else 1-u) * (v if j else 1-v) * (w if k else 1-w) * c_ijk
+        return c_xyz
+
+
+class TrilinearIntepolation(nn.Module):
+    """TrilinearIntepolation in PyTorch (the gather-based rewrite of LegacyTrilinearIntepolation).
+    The linear indices of the 8 corners are computed once, the corners are gathered by a
+    single index_select and blended in one vectorized pass. With `codebook` the input holds
+    the codebook index of each voxel and the corner features are looked up from the codebook
+    (see VQGrid); with `vq` the corner features are quantized by one call of vq.
+    """
+
+    def __init__(self):
+        super(TrilinearIntepolation, self).__init__()
+
+    def forward(self, input_feats, sampling_grid, vq=None, codebook=None, align_corners=True):
+        '''
+        input_feats:   [1,F,D,H,W] features, or the [1,1,D,H,W] codebook indices if codebook is given
+        sampling_grid: [B,H,W,3] normalized coordinates as in F.grid_sample
+        vq:            callable taking [1,M,F] features and returning the quantized ones as the first output
+        codebook:      [K,F] features of the codebook
+        align_corners: border padding w/ align_corners=True by default, zero padding w/ align_corners=False
+        Output: [1,F,H,W] the interpolated features
+        '''
+        assert input_feats.ndimension()==5 and input_feats.shape[0]==1, 'input_feats should be of shape [1,F,D,H,W]'
+        world_size = input_feats.shape[2:]
+        shape = sampling_grid.shape[:-1]
+        ind = (sampling_grid.reshape(-1,3).flip((-1,)) + 1) / 2
+        if align_corners:
+            ind = ind.clamp(0, 1)
+        corner_idx, corner_w = grid.trilinear_corners(
+                ind, 0, 1, world_size, align_corners=align_corners)
+        if codebook is not None:
+            code = input_feats.flatten().index_select(0, corner_idx.flatten()).long()
+            corner_feats = codebook.index_select(0, code).T
+        else:
+            corner_feats = input_feats.flatten(0,1).flatten(1).index_select(1, corner_idx.flatten())
+        if vq is not None:
+            corner_feats = vq(corner_feats.T.unsqueeze(0))[0].squeeze(0).T
+        out = (corner_feats.reshape(-1, *corner_w.shape) * corner_w).sum(-1)
+        return out.reshape(1, -1, *shape[1:])
+
+
+class VQGrid(nn.Module):
+    '''Vector-quantized 3D grid: a [K, channels] codebook and the codebook index of each voxel.
+    The query gathers the codebook indices of the 8 corners and decodes them from the codebook,
+    which matches grid.DenseGrid on the decoded dense grid. The compressed scenes store
+    affine-quantized values (lib/quant.py), so this grid only exists for the benchmark.
+    '''
+    def __init__(self, channels, world_size, xyz_min, xyz_max, codebook, code_index):
+        super(VQGrid, self).__init__()
+        self.channels = channels
+        self.world_size = world_size
+        self.register_buffer('xyz_min', torch.Tensor(xyz_min))
+        self.register_buffer('xyz_max', torch.Tensor(xyz_max))
+        self.register_buffer('codebook', codebook)
+        self.register_buffer('code_index', code_index)
+        self.trilinear_interpolation = TrilinearIntepolation()
+
+    @classmethod
+    def from_dense(cls, dense, xyz_min, xyz_max, codebook, chunk=65536):
+        '''Assign each voxel of a [1, channels, X, Y, Z] dense grid to its nearest code.'''
+        world_size = torch.LongTensor(list(dense.shape[2:]))
+        feat = dense[0].flatten(1).T
+        code_index = torch.cat([
+            torch.cdist(f, codebook).argmin(-1)
+            for f in feat.split(chunk)
+        ])
+        code_index = code_index.to(torch.int16 if len(codebook) <= 2**15 else torch.int32)
+        return cls(dense.shape[1], world_size, xyz_min, xyz_max, codebook, code_index.reshape(*world_size.tolist()))
+
+    def forward(self, xyz):
+        '''
+        xyz: global coordinates to query
+        '''
+        shape = xyz.shape[:-1]
+        xyz = xyz.reshape(1,1,-1,3)
+        ind_norm = ((xyz - self.xyz_min) / (self.xyz_max - self.xyz_min)).flip((-1,)) * 2 - 1
+        out = self.trilinear_interpolation(
+                self.code_index[None,None], ind_norm, codebook=self.codebook, align_corners=False)
+        out = out.reshape(self.channels,-1).T.reshape(*shape,self.channels)
+        if self.channels == 1:
+            out = out.squeeze(-1)
+        return out
+
+    def get_dense_grid(self):
+        return self.codebook[self.code_index.long()].permute(3,0,1,2).unsqueeze(0)
+
+    def extra_repr(self):
+        return f'channels={self.channels}, world_size={self.world_size.tolist()}, n_codes={len(self.codebook)}'
+
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--channels', type=int, default=12)
+    parser.add_argument('--world_size', type=int, default=160)
+    parser.add_argument('--n_pts', type=int, default=1000000)
+    parser.add_argument('--n_codes', type=int, default=4096)
+    parser.add_argument('--repeat', type=int, default=10)
+    return parser
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+@torch.no_grad()
+def bench(fn, repeat):
+    out = fn()  # warm up
+    sync()
+    eps_time = time.time()
+    for _ in range(repeat):
+        fn()
+    sync()
+    return out.reshape(out.shape[1], -1), (time.time() - eps_time) / repeat
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    C, S = args.channels, args.world_size
+    feats = torch.randn([1, C, S, S, S], device=device)
+    sampling_grid = torch.rand([1, 1, args.n_pts, 3], device=device) * 2 - 1
+    codebook = torch.randn([args.n_codes, C], device=device)
+    vq = lambda x: (codebook[torch.cdist(x[0], codebook).argmin(-1)][None],)
+    xyz_min, xyz_max = -torch.ones(3), torch.ones(3)
+    vq_grid = VQGrid.from_dense(feats, xyz_min, xyz_max, codebook).to(device)
+    decoded = vq_grid.get_dense_grid()
+    identity = lambda x: (x,)
+    legacy = LegacyTrilinearIntepolation()
+    gather = TrilinearIntepolation()
+
+    results = {
+        'grid_sample': bench(lambda: F.grid_sample(
+            feats, sampling_grid[None], mode='bilinear', padding_mode='border', align_corners=True), args.repeat),
+        'legacy': bench(lambda: legacy(feats, sampling_grid.clone(), identity), args.repeat),
+        'gather': bench(lambda: gather(feats, sampling_grid), args.repeat),
+        'legacy + vq': bench(lambda: legacy(feats, sampling_grid.clone(), vq), args.repeat),
+        'gather + vq': bench(lambda: gather(feats, sampling_grid, vq=vq), args.repeat),
+        'grid_sample (decoded)': bench(lambda: F.grid_sample(
+            decoded, sampling_grid[None], mode='bilinear', align_corners=False), args.repeat),
+        'VQGrid': bench(lambda: vq_grid(sampling_grid.flip((-1,)).reshape(-1,3)).T[None], args.repeat),
+    }
+    reference = {
+        'grid_sample': 'grid_sample', 'legacy': 'grid_sample', 'gather': 'grid_sample',
+        'legacy + vq': 'gather + vq', 'gather + vq': 'gather + vq',
+        'grid_sample (decoded)': 'grid_sample (decoded)', 'VQGrid': 'grid_sample (decoded)',
+    }
+    print(f'bench_interp: {args.n_pts} points on a {C}x{S}^3 grid ({device})')
+    print(f'{"method":>24s}{"ms":>12s}{"max abs diff":>16s}')
+    for k, (out, eps_time) in results.items():
+        diff = (out - results[reference[k]][0]).abs().max().item()
+        print(f'{k:>24s}{eps_time*1000:>12.2f}{diff:>16.2e}')
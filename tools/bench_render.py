@@ -0,0 +1,202 @@
+'''Benchmark rendering modes against the default forward.
+Render a subsampled test set of trained scenes with several rendering modes
+and report the PSNR, the time per frame and the size of the color representation
+(k0 + rgbnet, or the baked grids) of each mode.
+
+The shell mode is run once per --shell_band, tracing its quality-speed tradeoff.
+
+Example (the nerf_synthetic and BlendedMVS scenes):
+    python tools/bench_render.py --ckpt extreme_saving --modes base shell baked sh \
+        --shell_band 1 2 4 --configs configs/nerf/*.py configs/blendedmvs/*.py --out bench.csv
+'''
+import os, sys, time, argparse
+import numpy as np
+import mmengine
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import utils, dvgo
+from lib.load_data import load_data
+from lib.renderer import select_model_class, build_render_kwargs, load_vqdvgo
+
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--configs', nargs='+', required=True,
+                        help='config files of the trained scenes')
+    parser.add_argument('--ckpt', type=str, default='vq_last',
+                        help='checkpoint name under basedir/expname (extreme_saving for the compressed model)')
+    parser.add_argument('--modes', nargs='+', default=['base', 'shell'],
+                        help='rendering modes to benchmark: ' + ', '.join(MODES.keys()))
+    parser.add_argument('--testskip', type=int, default=8,
+                        help='render every testskip-th test view')
+    parser.add_argument('--chunk', type=int, default=8192)
+    parser.add_argument('--shell_band', type=float, nargs='+', default=[2],
+                        help='bands (in voxels) of the shell mode, one row per band')
+    parser.add_argument('--shell_coarse_step', type=float, default=4)
+    parser.add_argument('--bake_half', action='store_true')
+    parser.add_argument('--alpha_cache', type=str, default='uint8', choices=['float32', 'float16', 'uint8'],
+                        help='precision of the alpha_cache mode')
+    parser.add_argument('--sh_degree', type=int, default=2,
+                        help='SH degree of the sh mode (<= 3)')
+    parser.add_argument('--sh_dirs', type=int, default=128,
+                        help='number of directions the sh mode fits the rgbnet colors on')
+    parser.add_argument('--out', type=str, default='',
+                        help='save the result table to this csv file')
+    return parser
+
+
+''' Rendering modes
+Each mode takes the loaded model and the default render_kwargs and returns the
+(possibly modified) ones to render with.
+'''
+def mode_base(model, render_kwargs, args):
+    return model, render_kwargs
+
+def mode_shell(model, render_kwargs, args):
+    render_kwargs = dict(render_kwargs, shell_band=args.shell_band, shell_coarse_step=args.shell_coarse_step)
+    return model, render_kwargs
+
+def mode_baked(model, render_kwargs, args):
+    model.bake_rgbnet(half=args.bake_half)
+    return model, render_kwargs
+
+def mode_deferred(model, render_kwargs, args):
+    render_kwargs = dict(render_kwargs, deferred_shading=True)
+    return model, render_kwargs
+
+def mode_alpha_cache(model, render_kwargs, args):
+    model.build_alpha_cache(render_kwargs['stepsize'], dtype=getattr(torch, args.alpha_cache))
+    return model, render_kwargs
+
+def mode_sh(model, render_kwargs, args):
+    model.bake_sh(degree=args.sh_degree, n_dirs=args.sh_dirs, half=args.bake_half)
+    return model, render_kwargs
+
+MODES = {
+    'base': mode_base,
+    'shell': mode_shell,
+    'baked': mode_baked,
+    'deferred': mode_deferred,
+    'alpha_cache': mode_alpha_cache,
+    'sh': mode_sh,
+}
+
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def n_bytes(*tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def color_size(model):
+    '''MB of the color representation queried by the forward.'''
+    if getattr(model, 'sh_baked', None) is not None:
+        return n_bytes(model.sh_baked.feat, model.sh_baked.index) / 2**20
+    rgbnet_bytes = n_bytes(*model.rgbnet.parameters()) if model.rgbnet is not None else 0
+    if getattr(model, 'rgbnet_baked', None) is not None:
+        return (n_bytes(model.rgbnet_baked.feat, model.rgbnet_baked.index) + rgbnet_bytes) / 2**20
+    return (n_bytes(*model.k0.parameters()) + rgbnet_bytes) / 2**20
+
+def n_allocs():
+    if torch.cuda.is_available():
+        return torch.cuda.memory_stats().get('allocation.all.allocated', 0)
+    return 0
+
+@torch.no_grad()
+def render_views(model, cfg, render_kwargs, poses, HW, Ks, chunk):
+    rgbs = []
+    for c2w, (H, W), K in zip(poses, HW, Ks):
+        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
+                H, W, K, torch.Tensor(c2w), cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+        rgb = torch.cat([
+            model(ro, rd, vd, **render_kwargs)['rgb_marched']
+            for ro, rd, vd in zip(rays_o.flatten(0,-2).split(chunk), rays_d.flatten(0,-2).split(chunk),
+                                  viewdirs.flatten(0,-2).split(chunk))
+        ]).reshape(H,W,3)
+        rgbs.append(rgb.cpu().numpy())
+    return rgbs
+
+def load_model(model_class, ckpt_path, device):
+    if os.path.basename(ckpt_path) == 'extreme_saving.tar':
+        model_kwargs, model_state_dict, _ = load_vqdvgo(ckpt_path[:-len('.tar')], device=device)
+        model_kwargs['mask_cache_path'] = None
+        model = model_class(**model_kwargs)
+        model.load_state_dict(model_state_dict, strict=False)
+    else:
+        model = utils.load_model(model_class, ckpt_path)
+    return model.to(device)
+
+def bench_scene(config, args, device):
+    cfg = mmengine.Config.fromfile(config)
+    data_dict = load_data(cfg.data)
+    i_test = data_dict['i_test'][::args.testskip]
+    poses = data_dict['poses'][i_test]
+    HW = data_dict['HW'][i_test]
+    Ks = data_dict['Ks'][i_test]
+    gt_imgs = [data_dict['images'][i] for i in i_test]
+
+    model_class = select_model_class(cfg.data)
+    ckpt_path = os.path.join(cfg.basedir, cfg.expname, f'{args.ckpt}.tar')
+    default_render_kwargs = build_render_kwargs(cfg, data_dict['near'], data_dict['far'])
+
+    runs = []
+    for mode in args.modes:
+        if mode == 'shell':
+            runs.extend((f'shell{band:g}', mode, argparse.Namespace(**dict(vars(args), shell_band=band)))
+                        for band in args.shell_band)
+        else:
+            runs.append((mode, mode, args))
+
+    rows = []
+    for label, mode, mode_args in runs:
+        model = load_model(model_class, ckpt_path, device)
+        model.eval()
+        model, render_kwargs = MODES[mode](model, dict(default_render_kwargs), mode_args)
+        render_views(model, cfg, render_kwargs, poses[:1], HW[:1], Ks[:1], args.chunk)  # warm up
+        sync()
+        allocs = n_allocs()
+        eps_time = time.time()
+        rgbs = render_views(model, cfg, render_kwargs, poses, HW, Ks, args.chunk)
+        sync()
+        eps_time = (time.time() - eps_time) / len(rgbs)
+        allocs = (n_allocs() - allocs) / len(rgbs)
+        psnr = np.mean([-10. * np.log10(np.mean(np.square(rgb - gt))) for rgb, gt in zip(rgbs, gt_imgs)])
+        size = color_size(model)
+        rows.append([cfg.expname, label, psnr, eps_time, allocs, size])
+        print(f'bench_render: {cfg.expname} {label:>8s} psnr {psnr:6.3f} / {eps_time:7.4f} sec / {allocs:.0f} allocations per frame / '
+              f'color {size:.2f} MB')
+        del model
+        torch.cuda.empty_cache()
+    base_time = {r[0]: r[3] for r in rows if r[1] == runs[0][0]}
+    for r in rows:
+        r.append(base_time[r[0]] / r[3])
+    return rows
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    rows = []
+    for config in args.configs:
+        rows.extend(bench_scene(config, args, device))
+
+    header = ['scene', 'mode', 'psnr', 'sec_per_frame', 'allocs_per_frame', 'color_mb', f'speedup_vs_{args.modes[0]}']
+    print(''.join(f'{h:>20s}' for h in header))
+    for r in rows:
+        print(f'{r[0]:>20s}{r[1]:>20s}{r[2]:>20.3f}{r[3]:>20.4f}{r[4]:>20.0f}{r[5]:>20.2f}{r[6]:>20.2f}')
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(','.join(header) + '\n')
+            for r in rows:
+                f.write(','.join(str(v) for v in r) + '\n')
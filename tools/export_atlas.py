@@ -0,0 +1,94 @@
+'''Export a trained scene to the brick atlas of lib/atlas.py and verify it.
+The atlas is written to basedir/expname/atlas/atlas.bin. With --verify, the test views are
+rendered by the model forward and by the numpy reference renderer of the atlas (AtlasRenderer),
+and the PSNR between them (and to the ground truth) is reported.
+
+Example:
+    python tools/export_atlas.py --config configs/nerf/lego.py --ckpt extreme_saving --verify --testskip 25
+'''
+import os, sys, time, argparse
+import numpy as np
+import mmengine
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import dvgo, atlas
+from lib.load_data import load_data
+from lib.renderer import select_model_class, build_render_kwargs
+from tools.bench_render import load_model
+
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', required=True,
+                        help='config file of the trained scene')
+    parser.add_argument('--ckpt', type=str, default='extreme_saving',
+                        help='checkpoint name under basedir/expname (extreme_saving for the compressed model)')
+    parser.add_argument('--brick_size', type=int, default=8)
+    parser.add_argument('--alpha_thres', type=float, default=None,
+                        help='drop the bricks whose alpha never exceeds it (default: the fast_color_thres of the model)')
+    parser.add_argument('--out', type=str, default='',
+                        help='directory of the atlas (default: basedir/expname/atlas)')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare the reference renderer of the atlas to the model forward on the test views')
+    parser.add_argument('--testskip', type=int, default=8,
+                        help='verify every testskip-th test view')
+    parser.add_argument('--chunk', type=int, default=8192)
+    return parser
+
+
+def psnr(a, b):
+    return -10. * np.log10(np.mean(np.square(a - b)))
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    cfg = mmengine.Config.fromfile(args.config)
+    assert not cfg.data.ndc and not cfg.data.unbounded_inward, 'Only support the DirectVoxGO scenes'
+    data_dict = load_data(cfg.data)
+    render_kwargs = build_render_kwargs(cfg, data_dict['near'], data_dict['far'])
+    model = load_model(select_model_class(cfg.data), os.path.join(cfg.basedir, cfg.expname, f'{args.ckpt}.tar'), device)
+    model.eval()
+
+    out = args.out or os.path.join(cfg.basedir, cfg.expname, 'atlas')
+    os.makedirs(out, exist_ok=True)
+    header = atlas.export_atlas(model, out, render_kwargs['stepsize'], brick_size=args.brick_size,
+                                alpha_thres=args.alpha_thres, render_kwargs=render_kwargs)
+    print(f'export_atlas: {header["n_bricks"]} bricks of {args.brick_size}^3 -> {out}')
+    if not args.verify:
+        sys.exit()
+
+    reference = atlas.AtlasRenderer(out)
+    i_test = data_dict['i_test'][::args.testskip]
+    rows = []
+    for i in i_test:
+        (H, W), K, c2w = data_dict['HW'][i], data_dict['Ks'][i], data_dict['poses'][i]
+        rays_o, rays_d, viewdirs = [x.flatten(0,-2) for x in dvgo.get_rays_of_a_view(
+                H, W, K, torch.Tensor(c2w), cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)]
+        eps_time = time.time()
+        with torch.no_grad():
+            rgb_model = torch.cat([
+                model(ro.to(device), rd.to(device), vd.to(device), **render_kwargs)['rgb_marched'].cpu()
+                for ro, rd, vd in zip(rays_o.split(args.chunk), rays_d.split(args.chunk), viewdirs.split(args.chunk))
+            ]).numpy()
+        model_time = time.time() - eps_time
+        eps_time = time.time()
+        rgb_atlas = np.concatenate([
+            reference.render_rays(ro.numpy(), rd.numpy(), vd.numpy(), render_kwargs['near'])[0]
+            for ro, rd, vd in zip(rays_o.split(args.chunk), rays_d.split(args.chunk), viewdirs.split(args.chunk))
+        ])
+        atlas_time = time.time() - eps_time
+        gt = data_dict['images'][i].reshape(-1, 3).cpu().numpy()
+        rows.append([psnr(rgb_atlas, rgb_model), np.abs(rgb_atlas - rgb_model).max(), psnr(rgb_model, gt), psnr(rgb_atlas, gt)])
+        print(f'export_atlas: view {i}: atlas vs model psnr {rows[-1][0]:.2f} (max abs {rows[-1][1]:.4f}) / '
+              f'gt psnr model {rows[-1][2]:.3f} atlas {rows[-1][3]:.3f} / '
+              f'time model {model_time:.2f} atlas {atlas_time:.2f} sec')
+    rows = np.array(rows)
+    print(f'export_atlas: mean atlas vs model psnr {rows[:,0].mean():.2f} (max abs {rows[:,1].max():.4f}) / '
+          f'gt psnr model {rows[:,2].mean():.3f} atlas {rows[:,3].mean():.3f}')
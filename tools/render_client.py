@@ -0,0 +1,69 @@
+'''Local client of tools/render_server.py.
+Send one view (or several concurrent copies of it to exercise the request batching),
+save the rendered image and print the server counters.
+
+Example:
+    python tools/render_client.py --url http://127.0.0.1:8000 --scene lego \
+        --pose pose.txt --H 800 --W 800 --focal 1111 --n_concurrent 8 --out lego.png
+'''
+import os, io, json, time, argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import imageio
+
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--scene', type=str, required=True)
+    parser.add_argument('--pose', type=str, required=True,
+                        help='text file of the 3x4 or 4x4 camera-to-world matrix')
+    parser.add_argument('--H', type=int, default=800)
+    parser.add_argument('--W', type=int, default=800)
+    parser.add_argument('--focal', type=float, default=1111)
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'raw'])
+    parser.add_argument('--n_concurrent', type=int, default=1,
+                        help='number of concurrent requests of the same view')
+    parser.add_argument('--out', type=str, default='',
+                        help='save the rendered image to this png file')
+    return parser
+
+
+def render(url, spec):
+    req = urllib.request.Request(
+            f'{url}/render', data=json.dumps(spec).encode(),
+            headers={'Content-Type': 'application/json'})
+    eps_time = time.time()
+    with urllib.request.urlopen(req) as res:
+        body = res.read()
+        H, W = int(res.headers['X-Height']), int(res.headers['X-Width'])
+    eps_time = time.time() - eps_time
+    if spec['format'] == 'raw':
+        rgb = np.frombuffer(body, dtype=np.float32).reshape(H, W, 3)
+    else:
+        rgb = imageio.imread(io.BytesIO(body))
+    return rgb, eps_time
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    spec = {
+        'scene': args.scene,
+        'c2w': np.loadtxt(args.pose).reshape(-1, 4)[:3].tolist(),
+        'H': args.H, 'W': args.W, 'focal': args.focal,
+        'format': args.format,
+    }
+    with ThreadPoolExecutor(args.n_concurrent) as pool:
+        results = list(pool.map(lambda _: render(args.url, spec), range(args.n_concurrent)))
+    for i, (rgb, eps_time) in enumerate(results):
+        print(f'render_client: request {i} {rgb.shape} {rgb.dtype} in {eps_time*1000:.1f} ms')
+    if args.out:
+        rgb = results[0][0]
+        if rgb.dtype != np.uint8:
+            rgb = (255*np.clip(rgb,0,1)).astype(np.uint8)
+        imageio.imwrite(args.out, rgb)
+    with urllib.request.urlopen(f'{args.url}/stats') as res:
+        print(json.dumps(json.loads(res.read()), indent=2))
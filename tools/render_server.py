@@ -0,0 +1,308 @@
+'''Long-running render service for compressed scenes.
+Compressed scenes (the extreme_saving directories written by run.py) are loaded on demand
+into an LRU of resident models. Concurrent requests arriving within a short window are
+coalesced into shared ray batches and rendered by a single worker thread.
+
+Endpoints:
+    POST /render   json {"scene", "c2w" (3x4 or 4x4), "H", "W", "K" (3x3) or "focal",
+                         "format": "png" | "raw", and optional render_kwargs overrides}
+                   "raw" responds with the float32 [H,W,3] buffer (X-Height/X-Width headers)
+    GET  /stats    latency and throughput counters
+    GET  /scenes   the known and the resident scenes
+
+Example:
+    python tools/render_server.py --scene lego=logs/nerf_synthetic/lego/extreme_saving --port 8000
+    python tools/render_client.py --url http://127.0.0.1:8000 --scene lego --pose pose.txt --focal 1111 --out lego.png
+'''
+import os, io, sys, json, time, queue, argparse, threading, collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import imageio
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import utils
+from lib.renderer import Renderer
+
+
+RENDER_KEYS = ['near', 'far', 'bg', 'stepsize', 'inverse_y', 'flip_x', 'flip_y',
+               'shell_band', 'shell_coarse_step', 'deferred_shading']
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scene', action='append', default=[],
+                        help='name=path of a compressed scene (extreme_saving directory), can be repeated')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_resident', type=int, default=2,
+                        help='number of scenes kept resident on the device')
+    parser.add_argument('--batch_window', type=float, default=5,
+                        help='milliseconds to wait for more requests to share a ray batch')
+    parser.add_argument('--max_batch_rays', type=int, default=1<<21,
+                        help='stop coalescing requests when a batch has this many rays')
+    parser.add_argument('--chunk', type=int, default=8192,
+                        help='number of rays per forward pass')
+    return parser
+
+
+class ModelCache:
+    '''LRU of resident models, loaded and evicted by the render worker.
+    The handler threads only read snapshots of the resident scenes (resident_names), the lock
+    guards the LRU against the concurrent updates of the worker.
+    '''
+
+    def __init__(self, scenes, max_resident, device):
+        self.scenes = scenes
+        self.max_resident = max_resident
+        self.device = device
+        self.resident = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.n_loads = 0
+        self.n_evictions = 0
+
+    def resident_names(self):
+        with self.lock:
+            return list(self.resident.keys())
+
+    def get(self, name):
+        with self.lock:
+            if name in self.resident:
+                self.resident.move_to_end(name)
+                return self.resident[name]
+        if name not in self.scenes:
+            raise KeyError(f'unknown scene {name}')
+        with self.lock:
+            while len(self.resident) >= self.max_resident:
+                self.resident.popitem(last=False)
+                self.n_evictions += 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        path = self.scenes[name]
+        eps_time = time.time()
+        renderer = Renderer.from_compressed(path, device=self.device)
+        with self.lock:
+            self.resident[name] = renderer
+            self.n_loads += 1
+        print(f'render_server: loaded {name} from {path} (eps time: {time.time()-eps_time:.2f} sec)')
+        return renderer
+
+
+class Stats:
+    '''Latency and throughput counters.'''
+
+    def __init__(self, n_latest=1000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.latency = collections.deque(maxlen=n_latest)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.n_rays = 0
+        self.render_time = 0
+
+    def add_batch(self, n_requests, n_rays, render_time):
+        with self.lock:
+            self.n_batches += 1
+            self.n_requests += n_requests
+            self.n_rays += n_rays
+            self.render_time += render_time
+
+    def add_latency(self, latency, error=False):
+        with self.lock:
+            self.latency.append(latency)
+            self.n_errors += error
+
+    def summary(self, model_cache):
+        with self.lock:
+            latency = np.array(self.latency) * 1000 if len(self.latency) else np.zeros(1)
+            uptime = time.time() - self.start_time
+            return {
+                'uptime_sec': uptime,
+                'requests': self.n_requests,
+                'errors': self.n_errors,
+                'batches': self.n_batches,
+                'requests_per_batch': self.n_requests / max(self.n_batches, 1),
+                'rays': self.n_rays,
+                'rays_per_sec_rendering': self.n_rays / max(self.render_time, 1e-9),
+                'frames_per_sec': self.n_requests / max(uptime, 1e-9),
+                'latency_ms_mean': float(latency.mean()),
+                'latency_ms_p50': float(np.percentile(latency, 50)),
+                'latency_ms_p95': float(np.percentile(latency, 95)),
+                'resident_scenes': model_cache.resident_names(),
+                'scene_loads': model_cache.n_loads,
+                'scene_evictions': model_cache.n_evictions,
+            }
+
+
+class RenderRequest:
+
+    def __init__(self, spec):
+        self.scene = spec['scene']
+        self.H, self.W = int(spec['H']), int(spec['W'])
+        if 'K' in spec:
+            self.K = np.array(spec['K'], dtype=np.float32)
+        else:
+            focal = float(spec['focal'])
+            self.K = np.array([[focal, 0, 0.5*self.W], [0, focal, 0.5*self.H], [0, 0, 1]], dtype=np.float32)
+        self.c2w = np.array(spec['c2w'], dtype=np.float32)[:3,:4]
+        self.format = spec.get('format', 'png')
+        self.overrides = {k: spec[k] for k in RENDER_KEYS if k in spec}
+        self.key = (self.scene, json.dumps(self.overrides, sort_keys=True))
+        self.arrival = time.time()
+        self.future = Future()
+
+
+class RenderWorker(threading.Thread):
+    '''Coalesce the queued requests of the same scene and render kwargs into shared ray batches.'''
+
+    def __init__(self, model_cache, stats, batch_window, max_batch_rays, chunk):
+        super().__init__(daemon=True)
+        self.model_cache = model_cache
+        self.stats = stats
+        self.batch_window = batch_window / 1000
+        self.max_batch_rays = max_batch_rays
+        self.chunk = chunk
+        self.queue = queue.Queue()
+        self.pending = []
+
+    def submit(self, req):
+        self.queue.put(req)
+        return req.future
+
+    def next_batch(self):
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        deadline = time.time() + self.batch_window
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                self.pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        key = self.pending[0].key
+        batch, rest, n_rays = [], [], 0
+        for req in self.pending:
+            if req.key == key and (not batch or n_rays + req.H*req.W <= self.max_batch_rays):
+                batch.append(req)
+                n_rays += req.H * req.W
+            else:
+                rest.append(req)
+        self.pending = rest
+        return batch
+
+    @torch.no_grad()
+    def render(self, batch):
+        renderer = self.model_cache.get(batch[0].scene)
+        render_kwargs = dict(renderer.render_kwargs, **batch[0].overrides)
+        missing = [k for k in ['near', 'far', 'stepsize'] if k not in render_kwargs]
+        if missing:
+            raise ValueError(f'render_kwargs {missing} not in the scene metadata, give them in the request')
+        renderer = Renderer(renderer.model, render_kwargs, ndc=renderer.ndc, chunk=self.chunk)
+        rays = [renderer.get_rays(req.c2w, req.H, req.W, req.K) for req in batch]
+        rays_o, rays_d, viewdirs = [torch.cat([r[i] for r in rays]) for i in range(3)]
+        rgb = renderer.render_rays(rays_o, rays_d, viewdirs)['rgb_marched'].cpu().numpy()
+        return np.split(rgb, np.cumsum([req.H*req.W for req in batch])[:-1])
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            eps_time = time.time()
+            try:
+                rgbs = self.render(batch)
+            except Exception as e:
+                for req in batch:
+                    req.future.set_exception(e)
+                continue
+            self.stats.add_batch(len(batch), sum(req.H*req.W for req in batch), time.time() - eps_time)
+            for req, rgb in zip(batch, rgbs):
+                req.future.set_result(rgb.reshape(req.H, req.W, 3))
+
+
+def encode(rgb, fmt):
+    if fmt == 'raw':
+        return np.ascontiguousarray(rgb, dtype=np.float32).tobytes(), 'application/octet-stream'
+    buf = io.BytesIO()
+    imageio.imwrite(buf, utils.to8b(rgb), format='png')
+    return buf.getvalue(), 'image/png'
+
+
+def make_handler(worker, model_cache, stats):
+
+    class RenderHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, obj, code=200):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(stats.summary(model_cache))
+            elif self.path == '/scenes':
+                self.send_json({'scenes': model_cache.scenes, 'resident': model_cache.resident_names()})
+            else:
+                self.send_json({'error': f'unknown path {self.path}'}, 404)
+
+        def do_POST(self):
+            if self.path != '/render':
+                return self.send_json({'error': f'unknown path {self.path}'}, 404)
+            arrival = time.time()
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                req = RenderRequest(spec)
+                if req.scene not in model_cache.scenes:
+                    raise KeyError(f'unknown scene {req.scene}')
+            except Exception as e:
+                stats.add_latency(time.time() - arrival, error=True)
+                return self.send_json({'error': repr(e)}, 400)
+            try:
+                rgb = worker.submit(req).result()
+            except Exception as e:
+                stats.add_latency(time.time() - arrival, error=True)
+                return self.send_json({'error': repr(e)}, 500)
+            body, content_type = encode(rgb, req.format)
+            stats.add_latency(time.time() - arrival)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Height', str(req.H))
+            self.send_header('X-Width', str(req.W))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RenderHandler
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    scenes = dict(s.split('=', 1) for s in args.scene)
+    model_cache = ModelCache(scenes, args.max_resident, device)
+    stats = Stats()
+    worker = RenderWorker(model_cache, stats, args.batch_window, args.max_batch_rays, args.chunk)
+    worker.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(worker, model_cache, stats))
+    print(f'render_server: serving {list(scenes.keys())} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,122 @@
+'''Rate-distortion sweep of the final pruning threshold and the quantization.
+The fine model and its final importance are loaded once; quantize_reformat is then applied
+for every (importance_final, quant_mode, bits) combination, the compressed scene is saved and
+a subsampled test set is rendered. The table of the compressed size and the metrics of each
+combination is written to basedir/expname/sweep/rd.csv.
+The importance_prune threshold is applied while training the fine model and cannot be swept
+without retraining (see run.py --importance_prune).
+
+Example:
+    python tools/sweep_quant.py --config configs/nerf/lego.py \
+        --importance_final 1.0 0.999 0.995 0.99 --quant_modes tensor channel block --bits 8 6 4
+'''
+import os, sys, time, argparse, itertools
+import numpy as np
+import mmengine
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import dvgo
+from lib.load_data import load_data
+from lib.renderer import build_render_kwargs
+from lib.quant import QUANT_MODES
+from run import init_importance, render_viewpoints
+
+
+def config_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', required=True,
+                        help='config file of the trained scene')
+    parser.add_argument('--importance_final', type=float, nargs='+', default=[1.0, 0.999, 0.995, 0.99],
+                        help='quantile thresholds of the final pruning')
+    parser.add_argument('--bits', type=int, nargs='+', default=[8],
+                        help='bit-widths of the grid quantization (<= 8)')
+    parser.add_argument('--quant_modes', type=str, nargs='+', default=['tensor'], choices=QUANT_MODES,
+                        help='quantization modes (see lib/quant.py)')
+    parser.add_argument('--quant_block', type=int, default=16,
+                        help='spatial block size of the block mode')
+    parser.add_argument('--testskip', type=int, default=8,
+                        help='render every testskip-th test view')
+    parser.add_argument('--eval_ssim', action='store_true')
+    parser.add_argument('--eval_lpips_vgg', action='store_true')
+    parser.add_argument('--dump_images', action='store_true')
+    parser.add_argument('--out', type=str, default='',
+                        help='directory of the sweep results (default: basedir/expname/sweep)')
+    return parser
+
+
+def load_vq_model(cfg, device):
+    '''The model of tensor_quantize: the fine model w/ the vq_model_and_render kwargs.'''
+    ckpt = torch.load(os.path.join(cfg.basedir, cfg.expname, 'fine_last.tar'))
+    model_kwargs = ckpt['model_kwargs']
+    model_kwargs.update(cfg.vq_model_and_render)
+    model = dvgo.DirectVoxGO(**model_kwargs)
+    model.load_state_dict(ckpt['model_state_dict'], strict=False)
+    return model.to(device)
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+if __name__=='__main__':
+
+    parser = config_parser()
+    args = parser.parse_args()
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    assert all(1 < b <= 8 for b in args.bits), 'bits should be in [2, 8]'
+
+    cfg = mmengine.Config.fromfile(args.config)
+    data_dict = load_data(cfg.data)
+    sweepdir = args.out or os.path.join(cfg.basedir, cfg.expname, 'sweep')
+    os.makedirs(sweepdir, exist_ok=True)
+    render_kwargs = build_render_kwargs(
+            cfg, data_dict['near'], data_dict['far'], stepsize=cfg.fine_model_and_render.stepsize, render_depth=True)
+    i_test = data_dict['i_test'][::args.testskip]
+
+    # load the fine model and its final importance once
+    model = load_vq_model(cfg, device)
+    i_train = data_dict['i_train']
+    init_importance(
+            model, data_dict['poses'][i_train], data_dict['HW'][i_train], data_dict['Ks'][i_train],
+            cfg.data.ndc, render_kwargs, savedir=os.path.join(cfg.basedir, cfg.expname), if_final=True)
+    importance = model.importance
+    base_state = {k: v.clone() for k, v in model.state_dict().items()}
+
+    rows = []
+    for thres, quant_mode, bits in itertools.product(args.importance_final, args.quant_modes, args.bits):
+        eps_time = time.time()
+        model.load_state_dict(base_state)
+        model.importance = importance
+        savedir = os.path.join(sweepdir, f'final{thres}_{quant_mode}_bits{bits}')
+        os.makedirs(savedir, exist_ok=True)
+        model.quantize_reformat(thres, True, save_path=savedir, render_kwargs=render_kwargs, bits=bits,
+                                quant_mode=quant_mode, block_size=args.quant_block)
+        model.update_occupancy_cache(global_step=-1, cur_thres=1)
+        model.eval()
+        size = dir_size(os.path.join(savedir, 'extreme_saving')) / 2**20
+        n_voxels = model.non_prune_mask.sum().item()
+        render_viewpoints(
+                model, data_dict['poses'][i_test], data_dict['HW'][i_test], data_dict['Ks'][i_test],
+                cfg.data.ndc, render_kwargs,
+                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in i_test],
+                savedir=savedir, dump_images=args.dump_images,
+                eval_ssim=args.eval_ssim, eval_lpips_vgg=args.eval_lpips_vgg)
+        psnr, ssim, lpips_vgg = np.loadtxt(os.path.join(savedir, 'mean.txt'))[:3]
+        eps_time = time.time() - eps_time
+        rows.append([thres, quant_mode, bits, n_voxels, size, psnr, ssim, lpips_vgg, eps_time])
+        print(f'sweep_quant: importance_final {thres} {quant_mode} bits {bits}: {n_voxels} voxels / {size:.3f} MB / '
+              f'psnr {psnr:.3f} (eps time: {eps_time:.1f} sec)')
+
+    header = ['importance_final', 'quant_mode', 'bits', 'voxels', 'size_mb', 'psnr', 'ssim', 'lpips_vgg', 'sec']
+    print(''.join(f'{h:>18s}' for h in header))
+    for r in rows:
+        print(f'{r[0]:>18.4f}{r[1]:>18s}{r[2]:>18d}{r[3]:>18d}{r[4]:>18.3f}{r[5]:>18.3f}{r[6]:>18.4f}{r[7]:>18.4f}{r[8]:>18.1f}')
+    with open(os.path.join(sweepdir, 'rd.csv'), 'w') as f:
+        f.write(','.join(header) + '\n')
+        for r in rows:
+            f.write(','.join(str(v) for v in r) + '\n')